@@ -0,0 +1,4 @@
+"""
+Benchmarks for pit: a synthetic repository generator, and a harness
+timing the hot paths. Run it with python -m bench.
+"""
@@ -0,0 +1,131 @@
+import sys
+import json
+import argparse
+import tempfile
+from bench.generate import RepoSpec, repo_generate
+from bench.harness import BENCHMARKS, bench_child, bench_compare, bench_run
+
+argparser = argparse.ArgumentParser(
+    prog="python -m bench", description="Benchmarks for pit's hot paths"
+)
+argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
+argsubparsers.required = True
+
+
+def spec_arguments(argsp):
+    spec = RepoSpec()
+    argsp.add_argument("--commits", type=int, default=spec.commits)
+    argsp.add_argument(
+        "--width", type=int, default=spec.width, help="Entries per directory"
+    )
+    argsp.add_argument(
+        "--depth", type=int, default=spec.depth, help="Levels of directories"
+    )
+    argsp.add_argument(
+        "--changes", type=int, default=spec.changes, help="Files changed per commit"
+    )
+    argsp.add_argument(
+        "--blob-size", type=int, default=spec.blob_size, help="Median blob size"
+    )
+    argsp.add_argument(
+        "--blob-sigma",
+        type=float,
+        default=spec.blob_sigma,
+        help="Spread of the log-normal blob sizes",
+    )
+    argsp.add_argument(
+        "--branchiness",
+        type=float,
+        default=spec.branchiness,
+        help="Chance of a commit going to a side branch",
+    )
+    argsp.add_argument("--seed", type=int, default=spec.seed)
+
+
+def spec_from(args):
+    return RepoSpec(
+        args.commits,
+        args.width,
+        args.depth,
+        args.changes,
+        args.blob_size,
+        args.blob_sigma,
+        args.branchiness,
+        args.seed,
+    )
+
+
+# python -m bench generate
+argsp = argsubparsers.add_parser("generate", help="Create a synthetic repository.")
+argsp.add_argument("path", help="Where to create it")
+argsp.add_argument(
+    "--pack", action="store_true", help="Write the objects into a pack"
+)
+spec_arguments(argsp)
+
+# python -m bench run
+argsp = argsubparsers.add_parser(
+    "run", help="Run the benchmarks, on a new synthetic repository by default."
+)
+argsp.add_argument("--repo", help="Benchmark this repository instead")
+argsp.add_argument(
+    "--only", action="append", choices=list(BENCHMARKS), help="Benchmarks to run"
+)
+argsp.add_argument("--iterations", type=int, help="Operations per benchmark")
+argsp.add_argument("-o", dest="output", help="Write the results to this JSON file")
+spec_arguments(argsp)
+
+# python -m bench compare
+argsp = argsubparsers.add_parser(
+    "compare", help="Compare results against a baseline, flagging regressions."
+)
+argsp.add_argument("baseline", help="Results of the baseline run")
+argsp.add_argument("current", help="Results of the run to check")
+argsp.add_argument(
+    "--threshold",
+    type=float,
+    default=0.1,
+    help="Relative growth flagged as a regression",
+)
+
+# python -m bench child, used by run.
+argsp = argsubparsers.add_parser("child")
+argsp.add_argument("path")
+argsp.add_argument("name", choices=list(BENCHMARKS))
+argsp.add_argument("--iterations", type=int)
+
+
+def main(argv=sys.argv[1:]):
+    args = argparser.parse_args(argv)
+    match args.command:
+        case "generate":
+            repo_generate(args.path, spec_from(args), args.pack)
+        case "run":
+            if args.repo:
+                results = bench_run(args.repo, args.only, args.iterations)
+            else:
+                spec = spec_from(args)
+                with tempfile.TemporaryDirectory(prefix="pit-bench-") as path:
+                    repo_generate(path, spec)
+                    results = bench_run(path, args.only, args.iterations, spec.asdict())
+
+            text = json.dumps(results, indent=2)
+            if args.output:
+                with open(args.output, "w") as f:
+                    f.write(text + "\n")
+            else:
+                print(text)
+        case "compare":
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            with open(args.current) as f:
+                current = json.load(f)
+            lines, regressions = bench_compare(baseline, current, args.threshold)
+            print("\n".join(lines))
+            sys.exit(1 if regressions else 0)
+        case "child":
+            print(json.dumps(bench_child(args.path, args.name, args.iterations)))
+
+
+if __name__ == "__main__":
+    main()
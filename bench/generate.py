@@ -0,0 +1,160 @@
+import math
+import random
+from commands.init import repo_create
+from object import object_write, GitBlob, GitCommit, GitTree
+from odb import object_batch
+from ref import ref_create
+from repo import repo_path
+from tree import GitTreeLeaf
+
+# The first commit of every generated repository, so that runs with
+# the same parameters make the same objects.
+EPOCH = 1700000000
+
+
+class RepoSpec(object):
+    """
+    The shape of a synthetic repository.
+
+    The worktree has depth levels of directories, width entries in
+    each: width ** depth files. Every commit rewrites changes files.
+    Blob sizes follow a log-normal distribution of median blob_size
+    bytes. branchiness is the chance that a commit goes to a side
+    branch rather than main, and that a side branch gets merged back.
+    """
+
+    def __init__(
+        self,
+        commits=200,
+        width=8,
+        depth=3,
+        changes=3,
+        blob_size=2048,
+        blob_sigma=1.0,
+        branchiness=0.1,
+        seed=0,
+    ):
+        self.commits = commits
+        self.width = width
+        self.depth = depth
+        self.changes = changes
+        self.blob_size = blob_size
+        self.blob_sigma = blob_sigma
+        self.branchiness = branchiness
+        self.seed = seed
+
+    def asdict(self):
+        return dict(vars(self))
+
+
+def blob_data(rng, spec):
+    """Random text, of a size drawn from the distribution of spec."""
+    size = int(rng.lognormvariate(math.log(spec.blob_size), spec.blob_sigma))
+    line = "{0:08x} synthetic line of generated content\n"
+    lines = [line.format(rng.getrandbits(32)) for _ in range(size // 46 + 1)]
+    return "".join(lines)[:size].encode("ascii")
+
+
+def tree_build(repo, node, dirty):
+    """
+    Write the trees of node, a dict of names to blob shas or nested
+    dicts, and return the root sha. Only the directories in dirty
+    are written: the others keep the sha cached under "".
+    """
+    stack = [(node, False)]
+    while stack:
+        node, visited = stack.pop()
+        if not visited:
+            if id(node) not in dirty and "" in node:
+                continue
+            stack.append((node, True))
+            stack.extend((n, False) for k, n in node.items() if type(n) == dict)
+            continue
+
+        tree = GitTree()
+        for name, child in node.items():
+            if name == "":
+                continue
+            if type(child) == dict:
+                tree.items.append(GitTreeLeaf(b"040000", name, child[""]))
+            else:
+                tree.items.append(GitTreeLeaf(b"100644", name, child))
+        node[""] = object_write(tree, repo)
+
+    return node[""]
+
+
+def commit_write(repo, tree, parents, date, message):
+    c = GitCommit()
+    c.kvlm[b"tree"] = tree.encode()
+    if parents:
+        c.kvlm[b"parent"] = [p.encode() for p in parents]
+    ident = "Bench <bench@example.com> {0} +0000".format(date).encode()
+    c.kvlm[b"author"] = ident
+    c.kvlm[b"committer"] = ident
+    c.kvlm[None] = message.encode() + b"\n"
+    return object_write(c, repo)
+
+
+def repo_generate(path, spec, pack=False):
+    """
+    Create a repository at path, shaped by spec, with pit's own
+    object writer. Return the repository. Objects are loose, or in
+    a single pack if pack is set.
+    """
+    rng = random.Random(spec.seed)
+    repo = repo_create(path)
+
+    # Every file path, as the list of its components.
+    paths = [[]]
+    for _ in range(spec.depth):
+        paths = [p + ["d{0}".format(i)] for p in paths for i in range(spec.width)]
+    paths = [p[:-1] + ["f" + p[-1][1:] + ".txt"] for p in paths]
+
+    with object_batch(repo, pack):
+        root = dict()
+        for p in paths:
+            node = root
+            for name in p[:-1]:
+                node = node.setdefault(name, dict())
+            node[p[-1]] = object_write(GitBlob(blob_data(rng, spec)), repo)
+
+        main = None
+        branches = dict()  # Side branch name -> head.
+        for i in range(spec.commits):
+            # Rewrite a few files, and mark their directories dirty.
+            dirty = {id(root)}
+            for p in rng.sample(paths, min(spec.changes, len(paths))):
+                node = root
+                for name in p[:-1]:
+                    node = node[name]
+                    dirty.add(id(node))
+                node[p[-1]] = object_write(GitBlob(blob_data(rng, spec)), repo)
+            tree = tree_build(repo, root, dirty)
+            date = EPOCH + 60 * i
+
+            if main and rng.random() < spec.branchiness:
+                if branches and rng.random() < 0.5:
+                    # Merge a side branch back.
+                    name = rng.choice(sorted(branches))
+                    parents = [main, branches.pop(name)]
+                    main = commit_write(repo, tree, parents, date, "Merge " + name)
+                else:
+                    # Work on a side branch, forked from main if new.
+                    name = "topic{0}".format(rng.randrange(4))
+                    parent = branches.get(name, main)
+                    branches[name] = commit_write(repo, tree, [parent], date, name)
+                    ref_create(repo, "heads/" + name, branches[name])
+                continue
+
+            main = commit_write(
+                repo, tree, [main] if main else [], date, "Commit {0}".format(i)
+            )
+
+    with open(repo_path(repo, "HEAD"), "r") as f:
+        head = f.read().strip()[len("ref: refs/") :]
+    if main:
+        ref_create(repo, head, main)
+        ref_create(repo, "tags/v1", main)
+
+    return repo
@@ -0,0 +1,228 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+from commands.hash import hash_object
+from commands.init import repo_create
+from commands.log import log_print
+from commands.ref import show_refs
+from commands.tree import ls_tree, tree_checkout
+from config import GitConfig
+from object import object_abbrev, object_find, object_list_loose, object_read
+from pack import pack_list
+from ref import ref_list
+from repo import repo_find
+
+# Where pit's modules are, for the child processes.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def object_sample(repo, count, rng):
+    """Up to count random shas of repo, loose or packed."""
+    shas = list(object_list_loose(repo))
+    for pack in pack_list(repo):
+        shas.extend(pack.index)
+    return rng.sample(shas, min(count, len(shas)))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def bench_object_read(path, iterations, rng):
+    """Read objects with a cold cache: the cost of the object store."""
+    repo = repo_find(path)
+    ret = list()
+    for sha in object_sample(repo, iterations, rng):
+        repo.cache.clear()
+        ret.append(timed(object_read, repo, sha))
+    return ret
+
+
+def bench_object_find(path, iterations, rng):
+    """Resolve ref names and abbreviated shas."""
+    repo = repo_find(path)
+    shas = object_sample(repo, iterations, rng)
+    names = ["HEAD", "main", "v1"] + [object_abbrev(repo, sha) for sha in shas]
+    return [timed(object_find, repo, names[i % len(names)]) for i in range(iterations)]
+
+
+def bench_log(path, iterations, rng):
+    """The whole history of HEAD, from a fresh process state each time."""
+    ret = list()
+    with open(os.devnull, "wb") as out:
+        for _ in range(iterations):
+            repo = repo_find(path)
+            sha = object_find(repo, "HEAD", fmt=b"commit")
+            ret.append(timed(log_print, repo, sha, out))
+    return ret
+
+
+def bench_ls_tree(path, iterations, rng):
+    """ls-tree -r HEAD."""
+    ret = list()
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        for _ in range(iterations):
+            repo = repo_find(path)
+            ret.append(timed(ls_tree, repo, "HEAD", True))
+            out.seek(0)
+            out.truncate()
+    return ret
+
+
+def bench_checkout(path, iterations, rng):
+    """Checkout HEAD in an empty directory."""
+    ret = list()
+    for _ in range(iterations):
+        repo = repo_find(path)
+        tree = object_read(repo, object_read(repo, object_find(repo, "HEAD")).tree)
+        dest = tempfile.mkdtemp(prefix="pit-bench-")
+        try:
+            ret.append(timed(tree_checkout, repo, tree, dest))
+        finally:
+            shutil.rmtree(dest)
+    return ret
+
+
+def bench_hash_object(path, iterations, rng):
+    """
+    Hash and write new blobs of 64 KB. They go to a throwaway repository
+    with the configuration of the one at path, so that the same object
+    store is measured without filling the real one with garbage.
+    """
+    conf = repo_find(path).conf
+    ret = list()
+    with tempfile.TemporaryDirectory(prefix="pit-bench-") as scratch:
+        repo = repo_create(scratch)
+        repo.conf = GitConfig(dict(conf.values))
+        # A SQLite store at a configured path would be the real one.
+        repo.conf.values.pop(repo.conf.key("pit", "objectStorePath"), None)
+        with tempfile.TemporaryFile() as f:
+            for _ in range(iterations):
+                f.seek(0)
+                f.truncate()
+                f.write(rng.randbytes(64 * 1024))
+                f.seek(0)
+                ret.append(timed(hash_object, f, b"blob", repo))
+    return ret
+
+
+def bench_show_refs(path, iterations, rng):
+    """List refs, reading them afresh each time."""
+    ret = list()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            repo = repo_find(path)
+            start = time.perf_counter()
+            show_refs(repo, ref_list(repo), prefix="refs")
+            ret.append(time.perf_counter() - start)
+    return ret
+
+
+# Name -> (function, default iterations).
+BENCHMARKS = {
+    "object_read": (bench_object_read, 500),
+    "object_find": (bench_object_find, 500),
+    "log": (bench_log, 5),
+    "ls-tree": (bench_ls_tree, 5),
+    "checkout": (bench_checkout, 3),
+    "hash-object": (bench_hash_object, 100),
+    "show-refs": (bench_show_refs, 50),
+}
+
+
+def percentile(values, p):
+    """The p-th percentile of sorted values, by nearest rank."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def bench_child(path, name, iterations=None, seed=0):
+    """
+    Run benchmark name on the repository at path, in this process.
+    Return its measures.
+    """
+    fn, default = BENCHMARKS[name]
+    times = sorted(fn(path, iterations or default, random.Random(seed)))
+    total = sum(times)
+
+    return dict(
+        ops=len(times),
+        total=total,
+        throughput=len(times) / total if total else None,
+        p50=percentile(times, 50),
+        p99=percentile(times, 99),
+        # Kilobytes, on Linux.
+        max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+
+
+def bench_run(path, names=None, iterations=None, spec=None):
+    """
+    Run the benchmarks names (all by default) on the repository at
+    path. Each runs in its own process, so its peak RSS is its own.
+    Return the results, ready to dump as JSON.
+    """
+    results = dict()
+    for name in names or BENCHMARKS:
+        cmd = [sys.executable, "-m", "bench", "child", path, name]
+        if iterations:
+            cmd += ["--iterations", str(iterations)]
+        res = subprocess.run(cmd, cwd=ROOT, capture_output=True, check=True)
+        results[name] = json.loads(res.stdout)
+
+    return dict(
+        time=int(time.time()),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        cpus=os.cpu_count(),
+        spec=spec,
+        benchmarks=results,
+    )
+
+
+def bench_compare(baseline, current, threshold=0.1):
+    """
+    Compare two runs. Return a line per benchmark, and the names of
+    those whose p50 latency or peak RSS grew by more than threshold.
+    """
+    lines = list()
+    regressions = list()
+    for name, cur in current["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if not base:
+            lines.append("{0:<12} new".format(name))
+            continue
+
+        flags = list()
+        for key in ("p50", "max_rss"):
+            if base[key] and cur[key] > base[key] * (1 + threshold):
+                flags.append(key)
+        if flags:
+            regressions.append(name)
+
+        lines.append(
+            "{0:<12} p50 {1:9.3f}ms -> {2:9.3f}ms ({3:+6.1%})  "
+            "rss {4:7}K -> {5:7}K{6}".format(
+                name,
+                base["p50"] * 1000,
+                cur["p50"] * 1000,
+                cur["p50"] / base["p50"] - 1 if base["p50"] else 0,
+                base["max_rss"],
+                cur["max_rss"],
+                "  REGRESSION ({0})".format(", ".join(flags)) if flags else "",
+            )
+        )
+
+    return lines, regressions
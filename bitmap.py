@@ -0,0 +1,423 @@
+import os
+import sys
+import mmap
+import array
+import struct
+import hashlib
+from commitgraph import commit_parents
+from object import object_read
+from pack import pack_list
+from error import GitException
+
+# Reachability bitmaps, in git's .bitmap format, next to their pack.
+# Bit n of a bitmap stands for the n-th object of the pack in pack
+# order, the order of their offsets.
+BITMAP_MAGIC = b"BITM"
+BITMAP_OPT_FULL_DAG = 0x1
+
+# The reverse index, in git's .rev format: the index positions of the
+# objects, in pack order.
+RIDX_MAGIC = b"RIDX"
+
+# The types of the objects, one bitmap each, in the order of the file.
+TYPE_BITMAPS = (b"commit", b"tree", b"blob", b"tag")
+
+# One commit in this many, in a parents first order, gets a bitmap,
+# on top of the ref tips. Reaching any commit of the pack takes at
+# most that many steps before hitting a bitmap.
+BITMAP_INTERVAL = 100
+
+# EWAH words are 64 bits. A run length word has the bit of its run,
+# its length in words, then how many literal words follow it.
+EWAH_ONES = 0xFFFFFFFFFFFFFFFF
+EWAH_RUN_MAX = 0xFFFFFFFF
+EWAH_LITERAL_MAX = 0x7FFFFFFF
+
+
+def ewah_words(data):
+    """Big-endian 64 bits words to little-endian bytes."""
+    words = array.array("Q")
+    words.frombytes(data)
+    if sys.byteorder == "little":
+        words.byteswap()
+    return words.tobytes()
+
+
+def ewah_decode(buf, pos):
+    """
+    Decode the EWAH bitmap at pos in buf into a Python int, bit n of
+    the bitmap being bit n of the int. Return it, and the position
+    after the bitmap.
+    """
+    size, count = struct.unpack_from(">II", buf, pos)
+    pos += 8
+    end = pos + 8 * count
+
+    parts = list()
+    while pos < end:
+        rlw = struct.unpack_from(">Q", buf, pos)[0]
+        pos += 8
+        run = (rlw >> 1) & EWAH_RUN_MAX
+        literals = rlw >> 33
+        parts.append((b"\xff" if rlw & 1 else b"\x00") * (8 * run))
+        parts.append(ewah_words(buf[pos : pos + 8 * literals]))
+        pos += 8 * literals
+
+    bits = int.from_bytes(b"".join(parts), "little")
+    # Skip the position of the last run length word.
+    return bits & ((1 << size) - 1), end + 4
+
+
+def ewah_encode(bits, size):
+    """Encode the first size bits of int bits as an EWAH bitmap."""
+    words = array.array("Q")
+    words.frombytes(bits.to_bytes(8 * ((size + 63) // 64), "little"))
+    if sys.byteorder == "big":
+        words.byteswap()
+
+    out = list()
+    rlw = 0
+    i = 0
+    n = len(words)
+    while i < n:
+        # A run of empty or full words, maybe none, then literals.
+        w = words[i]
+        j = i
+        if w == 0 or w == EWAH_ONES:
+            while j < n and words[j] == w and j - i < EWAH_RUN_MAX:
+                j += 1
+        run = j - i
+        k = j
+        while k < n and words[k] not in (0, EWAH_ONES) and k - j < EWAH_LITERAL_MAX:
+            k += 1
+
+        rlw = len(out)
+        out.append((w == EWAH_ONES and run > 0) | (run << 1) | ((k - j) << 33))
+        out.extend(words[j:k])
+        i = k
+
+    return (
+        struct.pack(">II", size, len(out))
+        + struct.pack(">%dQ" % len(out), *out)
+        + struct.pack(">I", rlw)
+    )
+
+
+def ridx_write(path, order, checksum):
+    """
+    Write the reverse index of a pack: order holds the index positions
+    of its objects in pack order.
+    """
+    data = (
+        RIDX_MAGIC
+        + struct.pack(">II", 1, 1)
+        + struct.pack(">%dI" % len(order), *order)
+        + checksum
+    )
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.write(hashlib.sha1(data).digest())
+    os.replace(path + ".tmp", path)
+
+
+class GitPackBitmap(object):
+    """
+    The reachability bitmaps of a pack: for some commits, every object
+    of the pack they reach, and the objects of the pack by type.
+
+    Bitmaps are Python ints, decoded on first use: and, or and
+    bit_count() on them run at C speed.
+    """
+
+    def __init__(self, pack, path):
+        self.pack = pack
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[0:4] != BITMAP_MAGIC:
+            raise GitException("Not a bitmap {0}".format(path))
+        vers, options, count = struct.unpack_from(">HHI", self.map, 4)
+        if vers != 1 or not options & BITMAP_OPT_FULL_DAG:
+            raise GitException("Unsupported bitmap {0}".format(path))
+        if self.map[12:32] != pack.map[-20:]:
+            raise GitException("Bitmap {0} is for another pack".format(path))
+
+        self.size = len(pack.index)
+        pos = 32
+        self.types = list()
+        for _ in range(4):
+            bits, pos = ewah_decode(self.map, pos)
+            self.types.append(bits)
+        self.commits, self.trees, self.blobs, self.tags = self.types
+
+        # Commit index position -> the position of its entry. Each
+        # entry may be stored xored with one of the entries before it.
+        self.entries = dict()
+        self.offsets = list()  # Entry -> (bitmap position, xor offset).
+        for i in range(count):
+            idx_pos, xor, _ = struct.unpack_from(">IBB", self.map, pos)
+            self.entries[idx_pos] = i
+            self.offsets.append((pos + 6, xor))
+            words = struct.unpack_from(">I", self.map, pos + 10)[0]
+            pos += 6 + 8 + 8 * words + 4
+        self.decoded = dict()
+
+        self.rev = None  # Pack position -> index position.
+        self.inverse = None  # Index position -> pack position.
+
+    def entry(self, i):
+        if i not in self.decoded:
+            pos, xor = self.offsets[i]
+            bits = ewah_decode(self.map, pos)[0]
+            if xor:
+                bits ^= self.entry(i - xor)
+            self.decoded[i] = bits
+        return self.decoded[i]
+
+    def reverse(self):
+        """Return the index positions of the objects, in pack order."""
+        if self.rev is None:
+            path = self.pack.path[: -len(".pack")] + ".rev"
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    data = f.read()
+                if data[0:4] != RIDX_MAGIC:
+                    raise GitException("Not a reverse index {0}".format(path))
+                self.rev = array.array("I")
+                self.rev.frombytes(data[12 : 12 + 4 * self.size])
+                if sys.byteorder == "little":
+                    self.rev.byteswap()
+            else:
+                index = self.pack.index
+                self.rev = array.array(
+                    "I", sorted(range(self.size), key=index.offset)
+                )
+        return self.rev
+
+    def position(self, sha):
+        """Return the bit of object sha, or None if it's not in the pack."""
+        binsha = bytes.fromhex(sha)
+        index = self.pack.index
+        i = index.bisect(binsha)
+        if i == self.size or index.sha(i) != binsha:
+            return None
+
+        if self.inverse is None:
+            self.inverse = array.array("I", bytes(4 * self.size))
+            for pos, idx_pos in enumerate(self.reverse()):
+                self.inverse[idx_pos] = pos
+        return self.inverse[i]
+
+    def commit(self, sha):
+        """Return the bitmap of commit sha, or None if it has none."""
+        binsha = bytes.fromhex(sha)
+        i = self.pack.index.bisect(binsha)
+        if i == self.size or self.pack.index.sha(i) != binsha:
+            return None
+        entry = self.entries.get(i)
+        return None if entry is None else self.entry(entry)
+
+    def sha(self, pos):
+        return self.pack.index.sha(self.reverse()[pos]).hex()
+
+
+def bitmap_find(repo):
+    """
+    Return the bitmap of the first pack of repo that has one, or None.
+    It is opened once and kept on the repository, until the packs
+    change.
+    """
+    packs = pack_list(repo)
+    if repo.bitmap is None or repo.bitmap[0] is not packs:
+        bitmap = None
+        for pack in packs:
+            path = pack.path[: -len(".pack")] + ".bitmap"
+            if os.path.isfile(path):
+                bitmap = GitPackBitmap(pack, path)
+                break
+        repo.bitmap = (packs, bitmap)
+
+    return repo.bitmap[1]
+
+
+def bitmap_walk(repo, bitmap, tips, objects=True):
+    """
+    Compute what the commits tips reach, through bitmap, an object
+    with the position() and commit() of GitPackBitmap. Commits with a
+    bitmap aren't walked any further: only the history between tips
+    and the nearest bitmaps is read, and, if objects is set, the trees
+    of that history. Without objects, only commits are marked.
+
+    Return the bitmap of the objects reached in the pack, and a dict
+    of the others, from their sha to their type.
+    """
+    bits = 0
+    extra = dict()
+
+    # First the commits, down to the ones with a bitmap.
+    walked = list()
+    seen = set()
+    stack = list(tips)
+    while stack:
+        sha = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        reached = bitmap.commit(sha)
+        if reached is not None:
+            bits |= reached
+            continue
+
+        walked.append(sha)
+        stack.extend(commit_parents(repo, sha))
+
+    # Then the objects of the walked commits that the bitmaps don't
+    # have. Testing bits of a big int copies it: test them on bytes.
+    covered = bits.to_bytes((bits.bit_length() + 7) // 8 + 1, "little")
+    marked = set()
+
+    def mark(sha, fmt):
+        """Mark sha, return whether it is new."""
+        pos = bitmap.position(sha)
+        if pos is None:
+            if sha in extra:
+                return False
+            extra[sha] = fmt
+            return True
+        if pos in marked or (
+            pos >> 3 < len(covered) and covered[pos >> 3] >> (pos & 7) & 1
+        ):
+            return False
+        marked.add(pos)
+        return True
+
+    for sha in walked:
+        mark(sha, b"commit")
+
+    if objects:
+        stack = [object_read(repo, sha).tree for sha in walked]
+        while stack:
+            sha = stack.pop()
+            if not mark(sha, b"tree"):
+                continue
+            entries = object_read(repo, sha).entries
+            for i in range(len(entries)):
+                if entries.is_tree(i):
+                    stack.append(entries.sha(i))
+                elif not entries.mode(i).startswith(b"16"):
+                    # Submodules point to another repository.
+                    mark(entries.sha(i), b"blob")
+
+    if marked:
+        buf = bytearray(covered.ljust(bitmap.size // 8 + 1, b"\x00"))
+        for pos in marked:
+            buf[pos >> 3] |= 1 << (pos & 7)
+        bits = int.from_bytes(buf, "little")
+
+    return bits, extra
+
+
+class GitBitmapBuilder(object):
+    """The bitmaps of a pack being written, for bitmap_walk."""
+
+    def __init__(self, positions):
+        self.positions = positions  # sha -> pack position.
+        self.size = len(positions)
+        self.bitmaps = dict()  # Commit sha -> bitmap.
+
+    def position(self, sha):
+        return self.positions.get(sha)
+
+    def commit(self, sha):
+        return self.bitmaps.get(sha)
+
+
+def bitmap_write(repo, pack_path, types, tips):
+    """
+    Write the .bitmap and .rev files of the pack at pack_path, whose
+    objects types maps to their type. Every commit in tips gets a
+    bitmap, and one commit in BITMAP_INTERVAL of their history. The
+    pack must hold every object they reach. Return the number of
+    bitmaps written, or None, writing nothing, if their history has
+    objects missing from the pack.
+    """
+    pack = next(p for p in pack_list(repo) if p.path == pack_path)
+    index = pack.index
+    size = len(index)
+
+    # Pack order, and the bit of each object.
+    order = sorted(range(size), key=index.offset)
+    positions = {index.sha(i).hex(): pos for pos, i in enumerate(order)}
+
+    # The commits of the pack reachable from tips, parents first.
+    peeled = list()
+    for sha in tips:
+        while types.get(sha) == b"tag":
+            sha = object_read(repo, sha).object
+        if types.get(sha) == b"commit":
+            peeled.append(sha)
+    tips = list(dict.fromkeys(peeled))
+
+    history = list()
+    done = set()
+    for tip in tips:
+        stack = [(tip, False)]
+        while stack:
+            sha, expanded = stack.pop()
+            if expanded:
+                history.append(sha)
+                continue
+            if sha in done:
+                continue
+            done.add(sha)
+            stack.append((sha, True))
+            stack.extend(
+                (p, False) for p in commit_parents(repo, sha) if p not in done
+            )
+
+    selected = set(tips) | set(history[BITMAP_INTERVAL - 1 :: BITMAP_INTERVAL])
+
+    builder = GitBitmapBuilder(positions)
+    entries = list()
+    for sha in history:
+        if sha not in selected:
+            continue
+        bits, extra = bitmap_walk(repo, builder, [sha])
+        if extra:
+            # The history goes out of the pack: git requires the full
+            # graph of every bitmap.
+            return None
+        builder.bitmaps[sha] = bits
+        # Entries are never xored with another one.
+        header = struct.pack(">IBB", order[positions[sha]], 0, 0)
+        entries.append(header + ewah_encode(bits, size))
+
+    type_bits = {fmt: bytearray(size // 8 + 1) for fmt in TYPE_BITMAPS}
+    for sha, pos in positions.items():
+        type_bits[types[sha]][pos >> 3] |= 1 << (pos & 7)
+    type_bits = [
+        ewah_encode(int.from_bytes(type_bits[fmt], "little"), size)
+        for fmt in TYPE_BITMAPS
+    ]
+
+    checksum = pack.map[-20:]
+    data = (
+        BITMAP_MAGIC
+        + struct.pack(">HHI", 1, BITMAP_OPT_FULL_DAG, len(entries))
+        + checksum
+        + b"".join(type_bits)
+        + b"".join(entries)
+    )
+
+    base = pack_path[: -len(".pack")]
+    ridx_write(base + ".rev", order, checksum)
+    with open(base + ".bitmap.tmp", "wb") as f:
+        f.write(data)
+        f.write(hashlib.sha1(data).digest())
+    os.replace(base + ".bitmap.tmp", base + ".bitmap")
+
+    repo.bitmap = None
+    return len(entries)
@@ -0,0 +1,121 @@
+import collections
+import threading
+
+# Default byte budgets, overridden by pit.objectCacheLimit and
+# pit.blobCacheLimit in the repository configuration.
+OBJECT_CACHE_LIMIT = 64 * 1024 * 1024
+BLOB_CACHE_LIMIT = 16 * 1024 * 1024
+
+
+def parse_size(value):
+    """Parse a git-style size, with an optional k, m or g suffix."""
+    value = value.strip().lower()
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3}
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+
+class LRUCache(object):
+    """
+    A mapping bounded by the total size of its values, evicting the
+    least recently used entries first. Each entry is stored with its
+    size, as given by the caller.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Return the (value, size) pair stored for key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, value, size):
+        # An entry bigger than a quarter of the budget would flush
+        # most of the cache for a single object: don't keep it.
+        if size > self.limit // 4:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.limit:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "limit": self.limit,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class ObjectCache(object):
+    """
+    The parsed objects of a repository, keyed by sha.
+
+    Trees, commits and tags go in one pool, blobs in another with its
+    own budget, so that a few big files can't push out the trees and
+    commits a history walk keeps coming back to. Sizes are those of
+    the raw object data.
+
+    Cached objects are shared between callers: don't modify them.
+    """
+
+    def __init__(self, limit=OBJECT_CACHE_LIMIT, blob_limit=BLOB_CACHE_LIMIT):
+        self.objects = LRUCache(limit)
+        self.blobs = LRUCache(blob_limit)
+
+    def pool(self, fmt):
+        return self.blobs if fmt == b"blob" else self.objects
+
+    def get(self, sha):
+        """Return the (object, size) pair cached for sha, or None."""
+        # Only count a miss if neither pool has it.
+        if sha in self.blobs:
+            return self.blobs.get(sha)
+        return self.objects.get(sha)
+
+    def put(self, sha, obj, size):
+        self.pool(obj.fmt).put(sha, obj, size)
+
+    def clear(self):
+        self.objects.clear()
+        self.blobs.clear()
+
+    def stats(self):
+        return {"objects": self.objects.stats(), "blobs": self.blobs.stats()}
@@ -0,0 +1,122 @@
+import os
+import time
+from index import index_read, index_write
+from object import object_abbrev, object_write, GitCommit, GitTree
+from ref import ref_create, ref_resolve
+from repo import repo_path
+from tree import GitTreeLeaf
+from error import GitException
+
+
+def tree_write(repo, index):
+    """
+    Write the trees of index, and return the sha of the root one.
+
+    The sha of every directory is kept in index.trees, git's cached
+    trees: directories found there are reused as they are, so only
+    the trees of directories that changed are built and written.
+    """
+    if index.conflicts:
+        raise GitException("Cannot write a tree with unmerged paths")
+
+    # Directory -> its files, as leaves.
+    dirs = {"": list()}
+    for name, entry in index.entries.items():
+        parent, _, base = name.rpartition("/")
+        leaf = GitTreeLeaf(b"%06o" % entry.mode, base, entry.sha)
+        dirs.setdefault(parent, list()).append(leaf)
+
+        # Make sure every ancestor is listed, even without files.
+        while parent and parent.rpartition("/")[0] not in dirs:
+            parent = parent.rpartition("/")[0]
+            dirs[parent] = list()
+
+    # Children first: a tree needs the shas of its subtrees.
+    for path in sorted(dirs, key=lambda p: p.count("/") + bool(p), reverse=True):
+        if path not in index.trees:
+            tree = GitTree()
+            tree.items = dirs[path]
+            index.trees[path] = object_write(tree, repo)
+
+        if path:
+            parent, _, base = path.rpartition("/")
+            dirs[parent].append(GitTreeLeaf(b"040000", base, index.trees[path]))
+
+    return index.trees[""]
+
+
+def user_identity(repo, role):
+    """
+    Return the "name <email>" of the author or committer: from the
+    GIT_AUTHOR_* / GIT_COMMITTER_* environment variables, or the user
+    section of the configuration.
+    """
+    ret = list()
+    for key in ("name", "email"):
+        value = os.environ.get(
+            "GIT_{0}_{1}".format(role.upper(), key.upper())
+        ) or repo.conf.get("user", key)
+        if not value:
+            raise GitException("Please tell me who you are: set user.{0}".format(key))
+        ret.append(value)
+
+    return "{0} <{1}>".format(*ret)
+
+
+def date_now():
+    """Return the current time as git writes it: "<timestamp> <timezone>"."""
+    now = time.time()
+    offset = time.localtime(now).tm_gmtoff
+    sign = "-" if offset < 0 else "+"
+    offset = abs(offset) // 60
+    return "{0} {1}{2:02}{3:02}".format(int(now), sign, offset // 60, offset % 60)
+
+
+def commit(repo, message):
+    """
+    Commit the index on top of HEAD, and move the current branch (or
+    HEAD, if detached) to the new commit. Return its sha.
+    """
+    index = index_read(repo)
+    tree = tree_write(repo, index)
+    # Save the trees we just computed for next time.
+    index_write(repo, index)
+
+    c = GitCommit()
+    c.kvlm[b"tree"] = tree.encode()
+    parent = ref_resolve(repo, "HEAD")
+    if parent:
+        c.kvlm[b"parent"] = parent.encode()
+
+    date = date_now()
+    author = "{0} {1}".format(user_identity(repo, "author"), date)
+    committer = "{0} {1}".format(user_identity(repo, "committer"), date)
+    c.kvlm[b"author"] = author.encode("utf8")
+    c.kvlm[b"committer"] = committer.encode("utf8")
+
+    # Like git, end the message with a newline.
+    c.kvlm[None] = (message.rstrip("\n") + "\n").encode("utf8")
+
+    sha = object_write(c, repo)
+
+    with open(repo_path(repo, "HEAD"), "r") as f:
+        head = f.read().strip()
+    if head.startswith("ref: refs/"):
+        branch = head[10:]
+        ref_create(repo, branch, sha)
+        branch = branch.removeprefix("heads/")
+    else:
+        with open(repo_path(repo, "HEAD"), "w") as f:
+            f.write(sha + "\n")
+        branch = "detached HEAD"
+
+    print(
+        "[{0}{1} {2}] {3}".format(
+            branch,
+            "" if parent else " (root-commit)",
+            object_abbrev(repo, sha),
+            message.strip().split("\n")[0],
+        )
+    )
+
+    return sha
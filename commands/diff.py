@@ -0,0 +1,289 @@
+import sys
+import collections
+from object import object_find, object_read
+from error import GitException
+
+# A change between two trees. Modes are bytes, like b"100644", and
+# the side an entry is missing from has None mode and sha.
+TreeChange = collections.namedtuple(
+    "TreeChange", "status path old_mode new_mode old_sha new_sha"
+)
+
+NULL_SHA = "0" * 40
+
+# How many bytes git looks at to tell binary files.
+BINARY_CHECK = 8000
+
+# Git's default width of --stat output, when not on a terminal.
+STAT_WIDTH = 80
+
+
+def tree_diff(repo, old, new, recursive=True, prefix=""):
+    """
+    Yield the TreeChange between trees old and new (shas, or None for
+    an empty tree), sorted by path.
+
+    Both trees are sorted, so they are walked side by side. Subtrees
+    with the same sha on both sides are skipped without being read:
+    the cost depends on the size of the change, not of the trees.
+    """
+    a = object_read(repo, old).entries if old else None
+    b = object_read(repo, new).entries if new else None
+    i, j = 0, 0
+    na = len(a) if a else 0
+    nb = len(b) if b else 0
+
+    while i < na or j < nb:
+        ka = a.sort_key(i) if i < na else None
+        kb = b.sort_key(j) if j < nb else None
+
+        if kb is None or (ka is not None and ka < kb):
+            # Only in old.
+            yield from tree_diff_side(repo, a, i, prefix, recursive, deleted=True)
+            i += 1
+        elif ka is None or kb < ka:
+            # Only in new.
+            yield from tree_diff_side(repo, b, j, prefix, recursive, deleted=False)
+            j += 1
+        else:
+            binsha_a, binsha_b = a.binsha(i), b.binsha(j)
+            mode_a, mode_b = a.mode(i), b.mode(j)
+            if binsha_a != binsha_b or mode_a != mode_b:
+                path = prefix + a.path(i)
+                if recursive and a.is_tree(i):
+                    yield from tree_diff(
+                        repo, a.sha(i), b.sha(j), recursive, path + "/"
+                    )
+                else:
+                    # Git calls a change between a file, a symlink
+                    # and a submodule a type change.
+                    status = "M" if mode_a[0:2] == mode_b[0:2] else "T"
+                    yield TreeChange(
+                        status, path, mode_a, mode_b, a.sha(i), b.sha(j)
+                    )
+            i += 1
+            j += 1
+
+
+def tree_diff_side(repo, entries, i, prefix, recursive, deleted):
+    """
+    Yield the changes for entry i of entries, found on one side only:
+    in old if deleted, in new otherwise.
+    """
+    path = prefix + entries.path(i)
+    if recursive and entries.is_tree(i):
+        old, new = (entries.sha(i), None) if deleted else (None, entries.sha(i))
+        yield from tree_diff(repo, old, new, recursive, path + "/")
+    elif deleted:
+        yield TreeChange("D", path, entries.mode(i), None, entries.sha(i), None)
+    else:
+        yield TreeChange("A", path, None, entries.mode(i), None, entries.sha(i))
+
+
+def diff_tree(repo, old, new, recursive=False, out=None):
+    """
+    Print the changes between two tree-ish objects, in git's raw
+    diff-tree format.
+    """
+    out = out or sys.stdout.buffer
+    old = object_find(repo, old, fmt=b"tree")
+    new = object_find(repo, new, fmt=b"tree")
+
+    for c in tree_diff(repo, old, new, recursive):
+        line = ":{0} {1} {2} {3} {4}\t{5}\n".format(
+            (c.old_mode or b"000000").decode("ascii"),
+            (c.new_mode or b"000000").decode("ascii"),
+            c.old_sha or NULL_SHA,
+            c.new_sha or NULL_SHA,
+            c.status,
+            c.path,
+        )
+        out.write(line.encode("utf8"))
+    out.flush()
+
+
+def edit_distance(a, b):
+    """
+    Return the length of the shortest edit script between sequences
+    a and b, with Myers' greedy algorithm: O((n + m) * d) time for d
+    edits, and linear memory since we don't need the script itself.
+    """
+    # The common head and tail cost nothing: skip them first.
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end_a, end_b = len(a), len(b)
+    while end_a > start and end_b > start and a[end_a - 1] == b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+    a, b = a[start:end_a], b[start:end_b]
+
+    n, m = len(a), len(b)
+    if not n or not m:
+        return n + m
+
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)  # Diagonal k -> furthest x reached.
+    for d in range(n + m + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]  # An insertion.
+            else:
+                x = v[offset + k - 1] + 1  # A deletion.
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return d
+
+    raise GitException("Unreachable")
+
+
+def blob_lines(data):
+    """
+    Split a blob in lines, with their newline: a last line without
+    one counts, and differs from the same line with one.
+    """
+    lines = data.split(b"\n")
+    last = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def diff_count(repo, change):
+    """
+    Return the (insertions, deletions) of a change in lines, or None
+    if either side is binary. Submodules count for nothing.
+    """
+    sides = list()
+    for mode, sha in (
+        (change.old_mode, change.old_sha),
+        (change.new_mode, change.new_sha),
+    ):
+        if not sha or mode.startswith(b"16"):
+            sides.append(b"")
+            continue
+        data = object_read(repo, sha).blobdata
+        if b"\x00" in data[:BINARY_CHECK]:
+            return None
+        sides.append(data)
+
+    old, new = blob_lines(sides[0]), blob_lines(sides[1])
+    edits = edit_distance(old, new)
+    # Every edit inserts or deletes a line, and the difference is the
+    # change in length.
+    insertions = (edits + len(new) - len(old)) // 2
+    return insertions, edits - insertions
+
+
+def diff_stat(repo, changes):
+    """
+    Return the lines of git's --stat output for changes: a line per
+    file with its count of changed lines and a graph, then a summary.
+    """
+    rows = list()
+    for c in changes:
+        counts = diff_count(repo, c)
+        if counts is None:
+            # Binary files show their sizes instead.
+            old = object_read(repo, c.old_sha).blobdata if c.old_sha else b""
+            new = object_read(repo, c.new_sha).blobdata if c.new_sha else b""
+            rows.append((c.path, None, (len(old), len(new))))
+        else:
+            rows.append((c.path, counts, None))
+    if not rows:
+        return []
+
+    max_change = max((sum(r[1]) for r in rows if r[1]), default=0)
+    max_len = max(len(r[0]) for r in rows)
+    # The length of "Bin XXX -> YYY bytes".
+    bin_width = max(
+        (14 + len(str(r[2][0])) + len(str(r[2][1])) for r in rows if r[2]),
+        default=0,
+    )
+
+    # The widths of the name, count and graph columns, like git sets
+    # them.
+    width = STAT_WIDTH
+    number_width = max(len(str(max_change)), 3 if bin_width else 1)
+    if width < 16 + 6 + number_width:
+        width = 16 + 6 + number_width
+    graph_width = max_change if max_change + 4 > bin_width else bin_width - 4
+    name_width = max_len
+    if name_width + number_width + 6 + graph_width > width:
+        if graph_width > width * 3 // 8 - number_width - 6:
+            graph_width = max(width * 3 // 8 - number_width - 6, 6)
+        if name_width > width - number_width - 6 - graph_width:
+            name_width = width - number_width - 6 - graph_width
+        else:
+            graph_width = width - number_width - 6 - name_width
+
+    lines = list()
+    insertions, deletions = 0, 0
+    for name, counts, binary in rows:
+        if len(name) > name_width:
+            # Cut the head of the name, at a slash if there is one.
+            name = name[len(name) - name_width + 3 :]
+            if "/" in name:
+                name = name[name.index("/") :]
+            name = "..." + name
+
+        if binary:
+            lines.append(
+                " {0:<{1}} | {2:>{3}} {4} -> {5} bytes\n".format(
+                    name, name_width, "Bin", number_width, *binary
+                )
+            )
+            continue
+
+        add, rm = counts
+        insertions += add
+        deletions += rm
+        total = add + rm
+        if graph_width <= max_change:
+            # Scale the graph down, keeping at least one of each.
+            scaled = scale_linear(total, graph_width, max_change)
+            if scaled < 2 and add and rm:
+                scaled = 2
+            if add < rm:
+                add = scale_linear(add, graph_width, max_change)
+                rm = scaled - add
+            else:
+                rm = scale_linear(rm, graph_width, max_change)
+                add = scaled - rm
+        lines.append(
+            " {0:<{1}} | {2:>{3}}{4}{5}{6}\n".format(
+                name,
+                name_width,
+                total,
+                number_width,
+                " " if total else "",
+                "+" * add,
+                "-" * rm,
+            )
+        )
+
+    summary = " {0} file{1} changed".format(
+        len(rows), "" if len(rows) == 1 else "s"
+    )
+    if insertions or not deletions:
+        summary += ", {0} insertion{1}(+)".format(
+            insertions, "" if insertions == 1 else "s"
+        )
+    if deletions or not insertions:
+        summary += ", {0} deletion{1}(-)".format(
+            deletions, "" if deletions == 1 else "s"
+        )
+    lines.append(summary + "\n")
+
+    return lines
+
+
+def scale_linear(it, width, max_change):
+    if not it:
+        return 0
+    return 1 + it * (width - 1) // max_change
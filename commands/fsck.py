@@ -0,0 +1,283 @@
+import os
+import sys
+import hashlib
+import itertools
+import collections
+import concurrent.futures
+from error import GitException
+from index import index_read
+from kvlm import kvlm_header
+from object import object_list_loose
+from odb import object_store
+from pack import PACK_CODES, PACK_TYPES, pack_list
+from ref import ref_resolve, ref_snapshot
+from repo import GitRepository, repo_path
+from tree import tree_parse
+
+# Objects are checked in batches of this many, and at most this many
+# batches per worker are queued at a time: the store is never listed
+# in memory as a whole.
+FSCK_BATCH = 512
+FSCK_QUEUE = 4
+
+# The repository of a worker process, opened by fsck_init.
+fsck_repo = None
+
+
+def fsck_init(worktree):
+    global fsck_repo
+    fsck_repo = GitRepository(worktree)
+
+
+def fsck_workers(repo):
+    """
+    Default number of checking processes: fsck.workers from the
+    configuration, where anything below 1 means one per core.
+    """
+    workers = repo.conf.getint("fsck", "workers", fallback=0)
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def fsck_links(fmt, data):
+    """
+    Return the objects an object points to, as (binary sha, type code)
+    pairs.
+    """
+    links = list()
+    match fmt:
+        case b"tree":
+            entries = tree_parse(data)
+            for i in range(len(entries)):
+                mode = entries.mode(i)
+                if mode == b"160000":
+                    # A submodule commit, from another repository.
+                    continue
+                code = PACK_CODES[b"tree" if entries.is_tree(i) else b"blob"]
+                links.append((entries.binsha(i), code))
+        case b"commit":
+            for key, typ in ((b"tree", b"tree"), (b"parent", b"commit")):
+                for sha in kvlm_header(data, key):
+                    links.append((bytes.fromhex(sha.decode("ascii")), PACK_CODES[typ]))
+        case b"tag":
+            sha = kvlm_header(data, b"object")
+            typ = kvlm_header(data, b"type")
+            if not sha or not typ or typ[0] not in PACK_CODES:
+                raise GitException("bad tag header")
+            links.append((bytes.fromhex(sha[0].decode()), PACK_CODES[typ[0]]))
+    return links
+
+
+def fsck_stored(repo, sha):
+    """
+    Read sha from the object store of repo, check its hash, return its
+    type and data.
+    """
+    res = object_store(repo).get(sha)
+    if res is None:
+        raise GitException("vanished while checking")
+    fmt, data = res
+    h = hashlib.sha1(b"%s %d\x00" % (fmt, len(data)))
+    h.update(data)
+    if h.hexdigest() != sha:
+        raise GitException("hash mismatch")
+    return fmt, data
+
+
+def fsck_packed(repo, pack, sha, offset):
+    """Like fsck_stored, for the entry of pack at offset."""
+    fmt, data = pack.read(repo, offset)
+    h = hashlib.sha1(b"%s %d\x00" % (fmt, len(data)))
+    h.update(data)
+    if h.hexdigest() != sha:
+        raise GitException("hash mismatch")
+    return fmt, data
+
+
+def fsck_check(batch, repo=None):
+    """
+    Check a batch of objects, given as (sha, pack path or None for an
+    unpacked object, pack offset) tuples. Return, for each object, its
+    binary sha, its type code, the objects it points to and an error
+    message or None. This runs in the worker processes of fsck.
+    """
+    repo = repo or fsck_repo
+    packs = {p.path: p for p in pack_list(repo)}
+
+    results = list()
+    for sha, path, offset in batch:
+        try:
+            if path is None:
+                fmt, data = fsck_stored(repo, sha)
+            else:
+                fmt, data = fsck_packed(repo, packs[path], sha, offset)
+            if fmt not in PACK_CODES:
+                raise GitException("unknown type {0}".format(fmt.decode()))
+            links = fsck_links(fmt, data)
+        except Exception as e:
+            # Anything can go wrong with a corrupt object: zlib errors,
+            # bad headers, garbage in trees.
+            results.append((bytes.fromhex(sha), 0, [], str(e) or type(e).__name__))
+        else:
+            results.append((bytes.fromhex(sha), PACK_CODES[fmt], links, None))
+
+    return results
+
+
+def fsck_objects(repo):
+    """
+    Iterate over every object of repo, as fsck_check takes them. An
+    object both unpacked and packed, or in several packs, comes once per
+    copy: each one is checked.
+    """
+    for sha in object_list_loose(repo):
+        yield sha, None, None
+    for pack in pack_list(repo):
+        for i in range(len(pack.index)):
+            yield pack.index.sha(i).hex(), pack.path, pack.index.offset(i)
+
+
+def fsck_roots(repo):
+    """
+    Return the objects fsck walks from, as binary shas: HEAD, every
+    ref, and the blobs and cached trees of the index.
+    """
+    roots = set()
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        roots.add(head)
+    for value in ref_snapshot(repo).refs.values():
+        if not value.startswith("ref: "):
+            roots.add(value)
+
+    if os.path.exists(repo_path(repo, "index")):
+        index = index_read(repo)
+        roots.update(entry.sha for entry in index.entries.values())
+        for entries in index.conflicts.values():
+            roots.update(entry.sha for entry in entries)
+        roots.update(index.trees.values())
+
+    return {bytes.fromhex(sha) for sha in roots}
+
+
+def fsck_pack_checksums(repo):
+    """Return the packs whose trailing checksum doesn't match their data."""
+    bad = list()
+    for pack in pack_list(repo):
+        h = hashlib.sha1()
+        h.update(pack.view[:-20])
+        if h.digest() != pack.map[-20:]:
+            bad.append(pack.path)
+    return bad
+
+
+def fsck_progress(done, total, final=False):
+    sys.stderr.write(
+        "\rChecking objects: {0:3d}% ({1}/{2}){3}".format(
+            done * 100 // total if total else 100,
+            done,
+            total,
+            ", done.\n" if final else "",
+        )
+    )
+    sys.stderr.flush()
+
+
+def fsck(repo, jobs=None, progress=None):
+    """
+    Verify the object store of repo. Every loose and packed object is
+    inflated and hashed again, in a pool of jobs processes. Then the
+    links between objects, from the refs, HEAD and the index down, are
+    checked. Print corrupt objects and packs as errors, and missing and
+    dangling objects. Return whether the store is intact: dangling
+    objects are not an error.
+    """
+    if jobs is None:
+        jobs = fsck_workers(repo)
+    if progress is None:
+        progress = sys.stderr.isatty()
+
+    ok = True
+    for path in fsck_pack_checksums(repo):
+        print("error: {0}: pack checksum mismatch".format(path))
+        ok = False
+
+    total = sum(len(p.index) for p in pack_list(repo))
+    total += sum(1 for _ in object_list_loose(repo))
+
+    # Binary sha -> type code, for every object found, and for every
+    # object pointed to.
+    present = dict()
+    linked = dict()
+    done = 0
+
+    def collect(results):
+        nonlocal ok, done
+        for binsha, code, links, error in results:
+            done += 1
+            if error:
+                print("error: {0}: {1}".format(binsha.hex(), error))
+                ok = False
+                continue
+            present[binsha] = code
+            for link, link_code in links:
+                linked.setdefault(link, link_code)
+        if progress:
+            fsck_progress(done, total)
+
+    objects = fsck_objects(repo)
+    batches = iter(lambda: list(itertools.islice(objects, FSCK_BATCH)), [])
+
+    # Workers open the repository again: they can't see the objects of
+    # a store that lives in our memory.
+    if jobs > 1 and total > FSCK_BATCH and object_store(repo).shared:
+        with concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=fsck_init, initargs=(repo.worktree,)
+        ) as pool:
+            # Keep a bounded number of batches in flight, collecting
+            # them in order as they complete.
+            pending = collections.deque()
+            for batch in batches:
+                pending.append(pool.submit(fsck_check, batch))
+                if len(pending) >= jobs * FSCK_QUEUE:
+                    collect(pending.popleft().result())
+            for future in pending:
+                collect(future.result())
+    else:
+        for batch in batches:
+            collect(fsck_check(batch, repo))
+
+    if progress:
+        fsck_progress(done, total, final=True)
+
+    # Links to objects we don't have, or that have another type.
+    roots = fsck_roots(repo)
+    for binsha in sorted(roots.union(linked)):
+        code = present.get(binsha)
+        expected = linked.get(binsha)
+        if code is None:
+            print(
+                "missing {0} {1}".format(
+                    PACK_TYPES[expected].decode() if expected else "object",
+                    binsha.hex(),
+                )
+            )
+            ok = False
+        elif expected and code != expected:
+            print(
+                "error: {0}: is a {1}, not a {2}".format(
+                    binsha.hex(),
+                    PACK_TYPES[code].decode(),
+                    PACK_TYPES[expected].decode(),
+                )
+            )
+            ok = False
+
+    # Objects nothing points to.
+    for binsha in sorted(present.keys() - linked.keys() - roots):
+        fmt = PACK_TYPES[present[binsha]].decode()
+        print("dangling {0} {1}".format(fmt, binsha.hex()))
+
+    return ok
+
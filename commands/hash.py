@@ -1,15 +1,102 @@
+import re
 import sys
-from object import object_read, object_find, object_write, GitBlob
+import shutil
+from object import (
+    object_info,
+    object_resolve,
+    object_stream,
+    object_find,
+    object_write,
+    GitBlob,
+)
+from stream import STREAM_CHUNK
 from error import GitException
 
 
 def cat_file(repo, obj, fmt=None):
     """
-    Print out the content of a git object.
+    Print out the content of a git object. The content is copied
+    in chunks, so big blobs never sit in memory as a whole.
     """
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
+    sha = object_find(repo, obj, fmt=fmt)
+    res = object_stream(repo, sha)
+    if not res:
+        raise GitException("No such object {0}.".format(sha))
 
-    sys.stdout.buffer.write(obj.serialize())
+    _, _, stream = res
+    with stream:
+        shutil.copyfileobj(stream, sys.stdout.buffer, STREAM_CHUNK)
+
+
+def cat_file_info(repo, obj, size=False):
+    """
+    Print out the type, or the size, of a git object. Only its header
+    is read.
+    """
+    sha = object_find(repo, obj)
+    info = object_info(repo, sha)
+    if not info:
+        raise GitException("No such object {0}.".format(sha))
+
+    print(info[1] if size else info[0].decode("ascii"))
+
+
+FULL_SHA = re.compile(r"^[0-9a-f]{40}$")
+
+
+def cat_file_batch(repo, contents=True, buffer=False, inp=None, out=None):
+    """
+    Answer object names read from inp, one per line, like git cat-file
+    --batch. Each object is written to out as a "<sha> <type> <size>"
+    header line, then, if contents is set, its data and a newline.
+    Names that resolve to nothing print "<name> missing" instead.
+
+    The repository and its caches stay open for the whole input, so
+    this is the way to inspect many objects. Without contents, only
+    object headers are inflated. Output is flushed after each object,
+    so a caller can talk to us interactively, unless buffer is set.
+    """
+    inp = inp or sys.stdin.buffer
+    out = out or sys.stdout.buffer
+
+    for line in inp:
+        name = line.rstrip(b"\r\n").decode("utf8")
+
+        # Full hashes are by far the common case: don't look them up
+        # as refs and abbreviations.
+        if FULL_SHA.match(name):
+            candidates = [name]
+        else:
+            try:
+                candidates = object_resolve(repo, name)
+            except GitException:
+                candidates = None
+
+        if candidates and len(candidates) > 1:
+            out.write(name.encode("utf8") + b" ambiguous\n")
+        elif not candidates:
+            out.write(name.encode("utf8") + b" missing\n")
+        else:
+            sha = candidates[0]
+            if contents:
+                res = object_stream(repo, sha)
+            else:
+                res = object_info(repo, sha)
+
+            if not res:
+                out.write(name.encode("utf8") + b" missing\n")
+            else:
+                fmt, size = res[0], res[1]
+                out.write(b"%s %s %d\n" % (sha.encode("ascii"), fmt, size))
+                if contents:
+                    with res[2] as stream:
+                        shutil.copyfileobj(stream, out, STREAM_CHUNK)
+                    out.write(b"\n")
+
+        if not buffer:
+            out.flush()
+
+    out.flush()
 
 
 def hash_object(fd, fmt, repo=None):
@@ -0,0 +1,122 @@
+import os
+from index import (
+    GitIndexEntry,
+    index_entry_stat,
+    index_entry_uptodate,
+    index_mode,
+    index_read,
+    index_write,
+)
+from object import object_write, GitBlob
+from odb import object_batch
+from error import GitException
+
+
+def worktree_path(repo, path):
+    """
+    Return path, relative to the current directory, as a worktree
+    path: relative to the worktree, with "/" separators. The worktree
+    itself is "".
+    """
+    rel = os.path.relpath(os.path.abspath(path), repo.worktree)
+    if rel == os.curdir:
+        return ""
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        raise GitException("{0} is outside repository".format(path))
+    return rel.replace(os.sep, "/")
+
+
+def worktree_files(repo, path):
+    """
+    Yield the (path, stat) of every file under the worktree path
+    path, or of path itself if it's a file. .git directories are
+    skipped.
+    """
+    full = os.path.join(repo.worktree, path)
+    st = os.lstat(full)
+    if not os.path.isdir(full) or os.path.islink(full):
+        yield path, st
+        return
+
+    stack = [path]
+    while stack:
+        path = stack.pop()
+        with os.scandir(os.path.join(repo.worktree, path)) as it:
+            for entry in it:
+                if entry.name == ".git":
+                    continue
+                name = path + "/" + entry.name if path else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if not os.path.lexists(os.path.join(entry.path, ".git")):
+                        stack.append(name)
+                else:
+                    yield name, entry.stat(follow_symlinks=False)
+
+
+def blob_hash(repo, path):
+    """Write the blob of worktree file path, and return its sha."""
+    full = os.path.join(repo.worktree, path)
+    if os.path.islink(full):
+        # Symlinks are stored as blobs of their target.
+        data = os.fsencode(os.readlink(full))
+    else:
+        with open(full, "rb") as f:
+            data = f.read()
+
+    return object_write(GitBlob(data), repo)
+
+
+def add(repo, paths):
+    """
+    Add the files at paths, or under them, to the index. Files whose
+    stat data matches their index entry are not read again. Indexed
+    paths that no longer exist are removed from the index.
+    """
+    index = index_read(repo)
+    hashed = 0
+
+    # Blobs are written as one batch.
+    with object_batch(repo):
+        for path in paths:
+            path = worktree_path(repo, path)
+            prefix = path + "/" if path else ""
+
+            present = set()
+            if os.path.lexists(os.path.join(repo.worktree, path)):
+                for name, st in worktree_files(repo, path):
+                    present.add(name)
+
+                    entry = index.entries.get(name)
+                    if entry and index_entry_uptodate(index, entry, st):
+                        continue
+
+                    sha = blob_hash(repo, name)
+                    hashed += 1
+
+                    if entry is None:
+                        entry = GitIndexEntry(name, sha, 0)
+                        index_entry_stat(entry, st)
+                        index.add(entry)
+                        continue
+
+                    # Only a new sha or mode makes the cached trees stale.
+                    if entry.sha != sha or entry.mode != index_mode(st):
+                        index.invalidate(name)
+                    entry.sha = sha
+                    index_entry_stat(entry, st)
+            elif path not in index.entries and not any(
+                name.startswith(prefix) for name in index.entries
+            ):
+                raise GitException("pathspec {0} did not match any files".format(path))
+
+            # Forget what was deleted. Submodules are not ours to check.
+            for name in list(index.entries) + list(index.conflicts):
+                entry = index.entries.get(name)
+                if entry and entry.mode == 0o160000:
+                    continue
+                if (name == path or name.startswith(prefix)) and name not in present:
+                    index.remove(name)
+
+    index_write(repo, index)
+
+    return hashed
@@ -1,9 +1,8 @@
 import os
 import configparser
-import subprocess
 from repo import repo_file, repo_dir, GitRepository
 from error import FileSystemException, GitException
-from util import get_default_branch_name
+from config import config_read
 
 
 def repo_create(path):
@@ -36,7 +35,7 @@ def repo_create(path):
             "Unnamed repository: edit this file 'description' to name the repository.\n"
         )
 
-    default_branch_name = get_default_branch_name()
+    default_branch_name = config_read().get("init", "defaultBranch", fallback="main")
 
     # .git/HEAD
     with open(repo_file(repo, "HEAD"), "w") as f:
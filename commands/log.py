@@ -1,99 +1,259 @@
-from object import object_read
-from datetime import datetime, timedelta
+import re
+import sys
+import heapq
+import itertools
+from object import object_abbrev, object_read
+from commitgraph import commit_date, commit_parents
+from commands.diff import diff_stat, tree_diff
+from datetime import datetime, timedelta, timezone
+from error import GitException
 
+# In date order, --since gives up once this many commits in a row are
+# older than the cutoff, as git does: one commit with a skewed clock
+# doesn't hide the newer history behind it.
+LOG_SLOP = 5
 
-def log_print(repo, sha, seen):
+
+def log_date_order(repo, *shas):
     """
-    Pretty-print a commit's  history
+    Yield the commits reachable from shas, newest first. A priority
+    queue holds the commits seen but not yet shown, so only as much
+    history as the caller consumes is ever read.
     """
-    if sha in seen:
-        return
-    seen.add(sha)
+    # Ties are broken by insertion order, as git does.
+    counter = itertools.count()
+    queue = list()
+    seen = set()
+    for sha in shas:
+        if sha not in seen:
+            seen.add(sha)
+            heapq.heappush(queue, (-commit_date(repo, sha), next(counter), sha))
 
-    commit = object_read(repo, sha)
-    short_hash = sha[0:8]
-    message = commit.kvlm[None].decode("utf8").strip()
-    message = message.replace("\\", "\\\\")
-    message = message.replace('"', '\\"')
+    while queue:
+        _, _, sha = heapq.heappop(queue)
+        yield sha
 
-    author_date = commit.kvlm[b"author"].decode("utf8").strip()
+        for p in commit_parents(repo, sha):
+            if p not in seen:
+                seen.add(p)
+                heapq.heappush(queue, (-commit_date(repo, p), next(counter), p))
 
-    x = author_date.find(">")
-    y = author_date.find("+")
 
-    author = author_date[: x + 1]
-    timestamp = int(author_date[x + 1 : y - 1])
-    offset = author_date[y:]
-    date = date_utc(timestamp, offset)
+def log_topo_order(repo, sha):
+    """
+    Yield the commits reachable from sha so that no commit comes
+    before any of its children, newest first otherwise. This needs the
+    whole graph upfront: with a commit-graph, that's cheap.
+    """
+    # Count the children of every commit.
+    children = {sha: 0}
+    stack = [sha]
+    while stack:
+        for p in commit_parents(repo, stack.pop()):
+            if p not in children:
+                children[p] = 0
+                stack.append(p)
+            children[p] += 1
 
-    if "\n" in message:  # Keep only the first line.
-        message = message[: message.index("\n")]
+    # Then show commits once all their children have been.
+    counter = itertools.count()
+    queue = [(-commit_date(repo, sha), next(counter), sha)]
+    while queue:
+        _, _, sha = heapq.heappop(queue)
+        yield sha
 
-    # Print the commit SHA.
-    print("\x1b[0;33mcommit %s\x1b[0m" % sha)
-    # Print the commit's author.
-    print("Author: %s" % author)
-    # Print the commit's date.
-    print("Date: %s\n" % date)
+        for p in commit_parents(repo, sha):
+            children[p] -= 1
+            if children[p] == 0:
+                heapq.heappush(queue, (-commit_date(repo, p), next(counter), p))
 
-    print('    "%s"\n' % message)
-    assert commit.fmt == b"commit"
 
-    if not b"parent" in commit.kvlm.keys():
-        # Base case: the initial commit.
+def log_walk(
+    repo, sha, max_count=None, since=None, until=None, author=None, topo=False
+):
+    """
+    Yield the commits to show for the history of sha, applying the
+    limits and filters of pit log. since and until are timestamps,
+    author a regular expression matched against the author line.
+    """
+    if max_count == 0:
         return
 
-    parents = commit.kvlm[b"parent"]
+    pattern = re.compile(author) if author else None
+    count = 0
+    slop = LOG_SLOP
 
-    if type(parents) != list:
-        parents = [parents]
+    for sha in log_topo_order(repo, sha) if topo else log_date_order(repo, sha):
+        date = commit_date(repo, sha)
 
-    for p in parents:
-        p = p.decode("ascii")
-        print("commit {0} -> commit {1}\n".format(sha[0:8], p[0:8]))
-        log_print(repo, p, seen)
+        if since is not None and date < since:
+            # In date order, whatever is left is most likely older
+            # still: stop soon instead of walking the rest of the
+            # history.
+            if not topo:
+                slop -= 1
+                if not slop:
+                    return
+            continue
+        slop = LOG_SLOP
+        if until is not None and date > until:
+            continue
+        if pattern:
+            line = object_read(repo, sha).header(b"author")[0]
+            if not pattern.search(line.decode("utf8", "replace")):
+                continue
 
+        yield sha
 
-def log_graphviz(repo, sha, seen):
-    """
-    Return a commit's history in dot format
-    """
-    if sha in seen:
-        return
-    seen.add(sha)
+        count += 1
+        if max_count is not None and count >= max_count:
+            return
 
-    commit = object_read(repo, sha)
-    short_hash = sha[0:8]
+
+def log_message(commit):
+    """Return the first line of a commit message, quote-escaped."""
     message = commit.kvlm[None].decode("utf8").strip()
     message = message.replace("\\", "\\\\")
     message = message.replace('"', '\\"')
 
-    if "\n" in message:  # Keep only the first line
+    if "\n" in message:  # Keep only the first line.
         message = message[: message.index("\n")]
 
-    print('    c_{0} [label="{1}: {2}"]'.format(sha, short_hash, message))
+    return message
+
+
+def log_format(repo, sha):
+    """Format a commit for log_print."""
+    commit = object_read(repo, sha)
     assert commit.fmt == b"commit"
 
-    if not b"parent" in commit.kvlm.keys():
-        # Base case: the initial commit
-        return
+    # The author line ends with "<timestamp> <timezone>".
+    author_date = commit.header(b"author")[0].decode("utf8").strip()
+    author, timestamp, offset = author_date.rsplit(" ", 2)
+    date = date_utc(int(timestamp), offset)
+
+    lines = [
+        # The commit SHA.
+        "\x1b[0;33mcommit %s\x1b[0m\n" % sha,
+        # The commit's author.
+        "Author: %s\n" % author,
+        # The commit's date.
+        "Date: %s\n\n" % date,
+        '    "%s"\n\n' % log_message(commit),
+    ]
+    for p in commit_parents(repo, sha):
+        lines.append(
+            "commit {0} -> commit {1}\n\n".format(
+                object_abbrev(repo, sha), object_abbrev(repo, p)
+            )
+        )
 
-    parents = commit.kvlm[b"parent"]
+    return "".join(lines)
 
-    if type(parents) != list:
-        parents = [parents]
 
-    for p in parents:
-        p = p.decode("ascii")
-        print("    c_{0} -> c_{1};".format(sha, p))
-        log_graphviz(repo, p, seen)
+def log_diff(repo, sha, stat=False, name_only=False):
+    """
+    Format the files a commit changed, for log --stat or --name-only.
+    Like git, merges show nothing.
+    """
+    parents = commit_parents(repo, sha)
+    if len(parents) > 1:
+        return ""
+
+    old = object_read(repo, parents[0]).tree if parents else None
+    changes = list(tree_diff(repo, old, object_read(repo, sha).tree))
+    if not changes:
+        return ""
+
+    if stat:
+        lines = diff_stat(repo, changes)
+    else:
+        lines = [c.path + "\n" for c in changes]
+    return "".join(lines) + "\n"
+
+
+def log_print(repo, sha, out=None, stat=False, name_only=False, **filters):
+    """
+    Pretty-print a commit's history. filters are those of log_walk.
+    With stat or name_only, also show the files each commit changed.
+    Output goes through the binary, buffered stdout (or out).
+    """
+    out = out or sys.stdout.buffer
+    for c in log_walk(repo, sha, **filters):
+        text = log_format(repo, c)
+        if stat or name_only:
+            text += log_diff(repo, c, stat, name_only)
+        out.write(text.encode("utf8"))
+    out.flush()
+
+
+def log_graphviz(repo, sha, out=None, **filters):
+    """
+    Print a commit's history in dot format
+    """
+    out = out or sys.stdout.buffer
+    out.write(b"digraph pitlog{\n    node[shape=rect]\n")
+
+    for c in log_walk(repo, sha, **filters):
+        commit = object_read(repo, c)
+        assert commit.fmt == b"commit"
+
+        lines = [
+            '    c_{0} [label="{1}: {2}"]\n'.format(
+                c, object_abbrev(repo, c), log_message(commit)
+            )
+        ]
+        for p in commit_parents(repo, c):
+            lines.append("    c_{0} -> c_{1};\n".format(c, p))
+        out.write("".join(lines).encode("utf8"))
+
+    out.write(b"}\n")
+    out.flush()
 
 
 def date_utc(timestamp, offset):
     date = datetime.utcfromtimestamp(timestamp)
-    offset_hours = int(offset[:-2])
+    sign = -1 if offset.startswith("-") else 1
+    offset_hours = int(offset[-4:-2])
     offset_minutes = int(offset[-2:])
     offset_delta = timedelta(hours=offset_hours, minutes=offset_minutes)
-    date += offset_delta
+    date += sign * offset_delta
 
     return date
+
+
+DATE_UNITS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+    "month": 30 * 86400,
+    "year": 365 * 86400,
+}
+
+
+def date_parse(value, now=None):
+    """
+    Parse a --since/--until date into a timestamp. Accepts timestamps,
+    ISO 8601 dates, and relative dates like "2 weeks ago" or
+    "2.weeks.ago".
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    m = re.fullmatch(r"(\d+)[ .]+([a-z]+?)s?[ .]+ago", value.lower())
+    if m and m.group(2) in DATE_UNITS:
+        now = now if now is not None else datetime.now(timezone.utc).timestamp()
+        return int(now) - int(m.group(1)) * DATE_UNITS[m.group(2)]
+
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        raise GitException("Invalid date {0}".format(value))
+    if date.tzinfo is None:
+        # Like git, read dates without a timezone as local time.
+        date = date.astimezone()
+
+    return int(date.timestamp())
@@ -1,3 +1,9 @@
+import os
+from object import object_abbrev, object_find, object_info, object_read
+from ref import ref_snapshot, ref_peeled, packed_refs_write
+from repo import repo_path
+
+
 def show_refs(repo, refs, with_hash=True, prefix=""):
     for k, v in refs.items():
         if type(v) == str:
@@ -13,3 +19,74 @@ def show_refs(repo, refs, with_hash=True, prefix=""):
                 with_hash=with_hash,
                 prefix="{0}{1}{2}".format(prefix, "/" if prefix else "", k),
             )
+
+
+def rev_parse(repo, names, short=False):
+    """Print the object each of names resolves to."""
+    for name in names:
+        sha = object_find(repo, name)
+        print(object_abbrev(repo, sha) if short else sha)
+
+
+def tag_peel(repo, sha):
+    """
+    Follow sha down to the first object that is not a tag. Return
+    that object, or None if sha is not a tag.
+    """
+    peeled = sha
+    while True:
+        info = object_info(repo, peeled)
+        if not info or info[0] != b"tag":
+            break
+        peeled = object_read(repo, peeled).object
+
+    return peeled if peeled != sha else None
+
+
+def pack_refs(repo, everything=False, prune=True):
+    """
+    Write tags (every ref, with everything), and whatever already was
+    packed, to packed-refs along with their peeled values. Then, if
+    prune, delete the loose files of what was packed.
+    """
+    snapshot = ref_snapshot(repo)
+    refs = dict()
+    peeled = dict()
+
+    for name, value in snapshot.refs.items():
+        # Symbolic refs can't be packed.
+        if value.startswith("ref: "):
+            continue
+        if not (
+            everything or name.startswith("refs/tags/") or name in snapshot.packed
+        ):
+            continue
+
+        refs[name] = value
+        p = ref_peeled(repo, name) or tag_peel(repo, value)
+        if p:
+            peeled[name] = p
+
+    packed_refs_write(repo, refs, peeled)
+
+    if prune:
+        refs_dir = repo_path(repo, "refs")
+        for name, value in refs.items():
+            path = repo_path(repo, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "r") as fp:
+                # Don't lose a ref that moved since we read it.
+                if fp.read().strip() != value:
+                    continue
+            os.remove(path)
+
+            # Clean up the directories this leaves empty, but keep
+            # the top ones, like refs/heads.
+            parent = os.path.dirname(path)
+            while os.path.dirname(parent) != refs_dir and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+
+    # Next lookups will read the new state.
+    repo.refs = None
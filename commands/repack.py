@@ -0,0 +1,179 @@
+import os
+import collections
+from bitmap import bitmap_write
+from object import object_info, object_list_loose, object_read, object_read_raw
+from odb import object_store
+from pack import GitPackWriter, delta_create, delta_index, pack_list
+from ref import ref_resolve, ref_snapshot
+
+# Objects bigger than this are stored whole: our delta search is
+# pure Python, and big blobs rarely delta well anyway.
+DELTA_MAX_SIZE = 1024 * 1024
+
+# Objects of a same type are written together, in this order.
+TYPE_ORDER = {b"commit": 0, b"tag": 1, b"tree": 2, b"blob": 3}
+
+RepackEntry = collections.namedtuple("RepackEntry", "sha fmt data index depth")
+
+
+def name_hash(path):
+    """
+    Git's pack name hash: mostly made of the last characters of the
+    path, so that files with the same name (or extension) sort
+    together.
+    """
+    h = 0
+    for c in path:
+        if not c.isspace():
+            h = ((h >> 2) + (ord(c) << 24)) & 0xFFFFFFFF
+
+    return h
+
+
+def repack_paths(repo):
+    """
+    Walk every object reachable from the refs, and return the path
+    each tree and blob was first seen at. Blobs are never read.
+    """
+    paths = dict()
+    roots = [ref_resolve(repo, name) for name in ref_snapshot(repo).refs]
+    roots.append(ref_resolve(repo, "HEAD"))
+    roots = [sha for sha in roots if sha]
+
+    stack = [(sha, "") for sha in roots]
+    seen = set()
+    while stack:
+        sha, path = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+        paths[sha] = path
+
+        obj = object_read(repo, sha)
+        if not obj:
+            continue
+
+        match obj.fmt:
+            case b"commit":
+                stack.append((obj.tree, ""))
+                stack.extend((p, "") for p in obj.parents)
+            case b"tag":
+                stack.append((obj.object, ""))
+            case b"tree":
+                entries = obj.entries
+                for i in range(len(entries)):
+                    sub = os.path.join(path, entries.path(i))
+                    if entries.is_tree(i):
+                        stack.append((entries.sha(i), sub))
+                    elif not entries.mode(i).startswith(b"16"):
+                        # Blobs and symlinks. Submodules (160000)
+                        # point to commits in another repository.
+                        item = entries.sha(i)
+                        if item not in paths:
+                            paths[item] = sub
+
+    return paths
+
+
+def repack(repo, everything=False, window=10, depth=50, bitmaps=None):
+    """
+    Pack the loose objects of repo (and, if everything is set, the
+    objects of every existing pack) into a single new pack, then
+    delete what was packed. With bitmaps, or repack.writeBitmaps, a
+    pack of everything also gets reachability bitmaps.
+
+    Delta bases are picked the way git does: objects are sorted by
+    type, then by a hash of their path, then by decreasing size, and
+    each one is tried against the window objects before it.
+    """
+    shas = list(object_list_loose(repo))
+    old_packs = list(pack_list(repo)) if everything else []
+    for pack in old_packs:
+        shas.extend(pack.index)
+    shas = list(dict.fromkeys(shas))
+
+    if not shas:
+        print("Nothing to pack.")
+        return None
+
+    paths = repack_paths(repo)
+
+    # Sorting only needs types and sizes: don't inflate anything yet.
+    order = list()
+    types = dict()
+    for sha in shas:
+        fmt, size = object_info(repo, sha)
+        types[sha] = fmt
+        order.append((TYPE_ORDER[fmt], name_hash(paths.get(sha, "")), -size, sha))
+    order.sort()
+
+    writer = GitPackWriter(repo, len(order))
+    win = collections.deque(maxlen=window)
+    deltas = 0
+
+    try:
+        for _, _, _, sha in order:
+            fmt, data = object_read_raw(repo, sha)
+            size = len(data)
+
+            best = None
+            best_depth = 0
+            # Keep a delta only if it saves at least half the object.
+            limit = size // 2 - 20
+            if size <= DELTA_MAX_SIZE and limit > 0:
+                # Try the closest candidates first.
+                for cand in reversed(win):
+                    if cand.fmt != fmt or cand.depth >= depth:
+                        continue
+                    if size < len(cand.data) // 32:
+                        continue
+                    delta = delta_create(cand.data, data, cand.index, limit)
+                    if delta is not None:
+                        best = (cand.sha, delta)
+                        best_depth = cand.depth + 1
+                        limit = len(delta) - 1
+
+            if best:
+                writer.add(sha, fmt, best[1], base=best[0])
+                deltas += 1
+            else:
+                writer.add(sha, fmt, data)
+
+            if size <= DELTA_MAX_SIZE:
+                index = delta_index(data)
+                win.append(RepackEntry(sha, fmt, data, index, best_depth))
+    except BaseException:
+        writer.abort()
+        raise
+
+    path = writer.close()
+
+    if bitmaps is None:
+        bitmaps = repo.conf.getboolean("repack", "writeBitmaps", fallback=False)
+    if bitmaps and everything:
+        tips = [ref_resolve(repo, name) for name in ref_snapshot(repo).refs]
+        tips.append(ref_resolve(repo, "HEAD"))
+        count = bitmap_write(repo, path, types, [sha for sha in tips if sha])
+        if count is None:
+            print("Not writing bitmaps: the pack is missing reachable objects")
+
+    # Everything is safely packed: prune the unpacked copies and the
+    # packs we just merged.
+    object_store(repo).remove(shas)
+    for pack in old_packs:
+        if pack.path != path:
+            os.remove(pack.path)
+            os.remove(pack.index.path)
+            # And what was written for it.
+            for ext in (".bitmap", ".rev"):
+                extra = pack.path[: -len(".pack")] + ext
+                if os.path.exists(extra):
+                    os.remove(extra)
+    repo.oid_index = None
+
+    print(
+        "Packed {0} objects ({1} deltas) into {2}".format(
+            len(shas), deltas, os.path.basename(path)
+        )
+    )
+    return path
@@ -0,0 +1,184 @@
+import sys
+from bitmap import bitmap_find, bitmap_walk
+from commands.log import log_date_order
+from commitgraph import commit_parents
+from error import GitException
+from object import object_find, object_info, object_read
+
+
+def rev_list_peel(repo, names):
+    """
+    Resolve names without peeling them first. Return the commits they
+    lead to, and the other objects on the way, as (sha, type, name)
+    tuples in the order git lists them: each tag, named after itself,
+    then the tree or blob a tag chain ends at.
+    """
+    commits = list()
+    pending = list()
+    for name in names:
+        sha = object_find(repo, name)
+        while True:
+            info = object_info(repo, sha)
+            if not info:
+                raise GitException("No such object {0}.".format(sha))
+            if info[0] != b"tag":
+                break
+            tag = object_read(repo, sha)
+            tag_name = tag.header(b"tag")
+            pending.append((sha, b"tag", tag_name[0].decode() if tag_name else ""))
+            sha = tag.object
+
+        if info[0] == b"commit":
+            commits.append(sha)
+        else:
+            pending.append((sha, info[0], ""))
+
+    return commits, pending
+
+
+def rev_list_walk(repo, commits, objects=False, pending=(), out=None):
+    """
+    Write commits, then, if objects is set, the pending objects of
+    rev_list_peel and the trees and blobs of commits, each with its
+    path, the way git rev-list --objects does: each tree right before
+    what it holds, in tree order. Return how many objects were written.
+    """
+    out = out or sys.stdout
+    count = 0
+    for sha in commits:
+        out.write(sha + "\n")
+        count += 1
+    if not objects:
+        return count
+
+    roots = list(pending)
+    roots.extend((object_read(repo, sha).tree, b"tree", "") for sha in commits)
+
+    seen = set()
+    for root in roots:
+        stack = [root]
+        while stack:
+            sha, fmt, path = stack.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+            out.write("{0} {1}\n".format(sha, path))
+            count += 1
+            if fmt != b"tree":
+                continue
+
+            entries = object_read(repo, sha).entries
+            # Pushed backwards, to come out in order.
+            for i in reversed(range(len(entries))):
+                if entries.mode(i).startswith(b"16"):
+                    # Submodules point to another repository.
+                    continue
+                sub = path + "/" + entries.path(i) if path else entries.path(i)
+                fmt = b"tree" if entries.is_tree(i) else b"blob"
+                stack.append((entries.sha(i), fmt, sub))
+
+    return count
+
+
+def rev_list_tags(bitmap, bits, extra, pending):
+    """
+    Add the tags of pending to bits, or to extra for those that are not
+    in the pack of bitmap. Return the new bits.
+    """
+    for sha, fmt, _ in pending:
+        pos = bitmap.position(sha)
+        if pos is None:
+            extra[sha] = fmt
+        else:
+            bits |= 1 << pos
+    return bits
+
+
+def rev_list_bitmap(repo, bitmap, tips, objects=False, pending=(), out=None):
+    """
+    Like rev_list_walk, through the reachability bitmaps: only the
+    history down to the nearest bitmaps is read. Objects come in pack
+    order, without paths. pending may only hold tags. Return how many
+    objects were written.
+    """
+    out = out or sys.stdout
+    bits, extra = bitmap_walk(repo, bitmap, tips, objects)
+    if objects:
+        bits = rev_list_tags(bitmap, bits, extra, pending)
+    else:
+        bits &= bitmap.commits
+        extra = {sha: fmt for sha, fmt in extra.items() if fmt == b"commit"}
+
+    # Commits first, then the rest.
+    count = 0
+    for mask in (bitmap.commits, bits & ~bitmap.commits):
+        data = (bits & mask).to_bytes(bitmap.size // 8 + 1, "little")
+        for i, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                out.write(bitmap.sha(8 * i + low.bit_length() - 1) + "\n")
+                count += 1
+                byte ^= low
+    for sha in sorted(extra, key=lambda sha: extra[sha] != b"commit"):
+        out.write(sha + "\n")
+        count += 1
+    return count
+
+
+def rev_list_count(repo, tips, objects=False, bitmap=None, pending=()):
+    """
+    Count the commits reachable from tips, or every object if objects is
+    set, pending ones included. bitmap makes it a matter of or-ing a few
+    bitmaps; pending may then only hold tags.
+    """
+    if bitmap:
+        bits, extra = bitmap_walk(repo, bitmap, tips, objects)
+        if objects:
+            bits = rev_list_tags(bitmap, bits, extra, pending)
+        else:
+            bits &= bitmap.commits
+            extra = [sha for sha, fmt in extra.items() if fmt == b"commit"]
+        return bits.bit_count() + len(extra)
+
+    if objects:
+        commits = list(log_date_order(repo, *tips))
+        return rev_list_walk(repo, commits, True, pending, RevListCounter())
+
+    # Commits only: no need for date order.
+    seen = set(tips)
+    stack = list(tips)
+    while stack:
+        for p in commit_parents(repo, stack.pop()):
+            if p not in seen:
+                seen.add(p)
+                stack.append(p)
+    return len(seen)
+
+
+class RevListCounter(object):
+    """An output that throws lines away: rev_list_walk only counts them."""
+
+    def write(self, line):
+        pass
+
+
+def rev_list(repo, names, count=False, objects=False, use_bitmap=None):
+    """
+    List, or count, the commits reachable from names, and with objects
+    the tags on the way and the trees and blobs too. Reachability
+    bitmaps are used for --count and --objects when the repository has
+    some, unless use_bitmap is False.
+    """
+    tips, pending = rev_list_peel(repo, names)
+    bitmap = bitmap_find(repo) if use_bitmap is not False else None
+    if any(fmt != b"tag" for _, fmt, _ in pending):
+        # Trees and blobs named directly aren't in any bitmap: walk.
+        bitmap = None
+
+    if count:
+        print(rev_list_count(repo, tips, objects, bitmap, pending))
+    elif objects and bitmap:
+        rev_list_bitmap(repo, bitmap, tips, True, pending)
+    else:
+        commits = list(log_date_order(repo, *tips))
+        rev_list_walk(repo, commits, objects, pending)
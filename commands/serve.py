@@ -0,0 +1,235 @@
+import io
+import os
+import sys
+import json
+import signal
+import socket
+import struct
+import asyncio
+import traceback
+import concurrent.futures
+from config import config_read
+from error import GitException
+from cache import ObjectCache
+from repo import repo_cache_limits, repo_file, repo_path
+from stream import STREAM_CHUNK
+from rpc import (
+    FRAME_ARGS,
+    FRAME_EXIT,
+    FRAME_HEADER,
+    FRAME_STDERR,
+    FRAME_STDOUT,
+    SERVE_SOCKET,
+    frame,
+    rpc_forwardable,
+)
+
+
+def serve_state(repo):
+    """
+    The modification times of what the repository caches are built
+    from: refs, packs, the commit-graph and the config. Writers
+    replace files and directories, so a changed state means the
+    caches may be stale.
+    """
+    state = list()
+    for path in (
+        repo_path(repo, "packed-refs"),
+        repo_path(repo, "config"),
+        repo_path(repo, "objects", "pack"),
+        repo_path(repo, "objects", "info", "commit-graph"),
+    ):
+        try:
+            state.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            state.append(None)
+
+    # Loose refs may be rewritten in place: look at each of them.
+    for root, dirs, files in os.walk(repo_path(repo, "refs")):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                state.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                pass
+
+    return state
+
+
+def serve_refresh(repo, state):
+    """
+    Drop the caches of repo built from files that changed since state
+    was taken, and return the new state. Objects never change, so the
+    object cache stays, unless its limits changed.
+    """
+    current = serve_state(repo)
+    if current != state:
+        repo.refs = None
+        repo.packs = None
+        repo.commit_graph = None
+        repo.conf = config_read(repo_file(repo, "config"))
+
+        # The config picks the object store and its settings: open it
+        # again.
+        if repo.odb is not None:
+            repo.odb.close()
+            repo.odb = None
+
+        limits = repo_cache_limits(repo.conf)
+        if limits != (repo.cache.objects.limit, repo.cache.blobs.limit):
+            repo.cache = ObjectCache(*limits)
+
+    # New loose objects don't show up in the state, and the abbreviation
+    # index is rebuilt lazily, one fanout directory at a time.
+    repo.oid_index = None
+
+    return current
+
+
+class FrameWriter(io.RawIOBase):
+    """
+    A binary stream that sends whatever is written to it as frames of
+    kind, through send. Once send fails, the client is gone: the first
+    write after that raises BrokenPipeError, and the others are dropped.
+    """
+
+    def __init__(self, kind, send):
+        self.kind = kind
+        self.send = send
+        self.broken = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.broken:
+            return len(b)
+        try:
+            self.send(frame(self.kind, bytes(b)))
+        except Exception:
+            # The connection, or the server, is closing: the output
+            # can't go anywhere.
+            self.broken = True
+            raise BrokenPipeError("The client went away")
+        return len(b)
+
+
+def serve_run(repo, argv, send):
+    """
+    Run the pit command line argv against repo. What it writes to
+    stdout and stderr goes to send, a blocking function, as frames of
+    up to STREAM_CHUNK bytes while the command runs. Return its exit
+    status.
+    """
+    import libpit
+
+    saved = sys.stdout, sys.stderr
+    # Commands print text and write bytes to sys.stdout.buffer: write
+    # through so that both end up in order.
+    streams = list()
+    for kind in (FRAME_STDOUT, FRAME_STDERR):
+        buffer = io.BufferedWriter(FrameWriter(kind, send), STREAM_CHUNK)
+        streams.append(io.TextIOWrapper(buffer, encoding="utf8", write_through=True))
+    sys.stdout, sys.stderr = streams
+
+    status = 0
+    try:
+        args = libpit.argparser.parse_args(argv)
+        if not rpc_forwardable(args):
+            raise GitException("pit serve doesn't run {0}".format(args.command))
+        libpit.run(args, repo)
+    except SystemExit as e:
+        # argparse errors, and commands that exit.
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        sys.stderr.write("".join(traceback.format_exception_only(e)))
+        status = 1
+    finally:
+        for stream in streams:
+            try:
+                stream.flush()
+            except BrokenPipeError:
+                pass
+        sys.stdout, sys.stderr = saved
+
+    return status
+
+
+def serve(repo, path=None):
+    """
+    Answer pit commands sent to the Unix socket at path, .git/pit.sock
+    by default, until interrupted. The repository stays open, with its
+    caches warm, for the life of the server.
+    """
+    path = path or repo_path(repo, SERVE_SOCKET)
+
+    if os.path.exists(path):
+        # Don't steal the socket of a live server. A dead one leaves
+        # its socket file behind: reuse it.
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.remove(path)
+        else:
+            raise GitException("A server is already listening on {0}".format(path))
+        finally:
+            probe.close()
+
+    state = serve_state(repo)
+    # Commands run one at a time, in this thread: they share the
+    # repository and the process' stdout. The event loop stays free to
+    # send their output as it comes, and to accept new clients.
+    worker = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def handle(reader, writer):
+        loop = asyncio.get_running_loop()
+
+        async def send(data):
+            writer.write(data)
+            # Don't let a slow client pile output up in memory.
+            await writer.drain()
+
+        def send_blocking(data):
+            asyncio.run_coroutine_threadsafe(send(data), loop).result()
+
+        def run(argv):
+            nonlocal state
+            state = serve_refresh(repo, state)
+            return serve_run(repo, argv, send_blocking)
+
+        try:
+            header = await reader.readexactly(FRAME_HEADER.size)
+            kind, size = FRAME_HEADER.unpack(header)
+            payload = await reader.readexactly(size)
+            if kind != FRAME_ARGS:
+                return
+            argv = json.loads(payload)["argv"]
+
+            status = await loop.run_in_executor(worker, run, argv)
+            writer.write(frame(FRAME_EXIT, struct.pack(">i", status)))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client went away.
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_unix_server(handle, path)
+        stop = asyncio.get_running_loop().create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.cancel)
+        async with server:
+            try:
+                await stop
+            except asyncio.CancelledError:
+                pass
+
+    print("Serving {0} on {1}".format(repo.worktree, path), file=sys.stderr)
+    try:
+        asyncio.run(main())
+    finally:
+        worker.shutdown(cancel_futures=True)
+        if os.path.exists(path):
+            os.remove(path)
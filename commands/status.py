@@ -0,0 +1,246 @@
+import os
+import bisect
+import hashlib
+import concurrent.futures
+from commands.index import worktree_files
+from index import (
+    index_entry_stat,
+    index_entry_uptodate,
+    index_mode,
+    index_read,
+    index_write,
+)
+from object import object_abbrev, object_read
+from ref import ref_resolve
+from repo import repo_path
+from stream import STREAM_CHUNK
+
+# Below this many files to hash, starting worker processes costs more
+# than it saves.
+STATUS_POOL_MIN = 64
+
+
+def file_sha(path):
+    """
+    Return the sha the blob of the file at path would have, without
+    writing it. This runs in the worker processes of status.
+    """
+    if os.path.islink(path):
+        data = os.fsencode(os.readlink(path))
+        return hashlib.sha1(b"blob %d\x00" % len(data) + data).hexdigest()
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h = hashlib.sha1(b"blob %d\x00" % size)
+        while chunk := f.read(STREAM_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def status_workers(repo):
+    """
+    Default number of hashing processes: status.workers from the
+    configuration, where anything below 1 means one per core.
+    """
+    workers = repo.conf.getint("status", "workers", fallback=0)
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def status_head(repo, index):
+    """
+    Compare the tree of HEAD with the index. Return a dict mapping
+    the paths that differ to "A", "M" or "D".
+
+    Where git's cached tree of a directory has the sha of the
+    directory in HEAD, nothing under it changed: that subtree is
+    skipped without being read.
+    """
+    names = sorted(index.entries)
+    cached = index.trees
+    changes = dict()
+    seen = set()  # The index paths found in HEAD.
+    skipped = list()  # The ranges of names under skipped subtrees.
+
+    head = ref_resolve(repo, "HEAD")
+    stack = [(object_read(repo, head).tree, "")] if head else []
+    while stack:
+        sha, path = stack.pop()
+        if cached.get(path) == sha:
+            if path:
+                lo = bisect.bisect_left(names, path + "/")
+                # "0" is the character after "/".
+                hi = bisect.bisect_left(names, path + "0", lo)
+                skipped.append((lo, hi))
+            else:
+                skipped.append((0, len(names)))
+            continue
+
+        entries = object_read(repo, sha).entries
+        for i in range(len(entries)):
+            name = entries.path(i)
+            sub = path + "/" + name if path else name
+            if entries.is_tree(i):
+                stack.append((entries.sha(i), sub))
+                continue
+
+            entry = index.entries.get(sub)
+            if entry is None:
+                if sub not in index.conflicts:
+                    changes[sub] = "D"
+                continue
+
+            seen.add(sub)
+            if entry.sha != entries.sha(i) or entry.mode != int(entries.mode(i), 8):
+                changes[sub] = "M"
+
+    covered = bytearray(len(names))
+    for lo, hi in skipped:
+        covered[lo:hi] = b"\x01" * (hi - lo)
+    for i, name in enumerate(names):
+        if not covered[i] and name not in seen:
+            changes[name] = "A"
+
+    return changes
+
+
+def status_worktree(repo, index, jobs=None):
+    """
+    Compare the index with the worktree. Return a dict mapping the
+    paths that differ to "M" or "D", and the sorted list of untracked
+    paths, untracked directories collapsed as "dir/".
+
+    Only files whose stat data doesn't match their entry are hashed,
+    by a pool of jobs processes when there are enough of them. The
+    entries of those found unchanged get their new stat data, and
+    refresh is set to tell the index is worth writing.
+    """
+    changes = dict()
+    untracked = set()
+    stats = dict()
+
+    # The directories holding tracked files, for collapsing.
+    tracked = {""}
+    for name in list(index.entries) + list(index.conflicts):
+        while "/" in name:
+            name = name.rsplit("/", 1)[0]
+            if name in tracked:
+                break
+            tracked.add(name)
+
+    for name, st in worktree_files(repo, ""):
+        if name in index.entries or name in index.conflicts:
+            stats[name] = st
+            continue
+
+        # Report the topmost directory without tracked files in it.
+        parts = name.split("/")
+        for i in range(1, len(parts)):
+            if "/".join(parts[:i]) not in tracked:
+                name = "/".join(parts[:i]) + "/"
+                break
+        untracked.add(name)
+
+    check = list()
+    for name, entry in index.entries.items():
+        st = stats.get(name)
+        if st is None:
+            if entry.mode != 0o160000:
+                changes[name] = "D"
+        elif entry.mode != index_mode(st):
+            changes[name] = "M"
+        elif not index_entry_uptodate(index, entry, st):
+            check.append(name)
+
+    paths = [os.path.join(repo.worktree, name) for name in check]
+    if jobs is None:
+        jobs = status_workers(repo)
+    if jobs > 1 and len(paths) >= STATUS_POOL_MIN:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+            chunk = max(1, len(paths) // (jobs * 4))
+            shas = list(pool.map(file_sha, paths, chunksize=chunk))
+    else:
+        shas = [file_sha(p) for p in paths]
+
+    refresh = False
+    for name, sha in zip(check, shas):
+        entry = index.entries[name]
+        if sha != entry.sha:
+            changes[name] = "M"
+        else:
+            # Unchanged after all: remember so, to not hash it again.
+            index_entry_stat(entry, stats[name])
+            refresh = True
+
+    return changes, sorted(untracked), refresh
+
+
+def status_branch(repo):
+    """The first line of pit status."""
+    with open(repo_path(repo, "HEAD"), "r") as f:
+        head = f.read().strip()
+
+    if head.startswith("ref: refs/heads/"):
+        return "On branch {0}".format(head[16:])
+    return "HEAD detached at {0}".format(object_abbrev(repo, head))
+
+
+STATUS_WORDS = {
+    "A": "new file",
+    "M": "modified",
+    "D": "deleted",
+    "U": "both modified",
+}
+
+
+def status(repo, short=False, jobs=None):
+    """
+    Show the differences between HEAD, the index and the worktree.
+    """
+    index = index_read(repo)
+    staged = status_head(repo, index)
+    unstaged, untracked, refresh = status_worktree(repo, index, jobs)
+    unmerged = sorted(index.conflicts)
+
+    if refresh:
+        # Like git, save the stat data we just checked, so the next
+        # status doesn't hash the same files again.
+        try:
+            index_write(repo, index)
+        except OSError:
+            pass
+
+    lines = list()
+    if short:
+        for name in sorted(set(staged) | set(unstaged) | set(unmerged)):
+            if name in index.conflicts:
+                code = "UU"
+            else:
+                code = staged.get(name, " ") + unstaged.get(name, " ")
+            lines.append("{0} {1}\n".format(code, name))
+        lines.extend("?? {0}\n".format(name) for name in untracked)
+        print("".join(lines), end="")
+        return
+
+    lines.append(status_branch(repo) + "\n")
+    sections = [
+        ("Changes to be committed:", staged),
+        ("Unmerged paths:", {n: "U" for n in unmerged}),
+        ("Changes not staged for commit:", unstaged),
+    ]
+    for title, changes in sections:
+        if changes:
+            lines.append("{0}\n".format(title))
+            for name, code in sorted(changes.items()):
+                word = STATUS_WORDS[code] + ":"
+                lines.append("\t{0:<12}{1}\n".format(word, name))
+            lines.append("\n")
+    if untracked:
+        lines.append("Untracked files:\n")
+        lines.extend("\t{0}\n".format(name) for name in untracked)
+        lines.append("\n")
+
+    if not (staged or unstaged or unmerged or untracked):
+        lines.append("nothing to commit, working tree clean\n")
+    print("".join(lines), end="")
@@ -1,6 +1,6 @@
 import collections
 from object import object_find, object_write, GitTag
-from util import get_user_name_email
+from commands.commit import date_now, user_identity
 from ref import ref_create
 
 
@@ -16,12 +16,13 @@ def tag_create(repo, name, ref, message=None, create_tag_object=False):
         tag.kvlm[b"type"] = b"commit"
         tag.kvlm[b"tag"] = name.encode()
 
-        user_info = get_user_name_email()
-        tag.kvlm[b"tagger"] = user_info.encode()
+        tagger = "{0} {1}".format(user_identity(repo, "committer"), date_now())
+        tag.kvlm[b"tagger"] = tagger.encode("utf8")
 
-        tag.kvlm[None] = message.encode() if message != None else b""
+        # Like git, end the message with a newline.
+        tag.kvlm[None] = (message.rstrip("\n") + "\n").encode() if message else b""
 
-        tag_sha = object_write(tag)
+        tag_sha = object_write(tag, repo)
 
         # Create reference
         ref_create(repo, "tags/" + name, tag_sha)
@@ -1,20 +1,23 @@
 import os
-from object import object_find, object_read
+import shutil
+import concurrent.futures
+from object import object_find, object_info, object_read, object_stream
+from pack import pack_list
+from stream import STREAM_CHUNK
 from error import GitException
 
 
-def ls_tree(repo, ref, recursive=None, prefix=""):
+def ls_tree(repo, ref, recursive=None, prefix="", long=False):
     """
-    Pretty-print a tree object
+    Pretty-print a tree object. With long, also print the size of
+    blobs, which only costs reading their headers.
     """
     sha = object_find(repo, ref, fmt=b"tree")
-    obj = object_read(repo, sha)
+    entries = object_read(repo, sha).entries
 
-    for item in obj.items:
-        if len(item.mode) == 5:
-            type = item.mode[0:1]
-        else:
-            type = item.mode[0:2]
+    for i in range(len(entries)):
+        mode = entries.mode(i)
+        type = mode[0:2]
 
         match type:  # Determine the type.
             case b"04":
@@ -26,34 +29,131 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
             case b"16":
                 type = "commit"  # A submodule.
             case _:
-                raise GitException("Weird tree leaf mode {}".format(item.mode))
+                raise GitException("Weird tree leaf mode {}".format(mode))
 
         if not (recursive and type == "tree"):  # This is a leaf.
+            if long:
+                size = "-"
+                if type == "blob":
+                    info = object_info(repo, entries.sha(i))
+                    size = str(info[1]) if info else "-"
+                size = " {0:>7}".format(size)
+            else:
+                size = ""
+
             print(
-                "{0} {1} \x1b[0;33m{2}\x1b[0m\t{3}".format(
-                    "0" * (6 - len(item.mode)) + item.mode.decode("ascii"),
+                "{0} {1} \x1b[0;33m{2}\x1b[0m{3}\t{4}".format(
+                    mode.decode("ascii"),
                     # Git's ls-tree displays the type of the object pointed to.
                     type,
-                    item.sha,
-                    os.path.join(prefix, item.path),
+                    entries.sha(i),
+                    size,
+                    os.path.join(prefix, entries.path(i)),
                 )
             )
         else:  # This is a branch, recurse.
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+            ls_tree(
+                repo,
+                entries.sha(i),
+                recursive,
+                os.path.join(prefix, entries.path(i)),
+                long,
+            )
+
+
+def tree_checkout_plan(repo, tree, path):
+    """
+    List what checking out tree in path takes: the directories to
+    create, parents first, and the (mode, sha, destination) of every
+    file to write. Only trees are read.
+    """
+    dirs = list()
+    files = list()
+
+    stack = [(tree, path)]
+    while stack:
+        tree, path = stack.pop()
+        entries = tree.entries
+        for i in range(len(entries)):
+            mode = entries.mode(i)
+            dest = os.path.join(path, entries.path(i))
+
+            if mode.startswith(b"04"):
+                dirs.append(dest)
+                stack.append((object_read(repo, entries.sha(i)), dest))
+            elif mode.startswith(b"16"):
+                # A submodule: its commit lives in another repository.
+                dirs.append(dest)
+            else:
+                files.append((mode, entries.sha(i), dest))
+
+    return dirs, files
+
+
+def checkout_file(repo, mode, sha, dest):
+    """Write blob sha at dest, as a file or symlink depending on mode."""
+    res = object_stream(repo, sha)
+    if not res:
+        raise GitException("Missing blob {0}.".format(sha))
 
+    _, _, stream = res
+    with stream:
+        if mode.startswith(b"12"):
+            # A symlink: the blob holds the link target.
+            os.symlink(stream.read(), dest)
+            return
 
-def tree_checkout(repo, tree, path):
+        # Let the umask decide the final permissions, as git does.
+        perms = 0o777 if mode == b"100755" else 0o666
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, perms)
+
+        # Copy in chunks, so that memory use doesn't depend on the
+        # size of the file.
+        with open(fd, "wb") as f:
+            shutil.copyfileobj(stream, f, STREAM_CHUNK)
+
+
+def checkout_workers(repo):
     """
-    Checkout a commit in an empty directory
+    Default number of checkout workers: checkout.workers from the
+    configuration, where anything below 1 means one per core.
+    """
+    workers = repo.conf.getint("checkout", "workers", fallback=0)
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def tree_checkout(repo, tree, path, jobs=None):
     """
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
-        dest = os.path.join(path, item.path)
+    Checkout a commit in an empty directory.
+
+    The whole tree is listed first and its directories created in one
+    pass. Files are then inflated and written by a pool of jobs
+    threads: zlib and file writes release the GIL, so this scales
+    with the number of cores.
+    """
+    dirs, files = tree_checkout_plan(repo, tree, path)
+
+    for d in dirs:
+        os.mkdir(d)
+
+    if not jobs:
+        jobs = checkout_workers(repo)
+
+    if jobs == 1:
+        for mode, sha, dest in files:
+            checkout_file(repo, mode, sha, dest)
+        return
 
-        if obj.fmt == b"tree":
-            os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b"blob":
-            # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, "wb") as f:
-                f.write(obj.blobdata)
+    # Open the packs before the threads look for objects in them: the
+    # plan may have only read loose objects.
+    pack_list(repo)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = [
+            pool.submit(checkout_file, repo, mode, sha, dest)
+            for mode, sha, dest in files
+        ]
+        # Raise the first error, if any.
+        for future in futures:
+            future.result()
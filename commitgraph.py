@@ -0,0 +1,289 @@
+import os
+import mmap
+import struct
+import hashlib
+from object import object_read
+from ref import ref_resolve, ref_snapshot
+from repo import repo_dir, repo_path
+from error import GitException
+
+GRAPH_MAGIC = b"CGPH"
+
+CHUNK_OID_FANOUT = b"OIDF"
+CHUNK_OID_LOOKUP = b"OIDL"
+CHUNK_COMMIT_DATA = b"CDAT"
+CHUNK_EXTRA_EDGES = b"EDGE"
+
+# Parent positions in CDAT. A second parent with the high bit set
+# is an index in EDGE, where the parents of octopus merges go.
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EDGE_LAST = 0x80000000
+
+GENERATION_MAX = 0x3FFFFFFF
+
+# Tree sha, two parent positions, then generation and date.
+CDAT_WIDTH = 20 + 4 + 4 + 8
+
+
+class GitCommitGraph(object):
+    """
+    A commit-graph file, in git's format: for every commit, its tree,
+    parents, date and generation number, in memory-mapped fixed-width
+    records. Walking history through it never touches the object
+    store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[0:4] != GRAPH_MAGIC:
+            raise GitException("Not a commit-graph {0}".format(path))
+        vers, hash_vers, nchunks = self.map[4], self.map[5], self.map[6]
+        if vers != 1 or hash_vers != 1:
+            raise GitException(
+                "Unsupported commit-graph version in {0}".format(path)
+            )
+
+        # The chunk table: an id and an offset per chunk, and a
+        # terminating entry.
+        self.chunks = dict()
+        for i in range(nchunks):
+            pos = 8 + 12 * i
+            cid = self.map[pos : pos + 4]
+            self.chunks[cid] = struct.unpack_from(">Q", self.map, pos + 4)[0]
+
+        for cid in (CHUNK_OID_FANOUT, CHUNK_OID_LOOKUP, CHUNK_COMMIT_DATA):
+            if cid not in self.chunks:
+                raise GitException(
+                    "Missing {0} chunk in {1}".format(cid.decode("ascii"), path)
+                )
+
+        self.fanout = struct.unpack_from(
+            ">256I", self.map, self.chunks[CHUNK_OID_FANOUT]
+        )
+        self.count = self.fanout[255]
+        self.oids = self.chunks[CHUNK_OID_LOOKUP]
+        self.data = self.chunks[CHUNK_COMMIT_DATA]
+        self.edges = self.chunks.get(CHUNK_EXTRA_EDGES)
+
+    def __len__(self):
+        return self.count
+
+    def oid(self, pos):
+        """Return the hex sha of the commit at pos."""
+        start = self.oids + 20 * pos
+        return self.map[start : start + 20].hex()
+
+    def find(self, sha):
+        """Return the position of commit sha, or None."""
+        binsha = bytes.fromhex(sha)
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.oids + 20 * mid
+            cur = self.map[start : start + 20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return mid
+
+        return None
+
+    def tree(self, pos):
+        start = self.data + CDAT_WIDTH * pos
+        return self.map[start : start + 20].hex()
+
+    def parents(self, pos):
+        """Return the positions of the parents of the commit at pos."""
+        start = self.data + CDAT_WIDTH * pos
+        p1, p2 = struct.unpack_from(">II", self.map, start + 20)
+
+        if p1 == GRAPH_PARENT_NONE:
+            return []
+        if p2 == GRAPH_PARENT_NONE:
+            return [p1]
+        if not p2 & GRAPH_EDGE_LAST:
+            return [p1, p2]
+
+        # An octopus merge: the other parents are in EDGE, the last
+        # one flagged.
+        ret = [p1]
+        i = p2 & ~GRAPH_EDGE_LAST
+        while True:
+            edge = struct.unpack_from(">I", self.map, self.edges + 4 * i)[0]
+            ret.append(edge & ~GRAPH_EDGE_LAST)
+            if edge & GRAPH_EDGE_LAST:
+                return ret
+            i += 1
+
+    def generation(self, pos):
+        start = self.data + CDAT_WIDTH * pos
+        return struct.unpack_from(">I", self.map, start + 28)[0] >> 2
+
+    def date(self, pos):
+        start = self.data + CDAT_WIDTH * pos
+        hi, lo = struct.unpack_from(">II", self.map, start + 28)
+        return ((hi & 0x3) << 32) | lo
+
+
+def commit_graph(repo):
+    """
+    Return the commit-graph of repo, or None if it has none. It is
+    opened once and kept on the repository.
+    """
+    if repo.commit_graph is None:
+        path = repo_path(repo, "objects", "info", "commit-graph")
+        repo.commit_graph = GitCommitGraph(path) if os.path.isfile(path) else False
+
+    return repo.commit_graph or None
+
+
+def commit_parse(commit):
+    """Return the tree, parents and committer date of a commit object."""
+    # The committer line ends with "<timestamp> <timezone>".
+    committer = commit.header(b"committer")[0]
+    date = int(committer.rsplit(b" ", 2)[1])
+
+    return commit.tree, commit.parents, date
+
+
+def commit_parents(repo, sha):
+    """
+    Return the parents of commit sha, from the commit-graph when it
+    knows the commit, from the commit object otherwise.
+    """
+    graph = commit_graph(repo)
+    if graph:
+        pos = graph.find(sha)
+        if pos is not None:
+            return [graph.oid(p) for p in graph.parents(pos)]
+
+    return commit_parse(object_read(repo, sha))[1]
+
+
+def commit_date(repo, sha):
+    """Return the committer date of commit sha, like commit_parents."""
+    graph = commit_graph(repo)
+    if graph:
+        pos = graph.find(sha)
+        if pos is not None:
+            return graph.date(pos)
+
+    return commit_parse(object_read(repo, sha))[2]
+
+
+def commit_graph_write(repo):
+    """
+    Write a commit-graph for every commit reachable from the refs and
+    HEAD. Return the number of commits written.
+    """
+    roots = [ref_resolve(repo, name) for name in ref_snapshot(repo).refs]
+    roots.append(ref_resolve(repo, "HEAD"))
+
+    # Collect every commit, peeling tags on the way.
+    commits = dict()  # sha -> (tree, parents, date)
+    stack = [sha for sha in roots if sha]
+    while stack:
+        sha = stack.pop()
+        if sha in commits:
+            continue
+        obj = object_read(repo, sha)
+        if not obj:
+            raise GitException("Missing object {0}".format(sha))
+        if obj.fmt == b"tag":
+            stack.append(obj.object)
+            continue
+        if obj.fmt != b"commit":
+            continue
+
+        commits[sha] = commit_parse(obj)
+        stack.extend(p for p in commits[sha][1] if p not in commits)
+
+    oids = sorted(commits)
+    positions = {sha: i for i, sha in enumerate(oids)}
+
+    # Generation numbers: one more than the highest parent, so a
+    # commit must come after all its parents. Iterative post-order.
+    generations = dict()
+    for sha in oids:
+        stack = [sha]
+        while stack:
+            cur = stack[-1]
+            if cur in generations:
+                stack.pop()
+                continue
+            missing = [p for p in commits[cur][1] if p not in generations]
+            if missing:
+                stack.extend(missing)
+                continue
+            stack.pop()
+            gen = 1 + max((generations[p] for p in commits[cur][1]), default=0)
+            generations[cur] = min(gen, GENERATION_MAX)
+
+    fanout = [0] * 256
+    for sha in oids:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    cdat = list()
+    edges = list()
+    for sha in oids:
+        tree, parents, date = commits[sha]
+        pos = [positions[p] for p in parents]
+
+        p1 = pos[0] if pos else GRAPH_PARENT_NONE
+        if len(pos) < 2:
+            p2 = GRAPH_PARENT_NONE
+        elif len(pos) == 2:
+            p2 = pos[1]
+        else:
+            p2 = GRAPH_EDGE_LAST | len(edges)
+            edges.extend(pos[1:-1])
+            edges.append(pos[-1] | GRAPH_EDGE_LAST)
+
+        gen = generations[sha]
+        # The generation takes the top 30 bits of the last 8 bytes,
+        # the date the other 34.
+        hi = (gen << 2) | ((date >> 32) & 0x3)
+        cdat.append(
+            bytes.fromhex(tree) + struct.pack(">IIII", p1, p2, hi, date & 0xFFFFFFFF)
+        )
+
+    chunks = [
+        (CHUNK_OID_FANOUT, struct.pack(">256I", *fanout)),
+        (CHUNK_OID_LOOKUP, b"".join(bytes.fromhex(sha) for sha in oids)),
+        (CHUNK_COMMIT_DATA, b"".join(cdat)),
+    ]
+    if edges:
+        edge_data = struct.pack(">%dI" % len(edges), *edges)
+        chunks.append((CHUNK_EXTRA_EDGES, edge_data))
+
+    out = [GRAPH_MAGIC, bytes([1, 1, len(chunks), 0])]
+    offset = 8 + 12 * (len(chunks) + 1)
+    for cid, data in chunks:
+        out.append(cid + struct.pack(">Q", offset))
+        offset += len(data)
+    out.append(b"\0\0\0\0" + struct.pack(">Q", offset))
+    out.extend(data for _, data in chunks)
+
+    content = b"".join(out)
+    path = repo_path(repo, "objects", "info", "commit-graph")
+    repo_dir(repo, "objects", "info", mkdir=True)
+    with open(path + ".lock", "wb") as f:
+        f.write(content)
+        f.write(hashlib.sha1(content).digest())
+    os.replace(path + ".lock", path)
+
+    # Forget the old graph, if any.
+    repo.commit_graph = None
+
+    return len(oids)
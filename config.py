@@ -0,0 +1,211 @@
+import os
+from cache import parse_size
+from error import GitException
+
+# Parsed files, by path, with the mtime they had. Reading the same
+# configuration twice in a process costs a stat.
+config_files = dict()
+
+
+class GitConfig(object):
+    """
+    Git configuration, from one file or a cascade of them.
+
+    values maps "section.name" or "section.subsection.name" keys, with
+    section and name lowercased as git does, to every value they were
+    given, in order: the last one wins. The getters take the section
+    (or "section.subsection") and the name apart, like configparser's.
+    """
+
+    def __init__(self, values=None):
+        self.values = values if values is not None else dict()
+
+    def update(self, other):
+        for key, values in other.values.items():
+            self.values.setdefault(key, list()).extend(values)
+
+    def key(self, section, name):
+        section, dot, subsection = section.partition(".")
+        return section.lower() + dot + subsection + "." + name.lower()
+
+    def get_all(self, section, name):
+        return self.values.get(self.key(section, name), [])
+
+    def get(self, section, name, fallback=None):
+        values = self.get_all(section, name)
+        return values[-1] if values else fallback
+
+    def getint(self, section, name, fallback=None):
+        """Like get, for integers with an optional k, m or g suffix."""
+        value = self.get(section, name)
+        if value is None:
+            return fallback
+        return parse_size(value)
+
+    def getboolean(self, section, name, fallback=None):
+        value = self.get(section, name)
+        if value is None:
+            return fallback
+        value = value.lower()
+        if value in ("true", "yes", "on", "1"):
+            return True
+        if value in ("false", "no", "off", "0", ""):
+            return False
+        raise ValueError("Not a boolean: {0}".format(value))
+
+
+def config_value(line, path, value=""):
+    """
+    Parse the value in line: unquote it, apply escapes, cut comments
+    and trailing spaces, and append it to value, the part read from
+    the previous lines. Return it, and whether it ends with a
+    backslash and continues on the next line.
+    """
+    out = [value] if value else []
+    quoted = False
+    i = 0
+    spaces = ""  # Unquoted spaces, kept only if more value follows.
+    while i < len(line):
+        c = line[i]
+        i += 1
+        if c == "\n":
+            break
+        if c.isspace() and not quoted:
+            if out:
+                spaces += c
+            continue
+        if c in "#;" and not quoted:
+            break
+        if c == '"':
+            out.append(spaces)
+            spaces = ""
+            quoted = not quoted
+            continue
+        out.append(spaces)
+        spaces = ""
+        if c == "\\":
+            if i >= len(line) or line[i] == "\n":
+                return "".join(out), True
+            esc = line[i]
+            i += 1
+            if esc not in 'ntb"\\':
+                raise GitException("Bad config escape \\{0} in {1}".format(esc, path))
+            c = {"n": "\n", "t": "\t", "b": "\b"}.get(esc, esc)
+        out.append(c)
+
+    if quoted:
+        raise GitException("Unterminated quote in {0}".format(path))
+    return "".join(out), False
+
+
+def config_parse(text, path="<config>", depth=0):
+    """
+    Parse git configuration text. include.path directives are
+    followed, relative to path.
+    """
+    conf = GitConfig()
+    section = None
+    lines = text.splitlines(keepends=True)
+    n = 0
+    while n < len(lines):
+        line = lines[n]
+        n += 1
+        stripped = line.strip()
+        if not stripped or stripped[0] in "#;":
+            continue
+
+        if stripped.startswith("["):
+            # [section], [section "subsection"] or the old
+            # [section.subsection].
+            end = stripped.rfind("]")
+            if end < 0:
+                raise GitException("Bad config section in {0}".format(path))
+            header = stripped[1:end].strip()
+            if '"' in header:
+                name, _, sub = header.partition(" ")
+                sub = sub.strip()
+                if not (len(sub) >= 2 and sub[0] == sub[-1] == '"'):
+                    raise GitException("Bad config section in {0}".format(path))
+                sub = sub[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+                section = name.lower() + "." + sub
+            else:
+                name, dot, sub = header.partition(".")
+                section = name.lower() + dot + sub.lower()
+            rest = stripped[end + 1 :].strip()
+            if not rest or rest[0] in "#;":
+                continue
+            # A key may follow on the same line.
+            line = rest
+
+        if section is None:
+            raise GitException("Config key outside of a section in {0}".format(path))
+
+        name, eq, rest = line.strip().partition("=")
+        name = name.strip()
+        if not eq:
+            # A bare key is a true boolean.
+            name = name.split("#")[0].split(";")[0].strip()
+            value = "true"
+        else:
+            value, more = config_value(rest, path)
+            while more and n < len(lines):
+                value, more = config_value(lines[n], path, value)
+                n += 1
+
+        key = section + "." + name.lower()
+        conf.values.setdefault(key, list()).append(value)
+
+        if key == "include.path" and depth < 10:
+            include = os.path.expanduser(value)
+            if not os.path.isabs(include):
+                include = os.path.join(os.path.dirname(path), include)
+            conf.update(config_file(include, depth + 1))
+
+    return conf
+
+
+def config_file(path, depth=0):
+    """
+    Read and parse the configuration file at path. A missing file is
+    an empty configuration. Files are parsed once per process, unless
+    they change.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return GitConfig()
+
+    cached = config_files.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "r", encoding="utf8") as f:
+        conf = config_parse(f.read(), path, depth)
+    config_files[path] = (mtime, conf)
+    return conf
+
+
+def config_global_paths():
+    """The user's configuration files, read in this order."""
+    xdg = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+        os.path.expanduser("~"), ".config"
+    )
+    return [
+        os.path.join(xdg, "git", "config"),
+        os.path.join(os.path.expanduser("~"), ".gitconfig"),
+    ]
+
+
+def config_read(repo_config=None):
+    """
+    Return the configuration that applies to a repository: the XDG
+    and ~/.gitconfig files, then the repository's own config file at
+    repo_config, if any. Later files override earlier ones.
+    """
+    conf = GitConfig()
+    paths = config_global_paths()
+    if repo_config:
+        paths.append(repo_config)
+    for path in paths:
+        conf.update(config_file(path))
+    return conf
@@ -0,0 +1,409 @@
+import os
+import stat
+import struct
+import hashlib
+from repo import repo_path
+from error import GitException
+
+INDEX_MAGIC = b"DIRC"
+
+# ctime, mtime (seconds and nanoseconds), dev, ino, mode, uid, gid,
+# size, then the sha and the flags.
+INDEX_ENTRY = struct.Struct(">10I20sH")
+
+INDEX_FLAG_ASSUME_VALID = 0x8000
+INDEX_FLAG_EXTENDED = 0x4000
+INDEX_FLAG_STAGE = 0x3000
+INDEX_NAME_MASK = 0x0FFF
+
+INDEX_EXT_TREE = b"TREE"
+
+
+class GitIndexEntry(object):
+    """
+    A path in the index: the sha of its blob, and the stat data of
+    the file it was hashed from.
+    """
+
+    __slots__ = (
+        "ctime",
+        "mtime",
+        "dev",
+        "ino",
+        "mode",
+        "uid",
+        "gid",
+        "size",
+        "sha",
+        "flags",
+        "extended",
+        "name",
+    )
+
+    def __init__(
+        self,
+        name,
+        sha,
+        mode,
+        ctime=(0, 0),
+        mtime=(0, 0),
+        dev=0,
+        ino=0,
+        uid=0,
+        gid=0,
+        size=0,
+        flags=0,
+        extended=0,
+    ):
+        self.name = name  # The path, relative to the worktree.
+        self.sha = sha
+        self.mode = mode  # 0o100644, 0o100755, 0o120000 or 0o160000.
+        self.ctime = ctime  # (seconds, nanoseconds).
+        self.mtime = mtime
+        self.dev = dev
+        self.ino = ino
+        self.uid = uid
+        self.gid = gid
+        self.size = size
+        self.flags = flags  # Without the name length.
+        self.extended = extended  # Index v3 extended flags.
+
+    @property
+    def stage(self):
+        return (self.flags & INDEX_FLAG_STAGE) >> 12
+
+
+class GitIndex(object):
+    """
+    The staging area: entries maps paths to their stage 0 entry.
+    Unmerged paths have their stages 1 to 3 in conflicts instead.
+
+    trees is the cache of the TREE extension: it maps directories
+    ("" for the root) to the sha of the tree they would make, for those
+    that didn't change since it was computed. Adding or removing an
+    entry drops its directories from it.
+
+    extensions holds the extensions we don't interpret, by signature,
+    to write them back as they were. mtime is that of the index file
+    when it was read: entries modified at that time or later may have
+    changed since, without their stat data telling.
+    """
+
+    def __init__(self, version=2, entries=None, conflicts=None, extensions=None):
+        self.version = version
+        self.entries = entries if entries is not None else dict()
+        self.conflicts = conflicts if conflicts is not None else dict()
+        self.extensions = extensions if extensions is not None else dict()
+        self.trees = dict()
+        self.mtime = None
+
+    def add(self, entry):
+        self.conflicts.pop(entry.name, None)
+        self.entries[entry.name] = entry
+        self.invalidate(entry.name)
+
+    def remove(self, name):
+        self.conflicts.pop(name, None)
+        self.invalidate(name)
+        return self.entries.pop(name, None)
+
+    def invalidate(self, name):
+        """Forget the cached trees of the directories holding name."""
+        while "/" in name:
+            name = name.rsplit("/", 1)[0]
+            self.trees.pop(name, None)
+        self.trees.pop("", None)
+
+    def sorted(self):
+        """Every entry, in the order of the index file."""
+        ret = list(self.entries.values())
+        for stages in self.conflicts.values():
+            ret.extend(stages)
+        ret.sort(key=lambda e: (e.name.encode("utf8"), e.stage))
+        return ret
+
+
+def index_read(repo):
+    """
+    Read .git/index. Return an empty GitIndex if there is none.
+    """
+    path = repo_path(repo, "index")
+    if not os.path.isfile(path):
+        return GitIndex()
+
+    with open(path, "rb") as f:
+        mtime = os.fstat(f.fileno()).st_mtime_ns
+        raw = f.read()
+
+    if len(raw) < 32 or raw[0:4] != INDEX_MAGIC:
+        raise GitException("Not an index file {0}".format(path))
+    if hashlib.sha1(raw[:-20]).digest() != raw[-20:]:
+        raise GitException("Bad index checksum in {0}".format(path))
+
+    version, count = struct.unpack_from(">II", raw, 4)
+    if version not in (2, 3):
+        raise GitException("Unsupported index version {0}".format(version))
+
+    index = GitIndex(version)
+    index.mtime = (mtime // 10**9, mtime % 10**9)
+
+    pos = 12
+    for _ in range(count):
+        (
+            ctime_s,
+            ctime_ns,
+            mtime_s,
+            mtime_ns,
+            dev,
+            ino,
+            mode,
+            uid,
+            gid,
+            size,
+            binsha,
+            flags,
+        ) = INDEX_ENTRY.unpack_from(raw, pos)
+        start = pos + INDEX_ENTRY.size
+
+        extended = 0
+        if flags & INDEX_FLAG_EXTENDED:
+            if version < 3:
+                raise GitException("Extended flags in a version 2 index")
+            extended = struct.unpack_from(">H", raw, start)[0]
+            start += 2
+
+        # The name length saturates: long names are NUL terminated.
+        length = flags & INDEX_NAME_MASK
+        if length == INDEX_NAME_MASK:
+            length = raw.index(b"\x00", start + length) - start
+        name = raw[start : start + length].decode("utf8")
+
+        entry = GitIndexEntry(
+            name,
+            binsha.hex(),
+            mode,
+            (ctime_s, ctime_ns),
+            (mtime_s, mtime_ns),
+            dev,
+            ino,
+            uid,
+            gid,
+            size,
+            flags & ~INDEX_NAME_MASK,
+            extended,
+        )
+        if entry.stage:
+            index.conflicts.setdefault(name, []).append(entry)
+        else:
+            index.entries[name] = entry
+
+        # Entries are padded with 1 to 8 NULs, to a multiple of 8.
+        pos += (start - pos + length + 8) & ~7
+
+    # Then extensions, up to the checksum.
+    while pos < len(raw) - 20:
+        sig = raw[pos : pos + 4]
+        size = struct.unpack_from(">I", raw, pos + 4)[0]
+        data = raw[pos + 8 : pos + 8 + size]
+        if sig == INDEX_EXT_TREE:
+            index.trees = cache_tree_parse(data)
+        else:
+            index.extensions[sig] = data
+        pos += 8 + size
+
+    return index
+
+
+def index_write(repo, index):
+    """
+    Write index to .git/index.
+
+    Entries whose file was modified no earlier than the index could
+    change again within the same timestamp, and their stat data
+    wouldn't show it: their size is zeroed so they are hashed next
+    time, as git does.
+    """
+    path = repo_path(repo, "index")
+    with open(path + ".lock", "wb") as f:
+        # The lock file's mtime is "now", as the filesystem sees it.
+        now = os.fstat(f.fileno()).st_mtime_ns
+        now = (now // 10**9, now % 10**9)
+
+        content = index_serialize(index, now)
+        f.write(content)
+        f.write(hashlib.sha1(content).digest())
+    os.replace(path + ".lock", path)
+
+
+def index_serialize(index, now):
+    """Serialize index, without its checksum."""
+    entries = index.sorted()
+    version = index.version
+    if any(e.extended for e in entries):
+        version = max(version, 3)
+    elif version == 3:
+        version = 2
+
+    out = [INDEX_MAGIC, struct.pack(">II", version, len(entries))]
+    for e in entries:
+        name = e.name.encode("utf8")
+        flags = e.flags | min(len(name), INDEX_NAME_MASK)
+        if e.extended:
+            flags |= INDEX_FLAG_EXTENDED
+        else:
+            flags &= ~INDEX_FLAG_EXTENDED
+
+        size = e.size
+        if e.mtime >= now:
+            size = 0
+
+        data = INDEX_ENTRY.pack(
+            e.ctime[0],
+            e.ctime[1],
+            e.mtime[0],
+            e.mtime[1],
+            e.dev & 0xFFFFFFFF,
+            e.ino & 0xFFFFFFFF,
+            e.mode,
+            e.uid & 0xFFFFFFFF,
+            e.gid & 0xFFFFFFFF,
+            size & 0xFFFFFFFF,
+            bytes.fromhex(e.sha),
+            flags,
+        )
+        if e.extended:
+            data += struct.pack(">H", e.extended)
+        data += name
+        out.append(data + b"\x00" * (8 - len(data) % 8))
+
+    if index.trees:
+        data = cache_tree_serialize(index)
+        out.append(INDEX_EXT_TREE + struct.pack(">I", len(data)) + data)
+    for sig, data in index.extensions.items():
+        out.append(sig + struct.pack(">I", len(data)) + data)
+
+    return b"".join(out)
+
+
+def index_mode(st):
+    """The index mode of a file, from its stat data."""
+    if stat.S_ISLNK(st.st_mode):
+        return 0o120000
+    if st.st_mode & stat.S_IXUSR:
+        return 0o100755
+    return 0o100644
+
+
+def index_entry_stat(entry, st):
+    """Record the stat data st of its file in entry."""
+    entry.ctime = (st.st_ctime_ns // 10**9, st.st_ctime_ns % 10**9)
+    entry.mtime = (st.st_mtime_ns // 10**9, st.st_mtime_ns % 10**9)
+    entry.dev = st.st_dev & 0xFFFFFFFF
+    entry.ino = st.st_ino & 0xFFFFFFFF
+    entry.mode = index_mode(st)
+    entry.uid = st.st_uid & 0xFFFFFFFF
+    entry.gid = st.st_gid & 0xFFFFFFFF
+    entry.size = st.st_size & 0xFFFFFFFF
+
+
+def index_entry_uptodate(index, entry, st):
+    """
+    Tell whether entry is known to match its file, from the stat data
+    st of the file alone. When this is false, the file may still have
+    the same content: only hashing it can tell.
+    """
+    if (
+        entry.mtime != (st.st_mtime_ns // 10**9, st.st_mtime_ns % 10**9)
+        or entry.ctime != (st.st_ctime_ns // 10**9, st.st_ctime_ns % 10**9)
+        or entry.ino != st.st_ino & 0xFFFFFFFF
+        or entry.uid != st.st_uid & 0xFFFFFFFF
+        or entry.gid != st.st_gid & 0xFFFFFFFF
+        or entry.size != st.st_size & 0xFFFFFFFF
+        or entry.mode != index_mode(st)
+    ):
+        return False
+
+    # Racily clean: the file was modified in the same tick the index
+    # was written, maybe after it.
+    if index.mtime is not None and entry.mtime >= index.mtime:
+        return False
+
+    return True
+
+
+def cache_tree_parse(data):
+    """
+    Parse the TREE extension, git's cache of the trees of the index.
+    Return a dict mapping directories ("" for the root) to the sha of
+    their tree, for the directories whose cached tree is still valid.
+    """
+    ret = dict()
+
+    # Trees come parents first, each followed by its subtrees: the
+    # stack holds the directories that still have subtrees to come.
+    stack = list()
+    pos = 0
+    while pos < len(data):
+        nul = data.index(b"\x00", pos)
+        nl = data.index(b"\n", nul)
+        name = data[pos:nul].decode("utf8")
+        count, subtrees = data[nul + 1 : nl].split(b" ")
+        pos = nl + 1
+
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+        if stack:
+            stack[-1][1] -= 1
+            path = stack[-1][0] + "/" + name if stack[-1][0] else name
+        else:
+            path = name
+
+        # An entry count of -1 marks an invalidated tree, without sha.
+        if int(count) >= 0:
+            ret[path] = data[pos : pos + 20].hex()
+            pos += 20
+        stack.append([path, int(subtrees)])
+
+    return ret
+
+
+def cache_tree_serialize(index):
+    """
+    Serialize the TREE extension of index. Every directory of the
+    index is written, the ones missing from index.trees as invalid.
+    """
+    counts = {"": 0}  # Directory -> number of entries under it.
+    children = {"": set()}  # Directory -> subdirectory names.
+    for name in list(index.entries) + list(index.conflicts):
+        counts[""] += 1
+        parent = ""
+        for part in name.split("/")[:-1]:
+            path = parent + "/" + part if parent else part
+            if path not in counts:
+                counts[path] = 0
+                children[path] = set()
+                children[parent].add(part)
+            counts[path] += 1
+            parent = path
+
+    out = list()
+    stack = [("", "")]
+    while stack:
+        path, name = stack.pop()
+        subs = children[path]
+        sha = index.trees.get(path)
+        if sha:
+            header = "{0}\x00{1} {2}\n".format(name, counts[path], len(subs))
+            out.append(header.encode("utf8") + bytes.fromhex(sha))
+        else:
+            header = "{0}\x00-1 {1}\n".format(name, len(subs))
+            out.append(header.encode("utf8"))
+
+        # Git orders subtrees by name length, then name. The stack
+        # pops them in that order.
+        for sub in sorted(
+            subs, key=lambda n: (len(n.encode("utf8")), n.encode("utf8")), reverse=True
+        ):
+            stack.append((path + "/" + sub if path else sub, sub))
+
+    return b"".join(out)
@@ -1,80 +1,123 @@
-import collections
-
-
-def kvlm_parse(raw, start=0, dct=None):
-    if not dct:
-        dct = collections.OrderedDict()
-        # The argument is not declared as dct=OrderedDict() because
-        # all calls to the functions would endlessly grow the same dict.
-
-    # This function is recursive: it reads a key-value pair, then call
-    # itself back with the new position. So we first need to know
-    # where we are: at a keyword, or already in the messageQ.
-
-    # Search for the next space and the next newline.
-    spc = raw.find(b" ", start)
-    nl = raw.find(b"\n", start)
-
-    # If space appears before newline, there is a keyword. Otherwise,
-    # it's the final message, which we just read to the end of the file.
-
-    # Base case
-    # =========
-    # If newline appears first (or there's no space at all, in which
-    # case find returns -1), we assume a blank line. A blank line
-    # means the remainder of the data is the message. We store it in
-    # the dictionary, with None as the key, and return.
-    if (spc < 0) or (nl < spc):
-        assert nl == start
-        dct[None] = raw[start + 1 :]
-        return dct
-
-    # Recursive case
-    # ==============
-    # Read a key-value pair and recurse for the next.
-    key = raw[start:spc]
-
-    # Find the end of the value. Continuation lines begin with a
-    # space, so we loop until we find a "\n" not followed by a space.
-    end = start
-    while True:
-        end = raw.find(b"\n", end + 1)
-        if raw[end + 1] != ord(" "):
+from error import GitException
+import perf
+
+
+@perf.timed("kvlm_parse")
+def kvlm_parse(raw):
+    """
+    Parse a commit or tag: a list of "key value" header lines, then
+    a blank line and the message. Return a dict of keys to values,
+    in order, with the message under the None key. Repeated keys
+    (like parent) map to a list of values.
+
+    This is a single loop over raw. It only searches it in place, and
+    slices it once per key and value.
+    """
+    if not isinstance(raw, bytes):
+        raw = bytes(raw)
+
+    dct = dict()
+    pos = 0
+    size = len(raw)
+
+    while pos < size:
+        nl = raw.find(b"\n", pos)
+        if nl < 0:
+            nl = size
+
+        # A blank line: the rest is the message.
+        if nl == pos:
+            dct[None] = raw[pos + 1 :]
+            return dct
+
+        spc = raw.find(b" ", pos, nl)
+        if spc < 0:
+            raise GitException("Malformed header line")
+
+        # Find the end of the value. Continuation lines begin with a
+        # space, so we skip lines until one doesn't.
+        end = nl
+        while end + 1 < size and raw[end + 1] == 0x20:
+            end = raw.find(b"\n", end + 1)
+            if end < 0:
+                end = size
+
+        key = raw[pos:spc]
+        # Grab the value.
+        # Also, drop the leading space on continuation lines.
+        value = raw[spc + 1 : end]
+        if end != nl:
+            value = value.replace(b"\n ", b"\n")
+
+        # Don't overwrite existing data contents.
+        if key in dct:
+            if type(dct[key]) == list:
+                dct[key].append(value)
+            else:
+                dct[key] = [dct[key], value]
+        else:
+            dct[key] = value
+
+        pos = end + 1
+
+    # No blank line: no message.
+    dct[None] = b""
+    return dct
+
+
+def kvlm_header(raw, key):
+    """
+    Return the values of header key, as a list. Only header lines
+    are scanned: the message is never touched, nothing but the
+    matching values is copied.
+    """
+    ret = list()
+    prefix = key + b" "
+    pos = 0
+    size = len(raw)
+
+    while pos < size:
+        nl = raw.find(b"\n", pos)
+        if nl < 0:
+            nl = size
+        if nl == pos:
+            # Reached the message.
             break
 
-    # Grab the value.
-    # Also, drop the leading space on continuation lines.
-    value = raw[spc + 1 : end].replace(b"\n ", b"\n")
+        end = nl
+        while end + 1 < size and raw[end + 1] == 0x20:
+            end = raw.find(b"\n", end + 1)
+            if end < 0:
+                end = size
 
-    # Don't overwrite existing data contents.
-    if key in dct:
-        if type(dct[key]) == list:
-            dct[key].append(value)
-        else:
-            dct[key] = [dct[key], value]
-    else:
-        dct[key] = value
+        if raw.startswith(prefix, pos):
+            value = raw[pos + len(prefix) : end]
+            if end != nl:
+                value = value.replace(b"\n ", b"\n")
+            ret.append(value)
 
-    return kvlm_parse(raw, start=end + 1, dct=dct)
+        pos = end + 1
+
+    return ret
 
 
 def kvlm_serialize(kvlm):
-    ret = b""
+    out = list()
 
     # Output fields.
-    for k in kvlm.keys():
+    for k, val in kvlm.items():
         # Skip the message itself.
         if k == None:
             continue
-        val = kvlm[k]
         # Normalize to a list.
         if type(val) != list:
             val = [val]
 
         for v in val:
-            ret += k + b" " + (v.replace(b"\n", b"\n ")) + b"\n"
+            out.append(k + b" " + v.replace(b"\n", b"\n ") + b"\n")
 
-    # Append message.
-    ret += b"\n" + kvlm[None] + b"\n"
+    # Append message. It already holds its final newline, if any.
+    out.append(b"\n")
+    out.append(kvlm.get(None, b""))
 
-    return ret
+    return b"".join(out)
@@ -1,18 +1,19 @@
 import argparse
 import sys
 import os
-from commands.init import repo_create
-from commands.hash import cat_file, hash_object
-from commands.log import log_graphviz, log_print
-from commands.tree import ls_tree, tree_checkout
-from commands.ref import show_refs
-from commands.tag import tag_create
-from error import FileSystemException, GitException
-from repo import repo_find
-from object import object_find, object_read
-from ref import ref_list
+import time
+import perf
+
+# Command modules are imported by the cmd_* functions that need them,
+# so that running a command only loads what it uses.
 
 argparser = argparse.ArgumentParser(description="The stupidest content tracker")
+argparser.add_argument(
+    "--profile",
+    action="store_true",
+    help="Report where time went on stderr, at exit. PIT_TRACE_PERF=<file> "
+    "writes it to a file instead, as a Chrome trace if it ends in .json",
+)
 argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
 argsubparsers.required = True
 
@@ -26,17 +27,84 @@ argsp.add_argument(
     help="Where to create the repository.",
 )
 
+# pit add
+argsp = argsubparsers.add_parser("add", help="Add file contents to the index.")
+argsp.add_argument(
+    "paths", metavar="path", nargs="+", help="Files or directories to add"
+)
+
 # pit cat-file
 argsp = argsubparsers.add_parser(
     "cat-file", help="Provide content of repository objects."
 )
+argsp.add_argument(
+    "-t",
+    dest="show_type",
+    action="store_true",
+    help="Show the object type instead of its content",
+)
+argsp.add_argument(
+    "-s",
+    dest="show_size",
+    action="store_true",
+    help="Show the object size instead of its content",
+)
 argsp.add_argument(
     "type",
     metavar="type",
-    choices=["blob", "commit", "tag", "tree"],
-    help="Specify the type",
+    nargs="?",
+    help="Specify the type: blob, commit, tag or tree",
+)
+argsp.add_argument(
+    "object", metavar="object", nargs="?", help="The hash of the object to display"
+)
+argsp.add_argument(
+    "--batch",
+    action="store_true",
+    help="Print the header and content of each object named on stdin",
+)
+argsp.add_argument(
+    "--batch-check",
+    action="store_true",
+    help="Print the header of each object named on stdin",
+)
+argsp.add_argument(
+    "--buffer",
+    action="store_true",
+    help="Don't flush the batch output after each object",
+)
+
+# pit commit
+argsp = argsubparsers.add_parser("commit", help="Record changes to the repository.")
+argsp.add_argument(
+    "-m", metavar="message", dest="message", required=True, help="Commit message"
+)
+
+# pit diff-tree
+argsp = argsubparsers.add_parser(
+    "diff-tree", help="Compare the content and mode of blobs found via two trees."
+)
+argsp.add_argument(
+    "-r", dest="recursive", action="store_true", help="Recurse into sub-trees"
+)
+argsp.add_argument("old", help="The tree-ish to compare from")
+argsp.add_argument("new", help="The tree-ish to compare to")
+
+# pit fsck
+argsp = argsubparsers.add_parser(
+    "fsck", help="Verify the connectivity and validity of the objects."
+)
+argsp.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    help="Number of checking processes, fsck.workers or one per core by default",
+)
+argsp.add_argument(
+    "--progress",
+    action=argparse.BooleanOptionalAction,
+    help="Report progress on stderr, by default when it is a terminal",
 )
-argsp.add_argument("object", metavar="object", help="The hash of the object to display")
 
 # pit hash-object
 argsp = argsubparsers.add_parser(
@@ -68,6 +136,37 @@ argsp.add_argument(
     default="print",
     help="Specify the log output format",
 )
+argsp.add_argument(
+    "-n",
+    "--max-count",
+    type=int,
+    dest="max_count",
+    help="Limit the number of commits to output",
+)
+argsp.add_argument(
+    "--since", "--after", dest="since", help="Show commits more recent than a date"
+)
+argsp.add_argument(
+    "--until", "--before", dest="until", help="Show commits older than a date"
+)
+argsp.add_argument(
+    "--author", help="Only show commits whose author matches a regular expression"
+)
+argsp.add_argument(
+    "--topo-order",
+    dest="topo",
+    action="store_true",
+    help="Show no parents before all of its children are shown",
+)
+argsp.add_argument(
+    "--stat", action="store_true", help="Show how many lines of each file changed"
+)
+argsp.add_argument(
+    "--name-only",
+    dest="name_only",
+    action="store_true",
+    help="Show the names of the changed files",
+)
 argsp.add_argument("commit", default="HEAD", nargs="?", help="Commit to start at.")
 
 # pit ls-tree
@@ -75,18 +174,136 @@ argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
 argsp.add_argument(
     "-r", dest="recursive", action="store_true", help="Recurse into sub-trees"
 )
+argsp.add_argument(
+    "-l", dest="long", action="store_true", help="Show the size of blob entries"
+)
 argsp.add_argument("tree", help="A tree-ish object")
 
 # pit checkout
 argsp = argsubparsers.add_parser(
     "checkout", help="Checkout a commit inside if a directory"
 )
+argsp.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    help="Number of parallel workers (defaults to checkout.workers, or one per core)",
+)
 argsp.add_argument("commit", help="The commit of tree to checkout")
 argsp.add_argument("path", help="The EMPTY directory to checkout on")
 
+# pit repack
+argsp = argsubparsers.add_parser(
+    "repack", help="Pack loose objects into a packfile with deltas."
+)
+argsp.add_argument(
+    "-a",
+    dest="everything",
+    action="store_true",
+    help="Also repack the objects of existing packs into the new one",
+)
+argsp.add_argument(
+    "--window",
+    type=int,
+    default=10,
+    help="How many objects to try as delta bases for each object",
+)
+argsp.add_argument(
+    "--depth", type=int, default=50, help="Maximum length of delta chains"
+)
+argsp.add_argument(
+    "-b",
+    "--write-bitmap-index",
+    dest="bitmaps",
+    action=argparse.BooleanOptionalAction,
+    help="With -a, write reachability bitmaps (defaults to repack.writeBitmaps)",
+)
+
+# pit gc
+argsp = argsubparsers.add_parser(
+    "gc", help="Pack every object of the repository into a single pack."
+)
+
+# pit pack-refs
+argsp = argsubparsers.add_parser(
+    "pack-refs", help="Pack refs into a single file for efficient access."
+)
+argsp.add_argument(
+    "--all",
+    dest="everything",
+    action="store_true",
+    help="Pack all refs, not only tags and already packed refs",
+)
+argsp.add_argument(
+    "--no-prune",
+    dest="prune",
+    action="store_false",
+    help="Keep the loose files of the packed refs",
+)
+
+# pit commit-graph
+argsp = argsubparsers.add_parser(
+    "commit-graph", help="Write the commit-graph file, to speed up history walks."
+)
+argsp.add_argument("action", choices=["write"], help="What to do")
+
+# pit rev-parse
+argsp = argsubparsers.add_parser("rev-parse", help="Resolve names to object hashes.")
+argsp.add_argument("names", metavar="name", nargs="+", help="Names to resolve")
+argsp.add_argument(
+    "--short", action="store_true", help="Print the shortest unique abbreviations"
+)
+
+# pit rev-list
+argsp = argsubparsers.add_parser(
+    "rev-list", help="List the commits reachable from the given ones."
+)
+argsp.add_argument("commits", metavar="commit", nargs="+", help="Commits to start from")
+argsp.add_argument(
+    "--count", action="store_true", help="Print how many objects would be listed"
+)
+argsp.add_argument(
+    "--objects", action="store_true", help="List the trees and blobs too"
+)
+argsp.add_argument(
+    "--use-bitmap-index",
+    dest="use_bitmap",
+    action=argparse.BooleanOptionalAction,
+    help="Answer --count and --objects from the reachability bitmaps, if any",
+)
+
+# pit serve
+argsp = argsubparsers.add_parser(
+    "serve",
+    help="Answer read-only commands from a long-lived process, with warm caches.",
+)
+argsp.add_argument(
+    "--socket",
+    metavar="path",
+    help="Unix socket to listen on, .git/pit.sock by default. Clients find "
+    "it there, or in $PIT_SOCKET",
+)
+
 # pit show-refs
 argsp = argsubparsers.add_parser("show-refs", help="List references.")
 
+# pit status
+argsp = argsubparsers.add_parser("status", help="Show the working tree status.")
+argsp.add_argument(
+    "-s", "--short", action="store_true", help="Give the output in the short format"
+)
+argsp.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    help="Number of hashing processes (defaults to status.workers, or one per core)",
+)
+
+# pit write-tree
+argsp = argsubparsers.add_parser(
+    "write-tree", help="Create a tree object from the current index."
+)
+
 # pit tag
 argsp = argsubparsers.add_parser("tag", help="List and create tags.")
 argsp.add_argument(
@@ -103,15 +320,78 @@ argsp.add_argument("-m", metavar="message", dest="message", help="Tag message")
 
 
 def cmd_init(args):
+    from commands.init import repo_create
+
     repo_create(args.path)
 
 
-def cmd_cat_file(args):
+def cmd_add(args):
+    from commands.index import add
+    from repo import repo_find
+
+    repo = repo_find()
+    add(repo, args.paths)
+
+
+def cmd_cat_file(args, repo=None):
+    from commands.hash import cat_file, cat_file_batch, cat_file_info
+    from repo import repo_find
+
+    if args.batch or args.batch_check:
+        if args.type:
+            argparser.error("cat-file: --batch takes object names on stdin")
+        repo = repo or repo_find()
+        cat_file_batch(repo, contents=args.batch, buffer=args.buffer)
+        return
+
+    # Both positionals are optional for --batch, so a lone one is the
+    # object.
+    if not args.object:
+        args.type, args.object = None, args.type
+    if not args.object:
+        argparser.error("cat-file: an object is required")
+    if args.type and args.type not in ("blob", "commit", "tag", "tree"):
+        argparser.error("cat-file: invalid type {0}".format(args.type))
+
+    repo = repo or repo_find()
+
+    if args.show_type or args.show_size:
+        cat_file_info(repo, args.object, size=args.show_size)
+    elif args.type:
+        cat_file(repo, args.object, fmt=args.type.encode())
+    else:
+        argparser.error("cat-file: one of -t, -s or <type> is required")
+
+
+def cmd_commit(args):
+    from commands.commit import commit
+    from repo import repo_find
+
+    repo = repo_find()
+    commit(repo, args.message)
+
+
+def cmd_diff_tree(args):
+    from commands.diff import diff_tree
+    from repo import repo_find
+
     repo = repo_find()
-    cat_file(repo, args.object, fmt=args.type.encode())
+    diff_tree(repo, args.old, args.new, args.recursive)
+
+
+def cmd_fsck(args):
+    from commands.fsck import fsck
+    from repo import repo_find
+
+    repo = repo_find()
+    if not fsck(repo, args.jobs, args.progress):
+        sys.exit(1)
 
 
 def cmd_hash_object(args):
+    from commands.hash import hash_object
+    from repo import repo_find
+
     if args.write:
         repo = repo_find()
     else:
@@ -122,31 +402,48 @@ def cmd_hash_object(args):
         print(sha)
 
 
-def cmd_log(args):
-    repo = repo_find()
+def cmd_log(args, repo=None):
+    from commands.log import date_parse, log_graphviz, log_print
+    from object import object_find
+    from repo import repo_find
+
+    repo = repo or repo_find()
+    sha = object_find(repo, args.commit, fmt=b"commit")
+    filters = dict(
+        max_count=args.max_count,
+        since=date_parse(args.since) if args.since else None,
+        until=date_parse(args.until) if args.until else None,
+        author=args.author,
+        topo=args.topo,
+    )
 
     match args.format:
         case "print":
-            log_print(repo, object_find(repo, args.commit), set())
+            log_print(repo, sha, stat=args.stat, name_only=args.name_only, **filters)
         case "graph":
-            print("digraph pitlog{")
-            print("    node[shape=rect]")
-            log_graphviz(repo, object_find(repo, args.commit), set())
-            print("}")
+            log_graphviz(repo, sha, **filters)
 
 
-def cmd_ls_tree(args):
-    repo = repo_find()
-    ls_tree(repo, args.tree, args.recursive)
+def cmd_ls_tree(args, repo=None):
+    from commands.tree import ls_tree
+    from repo import repo_find
+
+    repo = repo or repo_find()
+    ls_tree(repo, args.tree, args.recursive, long=args.long)
 
 
 def cmd_checkout(args):
+    from commands.tree import tree_checkout
+    from error import FileSystemException
+    from object import object_find, object_read
+    from repo import repo_find
+
     repo = repo_find()
     obj = object_read(repo, object_find(repo, args.commit))
 
     # If the object is a commit, grab its tree.
     if obj.fmt == b"commit":
-        obj = object_read(repo, obj.kvlm[b"tree"].decode("ascii"))
+        obj = object_read(repo, obj.tree)
 
     # Verify that path is an empty directory.
     if os.path.exists(args.path):
@@ -157,16 +454,96 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
+    tree_checkout(repo, obj, os.path.realpath(args.path), args.jobs)
 
 
-def cmd_show_refs(args):
+def cmd_repack(args):
+    from commands.repack import repack
+    from repo import repo_find
+
     repo = repo_find()
+    repack(repo, args.everything, args.window, args.depth, args.bitmaps)
+
+
+def cmd_gc(args):
+    from commands.ref import pack_refs
+    from commands.repack import repack
+    from commitgraph import commit_graph_write
+    from repo import repo_find
+
+    repo = repo_find()
+    repack(repo, everything=True)
+    pack_refs(repo, everything=True)
+    commit_graph_write(repo)
+
+
+def cmd_pack_refs(args):
+    from commands.ref import pack_refs
+    from repo import repo_find
+
+    repo = repo_find()
+    pack_refs(repo, args.everything, args.prune)
+
+
+def cmd_commit_graph(args):
+    from commitgraph import commit_graph_write
+    from repo import repo_find
+
+    repo = repo_find()
+    match args.action:
+        case "write":
+            count = commit_graph_write(repo)
+            print("Wrote commit-graph with {0} commits".format(count))
+
+
+def cmd_rev_parse(args, repo=None):
+    from commands.ref import rev_parse
+    from repo import repo_find
+
+    repo = repo or repo_find()
+    rev_parse(repo, args.names, args.short)
+
+
+def cmd_rev_list(args, repo=None):
+    from commands.revlist import rev_list
+    from repo import repo_find
+
+    repo = repo or repo_find()
+    rev_list(repo, args.commits, args.count, args.objects, args.use_bitmap)
+
+
+def cmd_serve(args):
+    from commands.serve import serve
+    from repo import repo_find
+
+    repo = repo_find()
+    serve(repo, args.socket)
+
+
+def cmd_show_refs(args, repo=None):
+    from commands.ref import show_refs
+    from ref import ref_list
+    from repo import repo_find
+
+    repo = repo or repo_find()
     refs = ref_list(repo)
     show_refs(repo, refs, prefix="refs")
 
 
+def cmd_status(args):
+    from commands.status import status
+    from repo import repo_find
+
+    repo = repo_find()
+    status(repo, args.short, args.jobs)
+
+
 def cmd_tag(args):
+    from commands.ref import show_refs
+    from commands.tag import tag_create
+    from ref import ref_list
+    from repo import repo_find
+
     repo = repo_find()
 
     if args.name:
@@ -178,32 +555,98 @@ def cmd_tag(args):
             type == "object" if args.create_tag_object else "ref",
         )
     else:
-        refs = ref_list(repo)
-        show_refs(repo, refs["tags"], with_hash=False)
+        refs = ref_list(repo, "refs/tags")
+        show_refs(repo, refs, with_hash=False)
 
 
-def main(argv=sys.argv[1:]):
-    args = argparser.parse_args(argv)
+def cmd_write_tree(args):
+    from commands.commit import tree_write
+    from index import index_read, index_write
+    from repo import repo_find
+
+    repo = repo_find()
+    index = index_read(repo)
+    print(tree_write(repo, index))
+    # Keep the trees just computed for next time.
+    index_write(repo, index)
+
+
+def run(args, repo=None):
+    """
+    Run the command parsed in args. The commands pit serve answers run
+    against repo, when given, instead of finding theirs.
+    """
     match args.command:
         case "init":
             cmd_init(args)
+        case "add":
+            cmd_add(args)
         case "cat-file":
-            cmd_cat_file(args)
+            cmd_cat_file(args, repo)
+        case "commit":
+            cmd_commit(args)
+        case "diff-tree":
+            cmd_diff_tree(args)
+        case "fsck":
+            cmd_fsck(args)
         case "hash-object":
             cmd_hash_object(args)
         case "log":
-            cmd_log(args)
+            cmd_log(args, repo)
         case "ls-tree":
-            cmd_ls_tree(args)
+            cmd_ls_tree(args, repo)
         case "checkout":
             cmd_checkout(args)
+        case "repack":
+            cmd_repack(args)
+        case "gc":
+            cmd_gc(args)
+        case "pack-refs":
+            cmd_pack_refs(args)
+        case "commit-graph":
+            cmd_commit_graph(args)
+        case "rev-parse":
+            cmd_rev_parse(args, repo)
+        case "rev-list":
+            cmd_rev_list(args, repo)
+        case "serve":
+            cmd_serve(args)
         case "show-refs":
-            cmd_show_refs(args)
+            cmd_show_refs(args, repo)
+        case "status":
+            cmd_status(args)
         case "tag":
             cmd_tag(args)
+        case "write-tree":
+            cmd_write_tree(args)
         case _:
             print("Bad command.")
 
 
+def main(argv=sys.argv[1:]):
+    args = argparser.parse_args(argv)
+
+    # When a pit serve process has the repository open, let it answer.
+    from rpc import rpc_forward, rpc_forwardable, rpc_socket_find
+
+    if rpc_forwardable(args):
+        sock = rpc_socket_find()
+        if sock:
+            status = rpc_forward(sock, argv)
+            if status is not None:
+                sys.exit(status)
+
+    if args.profile:
+        perf.enable("-")
+    else:
+        perf.enable_from_env()
+    start = time.perf_counter() if perf.enabled else None
+
+    run(args)
+
+    if perf.enabled:
+        perf.record("command." + args.command, start)
+
+
 if __name__ == "__main__":
     main()
@@ -1,13 +1,15 @@
-import os
-import zlib
+import io
 import sys
 import hashlib
 import re
-from repo import repo_file, repo_dir
-from kvlm import kvlm_parse, kvlm_serialize
+import bisect
+from kvlm import kvlm_parse, kvlm_header, kvlm_serialize
 from tree import tree_parse, tree_serialize
 from ref import ref_resolve
+from pack import pack_list, pack_read, pack_info, pack_stream
+from odb import object_store
 from error import GitException
+import perf
 
 
 class GitObject(object):
@@ -51,30 +53,189 @@ class GitCommit(GitObject):
     fmt = b"commit"
 
     def deserialize(self, data):
-        self.kvlm = kvlm_parse(data)
+        # Parsing is deferred: kvlm is only built on first use, and
+        # header() reads single fields without building it.
+        self.raw = data
+        self._kvlm = None
 
     def serialize(self):
-        return kvlm_serialize(self.kvlm)
+        if self._kvlm is None:
+            return self.raw
+        return kvlm_serialize(self._kvlm)
 
     def init(self):
-        self.kvlm = dict()
+        self.raw = None
+        self._kvlm = dict()
+
+    @property
+    def kvlm(self):
+        if self._kvlm is None:
+            self._kvlm = kvlm_parse(self.raw)
+        return self._kvlm
+
+    @kvlm.setter
+    def kvlm(self, kvlm):
+        self._kvlm = kvlm
+
+    def header(self, key):
+        """
+        Return the values of header key, as a list, without decoding
+        the other headers or the message.
+        """
+        if self._kvlm is not None:
+            val = self._kvlm.get(key, [])
+            return val if type(val) == list else [val]
+        return kvlm_header(self.raw, key)
+
+    @property
+    def tree(self):
+        val = self.header(b"tree")
+        return val[0].decode("ascii") if val else None
+
+    @property
+    def parents(self):
+        return [p.decode("ascii") for p in self.header(b"parent")]
 
 
 class GitTag(GitCommit):
     fmt = b"tag"
 
+    @property
+    def object(self):
+        val = self.header(b"object")
+        return val[0].decode("ascii") if val else None
+
 
 class GitTree(GitObject):
     fmt = b"tree"
 
     def deserialize(self, data):
-        self.items = tree_parse(data)
+        # entries reads the raw tree in place. items, a list of leaves
+        # to edit, is only built if someone asks for it.
+        self.entries = tree_parse(data)
+        self._items = None
 
     def serialize(self):
+        if self._items is None:
+            return self.entries.raw
         return tree_serialize(self)
 
     def init(self):
-        self.items = list()
+        self.entries = tree_parse(b"")
+        self._items = list()
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = list(self.entries)
+        return self._items
+
+    @items.setter
+    def items(self, items):
+        self._items = items
+
+
+class GitObjectIndex(object):
+    """
+    The sorted ids of every object of a repository, for prefix
+    lookups and abbreviations in O(log n).
+
+    Packed ids are searched in place in the pack indexes. Loose ids
+    are listed one fan-out directory at a time, the first time a
+    prefix needs it, and kept sorted.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.loose = dict()  # Fan-out directory -> sorted shas.
+
+    def loose_dir(self, fanout):
+        if fanout not in self.loose:
+            self.loose[fanout] = list(object_store(self.repo).iter(fanout))
+
+        return self.loose[fanout]
+
+    def add(self, sha):
+        """Record a newly written loose object."""
+        if sha[0:2] in self.loose:
+            shas = self.loose[sha[0:2]]
+            i = bisect.bisect_left(shas, sha)
+            if i == len(shas) or shas[i] != sha:
+                shas.insert(i, sha)
+
+    def prefix(self, prefix):
+        """Return the sorted shas starting with prefix (at least 2 chars)."""
+        ret = set()
+
+        shas = self.loose_dir(prefix[0:2])
+        i = bisect.bisect_left(shas, prefix)
+        while i < len(shas) and shas[i].startswith(prefix):
+            ret.add(shas[i])
+            i += 1
+
+        for pack in pack_list(self.repo):
+            ret.update(pack.index.prefix(prefix))
+
+        return sorted(ret)
+
+    def neighbors(self, sha):
+        """Yield the ids right before and right after sha, in every source."""
+        shas = self.loose_dir(sha[0:2])
+        i = bisect.bisect_left(shas, sha)
+        if i > 0:
+            yield shas[i - 1]
+        if i < len(shas) and shas[i] == sha:
+            i += 1
+        if i < len(shas):
+            yield shas[i]
+
+        binsha = bytes.fromhex(sha)
+        for pack in pack_list(self.repo):
+            index = pack.index
+            i = index.bisect(binsha)
+            if i > 0:
+                yield index.sha(i - 1).hex()
+            if i < len(index) and index.sha(i) == binsha:
+                i += 1
+            if i < len(index):
+                yield index.sha(i).hex()
+
+    def abbrev(self, sha, min_len=7):
+        """
+        Return the shortest prefix of sha, at least min_len long, that
+        no other object shares.
+        """
+        common = 0
+        for other in self.neighbors(sha):
+            n = 0
+            while n < 40 and sha[n] == other[n]:
+                n += 1
+            common = max(common, n)
+
+        return sha[: max(min_len, common + 1)]
+
+
+def object_index(repo):
+    """Return the object id index of repo, kept on the repository."""
+    if repo.oid_index is None:
+        repo.oid_index = GitObjectIndex(repo)
+
+    return repo.oid_index
+
+
+def object_abbrev(repo, sha, min_len=None):
+    """
+    Return the shortest unique abbreviation of sha, no shorter than
+    min_len, which defaults to core.abbrev (or 7).
+    """
+    if min_len is None:
+        try:
+            min_len = repo.conf.getint("core", "abbrev", fallback=7)
+        except ValueError:
+            # "auto" or "no".
+            min_len = 7
+
+    return object_index(repo).abbrev(sha, max(4, min_len))
 
 
 def object_resolve(repo, name):
@@ -104,16 +265,7 @@ def object_resolve(repo, name):
         # minimal length for git to consider something a short hash.
         # This limit is documented in git-rev-parse.
         name = name.lower()
-        prefix = name[0:2]
-
-        path = repo_dir(repo, "objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works fo full hashes.
-                    candidates.append(prefix + f)
+        candidates.extend(object_index(repo).prefix(name))
 
     # Try for references.
     as_tag = ref_resolve(repo, "refs/tags/" + name)
@@ -150,68 +302,117 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
 
     while True:
-        obj = object_read(repo, sha)
-        #     ^^^^^^^^^^^ < this is a bit agressive: we're reading
-        # the full object just to get its type. And we're doing
-        # that in a loop, albeit normally short. Not very efficient
-        # performance wise.
+        # Only inflate the header to learn the type: the object may be
+        # a huge tree or blob.
+        info = object_info(repo, sha)
+        if not info:
+            raise GitException("No such object {0}.".format(sha))
 
-        if obj.fmt == fmt:
+        if info[0] == fmt:
             return sha
 
         if not follow:
             return None
 
-        # Follow tags
-        if obj.fmt == b"tag":
-            sha = obj.kvlm[b"object"].decode("ascii")
-        elif obj.fmt == b"commit" and fmt == b"tree":
-            sha = obj.kvlm[b"tree"].decode("ascii")
+        # Follow tags. Tags and commits are small, reading them whole
+        # is cheap.
+        if info[0] == b"tag":
+            sha = object_read(repo, sha).object
+        elif info[0] == b"commit" and fmt == b"tree":
+            sha = object_read(repo, sha).tree
         else:
             return None
 
 
+@perf.timed("object_info")
+def object_info(repo, sha):
+    """
+    Return the type and size of object sha, or None if there is no
+    such object. Only the header is inflated.
+    """
+
+    cached = repo.cache.get(sha)
+    if cached:
+        obj, size = cached
+        return obj.fmt, size
+
+    return object_store(repo).info(sha) or pack_info(repo, sha)
+
+
+def object_read_raw(repo, sha):
+    """
+    Read object sha from Git repository repo, looking in its object
+    store first, then in packs. Return its type and its data, or
+    None if there is no such object.
+    """
+
+    return object_store(repo).get(sha) or pack_read(repo, sha)
+
+
+def object_stream(repo, sha):
+    """
+    Open object sha for reading. Return its type, its size, and a
+    stream over its data, or None if there is no such object. The
+    data is inflated as it is read, so this is the way to go for
+    objects that may be big.
+    """
+
+    cached = repo.cache.get(sha)
+    if cached and cached[0].fmt == b"blob":
+        blob, size = cached
+        return blob.fmt, size, io.BytesIO(blob.blobdata)
+
+    return object_store(repo).stream(sha) or pack_stream(repo, sha)
+
+
+@perf.timed("object_read")
 def object_read(repo, sha):
     """
     Read object sha from Git repository repo. Return a
     GitObject whose exact type depends on the object.
+
+    Objects go through the repository's cache, and are shared with
+    every other reader: don't modify them.
     """
 
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    cached = repo.cache.get(sha)
+    if cached:
+        if perf.enabled:
+            perf.count("object_read.cached")
+        return cached[0]
 
-    if not os.path.isfile(path):
+    res = object_read_raw(repo, sha)
+    if not res:
         return None
 
-    with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
-
-        # Read object type
-        x = raw.find(b" ")
-        fmt = raw[0:x]
-
-        # Read and validate object size
-        y = raw.find(b"\x00", x)
-        size = int(raw[x:y].decode("ascii"))
-        if size != len(raw) - y - 1:
-            raise GitException(f"Malformed object {sha}: bad length")
-
-        # Pick constructor
-        match fmt:
-            case b"commit":
-                c = GitCommit
-            case b"tree":
-                c = GitTree
-            case b"tag":
-                c = GitTag
-            case b"blob":
-                c = GitBlob
-            case _:
-                raise GitException(
-                    "Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha)
-                )
-
-        # Call constructor and return object
-        return c(raw[y + 1 :])
+    fmt, data = res
+    if perf.enabled:
+        perf.count("object_read." + fmt.decode("ascii"))
+
+    # Pick constructor
+    match fmt:
+        case b"commit":
+            c = GitCommit
+        case b"tree":
+            c = GitTree
+        case b"tag":
+            c = GitTag
+        case b"blob":
+            c = GitBlob
+        case _:
+            raise GitException(
+                "Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha)
+            )
+
+    # Call constructor, cache and return object
+    obj = c(data)
+    repo.cache.put(sha, obj, len(data))
+    return obj
+
+
+def object_list_loose(repo):
+    """Iterate over the shas of every unpacked object of repo."""
+    return object_store(repo).iter()
 
 
 def object_write(obj, repo=None):
@@ -227,12 +428,8 @@ def object_write(obj, repo=None):
     sha = hashlib.sha1(result).hexdigest()
 
     if repo:
-        # Compute path
-        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
-
-        if not os.path.exists(path):
-            with open(path, "wb") as f:
-                # Compress and write
-                f.write(zlib.compress(result))
+        object_store(repo).put(sha, obj.fmt, data)
+        if repo.oid_index is not None:
+            repo.oid_index.add(sha)
 
     return sha
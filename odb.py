@@ -0,0 +1,577 @@
+import io
+import os
+import zlib
+import bisect
+import threading
+import contextlib
+from pack import GitPackWriter
+from repo import repo_dir, repo_path
+from stream import InflateStream, STREAM_CHUNK
+from error import GitException
+import perf
+
+
+class GitObjectStore(object):
+    """
+    Where objects that are not in packs live. Packs are shared by every
+    store, and searched after it.
+
+    Objects go in and out as their type and data, without the header
+    git hashes them with. shas are hex strings.
+    """
+
+    # Whether another process opening the same repository sees the
+    # objects of this store.
+    shared = True
+
+    def get(self, sha):
+        """Return the type and data of object sha, or None."""
+        raise NotImplementedError
+
+    def put(self, sha, fmt, data):
+        """Store object sha. Storing an object twice is harmless."""
+        raise NotImplementedError
+
+    def has(self, sha):
+        raise NotImplementedError
+
+    def info(self, sha):
+        """Return the type and size of object sha, or None."""
+        res = self.get(sha)
+        return (res[0], len(res[1])) if res else None
+
+    def stream(self, sha):
+        """
+        Return the type, size and a stream over the data of object sha,
+        or None. Stores that can should avoid holding big objects in
+        memory.
+        """
+        res = self.get(sha)
+        return (res[0], len(res[1]), io.BytesIO(res[1])) if res else None
+
+    def iter(self, prefix=""):
+        """Iterate over the shas starting with prefix, in order."""
+        raise NotImplementedError
+
+    def remove(self, shas):
+        """Forget objects, once they are safely packed."""
+        raise NotImplementedError
+
+    def batch(self):
+        """
+        Return a context manager grouping the writes made under it.
+        Stores that can make them faster, or atomic, together.
+        """
+        return contextlib.nullcontext()
+
+    def close(self):
+        """Release what the store keeps open. It isn't used afterwards."""
+        pass
+
+
+class GitLooseStore(GitObjectStore):
+    """
+    Git's own store: each object zlib-compressed, with its header, in
+    a file named after its sha in a fan-out directory.
+
+    Objects are written to a temporary file, renamed into place once
+    complete. With fsync set, each file is synced before its rename.
+    Inside batch(), known fan-out directories aren't checked again,
+    and an object is only looked for the first time it is written,
+    and not at all in a directory the batch created. With fsync_batch
+    also set, the syncs are grouped: every FSYNC_BATCH objects, all
+    the files are synced, renamed into place, then each directory
+    they went to is synced once. Until then, they are read from their
+    temporary files.
+    """
+
+    FSYNC_BATCH = 512
+
+    def __init__(self, path, fsync=False, fsync_batch=False):
+        self.path = path
+        self.fsync = fsync
+        self.fsync_batch = fsync_batch
+        self.depth = 0  # Nested batches.
+        self.dirs = set()  # Fan-out directories known to exist.
+        self.created = set()  # The ones this batch created: empty.
+        self.written = set()  # Objects written by this batch.
+        self.pending = dict()  # sha -> (fd, temporary file, path) to sync.
+
+    def file(self, sha):
+        return os.path.join(self.path, sha[0:2], sha[2:])
+
+    def open(self, sha):
+        """
+        Open the file of sha for reading, under its temporary name if it
+        is waiting for a grouped sync.
+        """
+        pending = self.pending.get(sha)
+        return open(pending[1] if pending else self.file(sha), "rb")
+
+    def get(self, sha):
+        try:
+            with self.open(sha) as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        raw = zlib.decompress(data)
+        if perf.enabled:
+            perf.count("bytes.read", len(data))
+            perf.count("bytes.inflated", len(raw))
+
+        # Read object type
+        x = raw.find(b" ")
+        fmt = raw[0:x]
+
+        # Read and validate object size
+        y = raw.find(b"\x00", x)
+        size = int(raw[x:y].decode("ascii"))
+        if size != len(raw) - y - 1:
+            raise GitException(f"Malformed object {sha}: bad length")
+
+        return fmt, raw[y + 1 :]
+
+    def put(self, sha, fmt, data):
+        path = self.file(sha)
+        if self.depth:
+            if sha in self.written:
+                return
+            self.written.add(sha)
+            fanout = sha[0:2]
+            if fanout not in self.dirs:
+                try:
+                    os.makedirs(os.path.dirname(path))
+                    self.created.add(fanout)
+                except FileExistsError:
+                    pass
+                self.dirs.add(fanout)
+            # One stat the first time sha comes, rather than deflating
+            # and writing it again. A directory of ours holds nothing
+            # from before the batch.
+            if fanout not in self.created and os.path.exists(path):
+                return
+        else:
+            if os.path.exists(path):
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Git keeps objects read-only.
+        tmp = "{0}.tmp{1}".format(path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o444)
+        try:
+            view = memoryview(zlib.compress(b"%s %d\x00" % (fmt, len(data)) + data))
+            while view:
+                view = view[os.write(fd, view) :]
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp)
+            raise
+
+        if self.fsync and self.fsync_batch and self.depth:
+            self.pending[sha] = (fd, tmp, path)
+            if len(self.pending) >= self.FSYNC_BATCH:
+                self.flush()
+            return
+
+        if self.fsync:
+            os.fsync(fd)
+        os.close(fd)
+        os.replace(tmp, path)
+
+    def flush(self):
+        """Sync, then rename, the objects waiting for a grouped sync."""
+        dirs = set()
+        for fd, tmp, path in self.pending.values():
+            os.fsync(fd)
+            os.close(fd)
+        for fd, tmp, path in self.pending.values():
+            os.replace(tmp, path)
+            dirs.add(os.path.dirname(path))
+        self.pending.clear()
+
+        # Make the renames durable too.
+        for path in dirs:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                # Objects never change: whatever was written is good to
+                # keep, even if the batch failed.
+                self.flush()
+                self.dirs.clear()
+                self.created.clear()
+                self.written.clear()
+
+    def has(self, sha):
+        return sha in self.pending or os.path.isfile(self.file(sha))
+
+    def info(self, sha):
+        # Only inflate the header: the object may be a huge blob.
+        try:
+            f = self.open(sha)
+        except FileNotFoundError:
+            return None
+
+        d = zlib.decompressobj()
+        head = b""
+        with f:
+            while b"\x00" not in head:
+                chunk = f.read(64)
+                if not chunk:
+                    raise GitException(f"Malformed object {sha}: no header")
+                head += d.decompress(chunk)
+
+        fmt, size = head[: head.find(b"\x00")].split(b" ")
+        return fmt, int(size.decode("ascii"))
+
+    def stream(self, sha):
+        try:
+            f = self.open(sha)
+        except FileNotFoundError:
+            return None
+        stream = InflateStream(lambda: f.read(STREAM_CHUNK), on_close=f.close)
+
+        # Inflate just enough to read the header, and push back whatever
+        # came after it.
+        head = b""
+        while b"\x00" not in head:
+            chunk = stream.read(64)
+            if not chunk:
+                stream.close()
+                raise GitException(f"Malformed object {sha}: no header")
+            head += chunk
+        header, rest = head.split(b"\x00", 1)
+        stream.unread(rest)
+
+        fmt, size = header.split(b" ")
+        size = int(size.decode("ascii"))
+        # The stream counted the header too.
+        stream.size = len(header) + 1 + size
+
+        return fmt, size, stream
+
+    def iter(self, prefix=""):
+        if not os.path.isdir(self.path):
+            return
+
+        if len(prefix) >= 2:
+            fanouts = [prefix[0:2]]
+        else:
+            # Skip pack/, info/ and such.
+            fanouts = sorted(
+                f
+                for f in os.listdir(self.path)
+                if len(f) == 2 and f.startswith(prefix)
+            )
+
+        for fanout in fanouts:
+            path = os.path.join(self.path, fanout)
+            if not os.path.isdir(path):
+                continue
+            for f in sorted(os.listdir(path)):
+                if len(f) == 38 and (fanout + f).startswith(prefix):
+                    yield fanout + f
+
+    def remove(self, shas):
+        fanouts = set()
+        for sha in shas:
+            try:
+                os.remove(self.file(sha))
+            except FileNotFoundError:
+                continue
+            fanouts.add(sha[0:2])
+
+        # Drop the fan-out directories we emptied.
+        for fanout in fanouts:
+            path = os.path.join(self.path, fanout)
+            if not os.listdir(path):
+                os.rmdir(path)
+
+
+class GitMemoryStore(GitObjectStore):
+    """
+    Objects kept in a dict, for the life of the repository object: for
+    tests, and pipelines whose objects are thrown away or packed at
+    the end.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self.objects = dict()
+        self.sorted = None  # The shas, sorted, until the next put.
+
+    def get(self, sha):
+        return self.objects.get(sha)
+
+    def put(self, sha, fmt, data):
+        if sha not in self.objects:
+            self.objects[sha] = (fmt, bytes(data))
+            self.sorted = None
+
+    def has(self, sha):
+        return sha in self.objects
+
+    def info(self, sha):
+        res = self.objects.get(sha)
+        return (res[0], len(res[1])) if res else None
+
+    def iter(self, prefix=""):
+        if self.sorted is None:
+            self.sorted = sorted(self.objects)
+        shas = self.sorted
+        i = bisect.bisect_left(shas, prefix)
+        while i < len(shas) and shas[i].startswith(prefix):
+            yield shas[i]
+            i += 1
+
+    def remove(self, shas):
+        for sha in shas:
+            if self.objects.pop(sha, None):
+                self.sorted = None
+
+
+class GitSQLiteStore(GitObjectStore):
+    """
+    Objects in a single SQLite file, zlib-compressed like loose objects,
+    one row each. Writing an object doesn't create a file, and a batch
+    of writes is one transaction: committed whole, or not at all.
+
+    SQLite connections can't be shared between threads: each thread,
+    like the workers of a parallel checkout, opens its own, with its
+    own batches.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connections = list()
+        self.lock = threading.Lock()
+        # Create the table now, in the calling thread.
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            "sha TEXT PRIMARY KEY, type TEXT, size INTEGER, data BLOB"
+            ") WITHOUT ROWID"
+        )
+
+    @property
+    def db(self):
+        """The connection of the calling thread, opened on first use."""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            # Only repositories using this store pay for importing sqlite3.
+            import sqlite3
+
+            # We run the transactions ourselves. close() may come from
+            # another thread.
+            db = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            db.execute("PRAGMA journal_mode=WAL")
+            self.local.db = db
+            self.local.depth = 0  # Nested batches.
+            with self.lock:
+                self.connections.append(db)
+        return db
+
+    @property
+    def depth(self):
+        return getattr(self.local, "depth", 0)
+
+    @depth.setter
+    def depth(self, value):
+        self.local.depth = value
+
+    def close(self):
+        """Close the connections of every thread."""
+        with self.lock:
+            for db in self.connections:
+                db.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+    def get(self, sha):
+        row = self.db.execute(
+            "SELECT type, data FROM objects WHERE sha = ?", (sha,)
+        ).fetchone()
+        if not row:
+            return None
+        data = zlib.decompress(row[1])
+        if perf.enabled:
+            perf.count("bytes.read", len(row[1]))
+            perf.count("bytes.inflated", len(data))
+        return row[0].encode("ascii"), data
+
+    def put(self, sha, fmt, data):
+        self.db.execute(
+            "INSERT OR IGNORE INTO objects VALUES (?, ?, ?, ?)",
+            (sha, fmt.decode("ascii"), len(data), zlib.compress(data)),
+        )
+
+    def has(self, sha):
+        row = self.db.execute("SELECT 1 FROM objects WHERE sha = ?", (sha,))
+        return row.fetchone() is not None
+
+    def info(self, sha):
+        row = self.db.execute(
+            "SELECT type, size FROM objects WHERE sha = ?", (sha,)
+        ).fetchone()
+        return (row[0].encode("ascii"), row[1]) if row else None
+
+    def iter(self, prefix=""):
+        # "g" sorts after every hex digit: this is a range scan on the
+        # primary key.
+        rows = self.db.execute(
+            "SELECT sha FROM objects WHERE sha >= ? AND sha < ? ORDER BY sha",
+            (prefix, prefix + "g"),
+        )
+        for row in rows:
+            yield row[0]
+
+    def remove(self, shas):
+        with self.batch():
+            self.db.executemany(
+                "DELETE FROM objects WHERE sha = ?", ((sha,) for sha in shas)
+            )
+
+    @contextlib.contextmanager
+    def batch(self):
+        if self.depth:
+            # Part of an outer batch.
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+            return
+
+        self.db.execute("BEGIN")
+        self.depth = 1
+        try:
+            yield
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        else:
+            self.db.execute("COMMIT")
+        finally:
+            self.depth = 0
+
+
+class GitPackingStore(GitObjectStore):
+    """
+    The store of object_batch in pack mode: new objects go into the
+    pack being written, everything else to the store underneath. The
+    new objects are read back from the unfinished pack.
+    """
+
+    shared = False
+
+    def __init__(self, writer, store):
+        self.writer = writer
+        self.store = store
+        self.sizes = dict()  # sha -> (type, size) of the new objects.
+
+    def get(self, sha):
+        if sha in self.writer:
+            return self.writer.read(sha)
+        return self.store.get(sha)
+
+    def put(self, sha, fmt, data):
+        if sha not in self.writer:
+            self.writer.add(sha, fmt, data)
+            self.sizes[sha] = (fmt, len(data))
+
+    def has(self, sha):
+        return sha in self.writer or self.store.has(sha)
+
+    def info(self, sha):
+        return self.sizes.get(sha) or self.store.info(sha)
+
+    def stream(self, sha):
+        if sha in self.writer:
+            return super().stream(sha)
+        return self.store.stream(sha)
+
+    def iter(self, prefix=""):
+        return self.store.iter(prefix)
+
+    def remove(self, shas):
+        self.store.remove(shas)
+
+
+def object_store(repo):
+    """
+    Return the object store of repo, opened on first use and kept on
+    the repository. pit.objectStore picks it: loose (the default, and
+    the only one git reads), memory or sqlite. The SQLite file is
+    pit.objectStorePath, or objects/pit.sqlite in the gitdir. Loose
+    objects are synced to disk if core.fsyncObjectFiles is set, in
+    groups if core.fsyncMethod is batch.
+    """
+    if repo.odb is None:
+        kind = repo.conf.get("pit", "objectStore", fallback="loose").lower()
+        match kind:
+            case "loose":
+                repo.odb = GitLooseStore(
+                    repo_path(repo, "objects"),
+                    repo.conf.getboolean("core", "fsyncObjectFiles", fallback=False),
+                    repo.conf.get("core", "fsyncMethod", fallback="") == "batch",
+                )
+            case "memory":
+                repo.odb = GitMemoryStore()
+            case "sqlite":
+                path = repo.conf.get("pit", "objectStorePath")
+                if path:
+                    path = os.path.join(repo.worktree, os.path.expanduser(path))
+                else:
+                    path = os.path.join(
+                        repo_dir(repo, "objects", mkdir=True), "pit.sqlite"
+                    )
+                repo.odb = GitSQLiteStore(path)
+            case _:
+                raise GitException("Unknown pit.objectStore {0}".format(kind))
+
+    return repo.odb
+
+
+@contextlib.contextmanager
+def object_batch(repo, pack=False):
+    """
+    Group the object writes of repo made under it, for bulk imports:
+    see the batch() of each store. With pack set, new objects are
+    written straight into a new pack instead, which shows up once the
+    block is done, and is thrown away if it fails.
+    """
+    store = object_store(repo)
+    if not pack:
+        with store.batch():
+            yield
+        return
+
+    writer = GitPackWriter(repo)
+    repo.odb = GitPackingStore(writer, store)
+    try:
+        yield
+    except BaseException:
+        writer.abort()
+        raise
+    else:
+        if len(writer):
+            writer.close()
+        else:
+            writer.abort()
+    finally:
+        repo.odb = store
+        # Abbreviations may have seen objects that went to the pack.
+        repo.oid_index = None
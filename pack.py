@@ -0,0 +1,768 @@
+import io
+import os
+import mmap
+import struct
+import zlib
+import hashlib
+import tempfile
+from repo import repo_dir
+from stream import InflateStream, STREAM_CHUNK
+from error import GitException
+import perf
+
+# Object types, as stored in the 3 bits of a pack entry header.
+PACK_OBJ_COMMIT = 1
+PACK_OBJ_TREE = 2
+PACK_OBJ_BLOB = 3
+PACK_OBJ_TAG = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+PACK_TYPES = {
+    PACK_OBJ_COMMIT: b"commit",
+    PACK_OBJ_TREE: b"tree",
+    PACK_OBJ_BLOB: b"blob",
+    PACK_OBJ_TAG: b"tag",
+}
+
+# And the other way around, for writing.
+PACK_CODES = {fmt: typ for typ, fmt in PACK_TYPES.items()}
+
+IDX_MAGIC = b"\377tOc"
+PACK_MAGIC = b"PACK"
+
+
+class GitPackIndex(object):
+    """
+    A version 2 pack index (.idx) file.
+
+    The file is memory-mapped: we never read it as a whole, we only
+    touch the fanout table and the few sha records a binary search
+    goes through.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[0:4] != IDX_MAGIC:
+            raise GitException("Unsupported pack index {0}".format(path))
+        vers = struct.unpack_from(">I", self.map, 4)[0]
+        if vers != 2:
+            raise GitException(
+                "Unsupported pack index version {0} in {1}".format(vers, path)
+            )
+
+        # The fanout table: entry N is the number of objects whose
+        # first sha byte is <= N. The last one is the object count.
+        self.fanout = struct.unpack_from(">256I", self.map, 8)
+        self.count = self.fanout[255]
+
+        # Then come three tables, one record per object: the sorted
+        # binary shas, their crc32 and their 4-bytes pack offsets.
+        # Offsets that don't fit in 31 bits point into a fourth table
+        # of 8-bytes offsets.
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = self.offset_table + 4 * self.count
+
+    def __len__(self):
+        return self.count
+
+    def sha(self, i):
+        """Return the binary sha of the i-th object."""
+        pos = self.sha_table + 20 * i
+        return self.map[pos : pos + 20]
+
+    def offset(self, i):
+        """Return the pack offset of the i-th object."""
+        ofs = struct.unpack_from(">I", self.map, self.offset_table + 4 * i)[0]
+        if ofs & 0x80000000:
+            ofs = struct.unpack_from(
+                ">Q", self.map, self.large_offset_table + 8 * (ofs & 0x7FFFFFFF)
+            )[0]
+        return ofs
+
+    def bisect(self, binsha):
+        """
+        Return the position of the first object whose sha is >=
+        binsha. Only the slice of the fanout table for the first
+        byte is searched.
+        """
+        first = binsha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha(mid) < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def find(self, sha):
+        """Return the pack offset of object sha, or None."""
+        binsha = bytes.fromhex(sha)
+        i = self.bisect(binsha)
+        if i < self.count and self.sha(i) == binsha:
+            return self.offset(i)
+        return None
+
+    def __iter__(self):
+        """Iterate over the hex shas of this index, in order."""
+        for i in range(self.count):
+            yield self.sha(i).hex()
+
+    def prefix(self, prefix):
+        """Return every hex sha of this index starting with prefix."""
+        # Pad the prefix with zeroes to get the smallest sha it could
+        # match, then scan forward while it still matches.
+        low = bytes.fromhex((prefix + "0" * 40)[:40])
+        ret = list()
+
+        i = self.bisect(low)
+        while i < self.count:
+            sha = self.sha(i).hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            i += 1
+
+        return ret
+
+
+class GitPack(object):
+    """A packfile and its index."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = GitPackIndex(path[: -len(".pack")] + ".idx")
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        if self.map[0:4] != PACK_MAGIC:
+            raise GitException("Not a packfile {0}".format(path))
+        vers, count = struct.unpack_from(">II", self.map, 4)
+        if vers not in (2, 3):
+            raise GitException(
+                "Unsupported pack version {0} in {1}".format(vers, path)
+            )
+        if count != len(self.index):
+            raise GitException("Pack and index disagree for {0}".format(path))
+
+    def entry_header(self, offset):
+        """
+        Parse the header of the entry at offset. Return its type, its
+        (inflated) size, and the position right after the header.
+        """
+        c = self.map[offset]
+        offset += 1
+        typ = (c >> 4) & 7
+        size = c & 0x0F
+        shift = 4
+        while c & 0x80:
+            c = self.map[offset]
+            offset += 1
+            size |= (c & 0x7F) << shift
+            shift += 7
+
+        return typ, size, offset
+
+    def delta_base(self, typ, offset, pos):
+        """
+        Read the base reference of a delta entry starting at pos (just
+        after its header). Return the base, either as a pack offset
+        (OFS_DELTA) or a hex sha (REF_DELTA), and the position of the
+        compressed delta data.
+        """
+        if typ == PACK_OBJ_REF_DELTA:
+            return self.map[pos : pos + 20].hex(), pos + 20
+
+        # OFS_DELTA: a big-endian base-128 number, with one added to
+        # every byte but the last one, to be subtracted from our own
+        # offset.
+        c = self.map[pos]
+        pos += 1
+        ofs = c & 0x7F
+        while c & 0x80:
+            c = self.map[pos]
+            pos += 1
+            ofs = ((ofs + 1) << 7) | (c & 0x7F)
+
+        return offset - ofs, pos
+
+    def inflate(self, pos, size):
+        """Inflate the zlib stream starting at pos."""
+        d = zlib.decompressobj()
+        chunks = list()
+        start = pos
+        # Compressed data is almost never bigger than its inflated
+        # size plus a few bytes, so the first chunk is usually the
+        # only one.
+        step = min(size + 64, STREAM_CHUNK)
+
+        while not d.eof:
+            chunk = self.view[pos : pos + step]
+            if not chunk:
+                raise GitException("Truncated pack entry in {0}".format(self.path))
+            chunks.append(d.decompress(chunk))
+            pos += step
+            step = STREAM_CHUNK
+
+        data = b"".join(chunks)
+        if perf.enabled:
+            perf.count("bytes.read", pos - len(d.unused_data) - start)
+            perf.count("bytes.inflated", len(data))
+        if len(data) != size:
+            raise GitException(
+                "Malformed pack entry in {0}: bad length".format(self.path)
+            )
+        return data
+
+    def read(self, repo, offset):
+        """
+        Read the entry at offset. Return its type and data, with any
+        delta chain resolved.
+        """
+        # Walk down the chain to its base, remembering each delta on
+        # the way. Chains can be long, so this is a loop rather than
+        # recursion.
+        deltas = list()
+        while True:
+            typ, size, pos = self.entry_header(offset)
+
+            if typ in PACK_TYPES:
+                fmt = PACK_TYPES[typ]
+                data = self.inflate(pos, size)
+                break
+
+            if typ not in (PACK_OBJ_OFS_DELTA, PACK_OBJ_REF_DELTA):
+                raise GitException(
+                    "Unknown pack entry type {0} in {1}".format(typ, self.path)
+                )
+
+            base, pos = self.delta_base(typ, offset, pos)
+            deltas.append(self.inflate(pos, size))
+
+            if typ == PACK_OBJ_OFS_DELTA:
+                offset = base
+                continue
+
+            base_offset = self.index.find(base)
+            if base_offset is not None:
+                offset = base_offset
+                continue
+
+            # The base lives in another pack.
+            res = pack_read(repo, base)
+            if not res:
+                raise GitException(
+                    "Missing delta base {0} in {1}".format(base, self.path)
+                )
+            fmt, data = res
+            break
+
+        # Now replay the deltas, the closest to the base first.
+        for delta in reversed(deltas):
+            data = delta_apply(data, delta)
+
+        return fmt, data
+
+    def info(self, repo, offset):
+        """
+        Return the type and size of the entry at offset, without
+        inflating it. For a delta, the size is read from the first
+        bytes of the delta, and the type from the headers down the
+        chain.
+        """
+        typ, size, pos = self.entry_header(offset)
+        if typ in PACK_TYPES:
+            return PACK_TYPES[typ], size
+
+        # A delta starts with the size of its base, then the size of
+        # its result, each at most 10 bytes long.
+        base, pos = self.delta_base(typ, offset, pos)
+        d = zlib.decompressobj()
+        head = b""
+        while len(head) < 20 and not d.eof:
+            chunk = self.view[pos : pos + 64]
+            if not chunk:
+                raise GitException("Truncated pack entry in {0}".format(self.path))
+            head += d.decompress(chunk)
+            pos += 64
+        _, i = delta_read_size(head, 0)
+        size, _ = delta_read_size(head, i)
+
+        while True:
+            if typ == PACK_OBJ_REF_DELTA:
+                offset = self.index.find(base)
+                if offset is None:
+                    # The base lives in another pack.
+                    res = pack_info(repo, base)
+                    if not res:
+                        raise GitException(
+                            "Missing delta base {0} in {1}".format(base, self.path)
+                        )
+                    return res[0], size
+            else:
+                offset = base
+
+            typ, _, pos = self.entry_header(offset)
+            if typ in PACK_TYPES:
+                return PACK_TYPES[typ], size
+            base, _ = self.delta_base(typ, offset, pos)
+
+    def stream(self, repo, offset):
+        """
+        Return the type and size of the entry at offset, and a stream
+        over its data. Only whole objects are inflated incrementally:
+        deltas need their full base anyway.
+        """
+        typ, size, pos = self.entry_header(offset)
+
+        if typ not in PACK_TYPES:
+            fmt, data = self.read(repo, offset)
+            return fmt, len(data), io.BytesIO(data)
+
+        def source():
+            nonlocal pos
+            chunk = self.view[pos : pos + STREAM_CHUNK]
+            pos += len(chunk)
+            return chunk
+
+        return PACK_TYPES[typ], size, InflateStream(source, size)
+
+
+def delta_read_size(delta, pos):
+    """Read one of the two size varints at the start of a delta."""
+    size = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        size |= (c & 0x7F) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+
+def delta_apply(base, delta):
+    """Apply a git delta to base, and return the result."""
+    src_size, pos = delta_read_size(delta, 0)
+    dst_size, pos = delta_read_size(delta, pos)
+    if src_size != len(base):
+        raise GitException("Delta base size mismatch")
+
+    out = list()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+
+        if op & 0x80:
+            # Copy from base. The low 4 bits tell which offset bytes
+            # follow, the next 3 which size bytes do.
+            ofs = 0
+            for i in range(4):
+                if op & (1 << i):
+                    ofs |= delta[pos] << (8 * i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out.append(base[ofs : ofs + size])
+        elif op:
+            # Insert the next op bytes verbatim.
+            out.append(delta[pos : pos + op])
+            pos += op
+        else:
+            raise GitException("Invalid delta opcode 0")
+
+    ret = b"".join(out)
+    if len(ret) != dst_size:
+        raise GitException("Delta result size mismatch")
+    return ret
+
+
+# Blocks of the base shorter than this are never matched.
+DELTA_BLOCK = 16
+
+
+def delta_write_size(size):
+    """Encode one of the two size varints at the start of a delta."""
+    out = bytearray()
+    while True:
+        c = size & 0x7F
+        size >>= 7
+        if size:
+            out.append(c | 0x80)
+        else:
+            out.append(c)
+            return bytes(out)
+
+
+def delta_copy(ofs, size):
+    """Encode a copy-from-base instruction, omitting zero bytes."""
+    op = 0x80
+    args = bytearray()
+    for i in range(4):
+        b = (ofs >> (8 * i)) & 0xFF
+        if b:
+            op |= 1 << i
+            args.append(b)
+    for i in range(3):
+        b = (size >> (8 * i)) & 0xFF
+        if b:
+            op |= 0x10 << i
+            args.append(b)
+
+    return bytes([op]) + args
+
+
+def delta_index(base):
+    """
+    Index base for delta_create: map every aligned DELTA_BLOCK bytes
+    block to its offset. When a block repeats, the first one wins.
+    """
+    index = dict()
+    last = len(base) - len(base) % DELTA_BLOCK - DELTA_BLOCK
+    for i in range(last, -1, -DELTA_BLOCK):
+        index[base[i : i + DELTA_BLOCK]] = i
+
+    return index
+
+
+def delta_create(base, target, index=None, max_size=None):
+    """
+    Compute a git delta turning base into target. index is the
+    result of delta_index(base), which callers trying several targets
+    against the same base should compute once.
+
+    Return None if the delta would be bigger than max_size.
+    """
+    if index is None:
+        index = delta_index(base)
+
+    out = [delta_write_size(len(base)), delta_write_size(len(target))]
+    size = len(out[0]) + len(out[1])
+
+    def literal(start, stop):
+        # Insert instructions carry at most 127 bytes.
+        n = 0
+        for i in range(start, stop, 0x7F):
+            chunk = target[i : min(i + 0x7F, stop)]
+            out.append(bytes([len(chunk)]))
+            out.append(chunk)
+            n += 1 + len(chunk)
+        return n
+
+    tlen = len(target)
+    blen = len(base)
+    pos = 0
+    lit = 0  # Start of the bytes not covered by any instruction yet.
+    while pos + DELTA_BLOCK <= tlen:
+        ofs = index.get(target[pos : pos + DELTA_BLOCK])
+        if ofs is None:
+            pos += 1
+            continue
+
+        # Extend the match backward, over bytes we were going to
+        # insert literally...
+        start, bstart = pos, ofs
+        while start > lit and bstart > 0 and target[start - 1] == base[bstart - 1]:
+            start -= 1
+            bstart -= 1
+
+        # ...and forward, a block at a time first.
+        stop, bstop = pos + DELTA_BLOCK, ofs + DELTA_BLOCK
+        while (
+            stop + 64 <= tlen
+            and bstop + 64 <= blen
+            and target[stop : stop + 64] == base[bstop : bstop + 64]
+        ):
+            stop += 64
+            bstop += 64
+        while stop < tlen and bstop < blen and target[stop] == base[bstop]:
+            stop += 1
+            bstop += 1
+
+        size += literal(lit, start)
+        # A copy instruction holds at most 24 bits of size.
+        while start < stop:
+            n = min(stop - start, 0xFFFFFF)
+            op = delta_copy(bstart, n)
+            out.append(op)
+            size += len(op)
+            start += n
+            bstart += n
+
+        pos = lit = stop
+        if max_size is not None and size > max_size:
+            return None
+
+    size += literal(lit, tlen)
+    if max_size is not None and size > max_size:
+        return None
+
+    return b"".join(out)
+
+
+def pack_entry_header(typ, size):
+    """Encode a pack entry header: type and inflated size."""
+    c = (typ << 4) | (size & 0x0F)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(c | 0x80)
+        c = size & 0x7F
+        size >>= 7
+    out.append(c)
+
+    return bytes(out)
+
+
+def pack_delta_offset(ofs):
+    """Encode the distance from an OFS_DELTA entry back to its base."""
+    out = [ofs & 0x7F]
+    ofs >>= 7
+    while ofs:
+        ofs -= 1
+        out.append(0x80 | (ofs & 0x7F))
+        ofs >>= 7
+
+    return bytes(reversed(out))
+
+
+class GitPackWriter(object):
+    """
+    Write a new pack, one object at a time, then its index.
+
+    Objects are written to a temporary file in objects/pack, which is
+    only renamed to pack-<sha>.pack once complete, so readers never
+    see a partial pack.
+    """
+
+    def __init__(self, repo, count=0):
+        self.repo = repo
+        self.dir = repo_dir(repo, "objects", "pack", mkdir=True)
+        fd, self.tmp = tempfile.mkstemp(prefix="tmp_pack_", dir=self.dir)
+        self.f = os.fdopen(fd, "wb")
+        self.hash = hashlib.sha1()
+        # The header holds the object count. If the caller doesn't
+        # know it upfront, close() fixes the header afterwards.
+        self.count = count
+        self.offset = 0
+        self.entries = dict()  # sha -> (offset, crc32)
+
+        self.write(PACK_MAGIC + struct.pack(">II", 2, count))
+
+    def __contains__(self, sha):
+        return sha in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def write(self, data):
+        self.f.write(data)
+        self.hash.update(data)
+        self.offset += len(data)
+
+    def add(self, sha, fmt, data, base=None):
+        """
+        Add object sha to the pack. If base is given, data is a delta
+        against base, which must have been added already.
+        """
+        offset = self.offset
+
+        if base is None:
+            header = pack_entry_header(PACK_CODES[fmt], len(data))
+        else:
+            header = pack_entry_header(
+                PACK_OBJ_OFS_DELTA, len(data)
+            ) + pack_delta_offset(offset - self.entries[base][0])
+
+        entry = header + zlib.compress(data)
+        self.write(entry)
+        self.entries[sha] = (offset, zlib.crc32(entry))
+
+    def read(self, sha):
+        """
+        Read object sha back from the unfinished pack, as its type and
+        data. Only objects added without a base can be.
+        """
+        offset, _ = self.entries[sha]
+        self.f.flush()
+        with open(self.tmp, "rb") as f:
+            f.seek(offset)
+            c = f.read(1)[0]
+            typ = (c >> 4) & 7
+            size = c & 0x0F
+            shift = 4
+            while c & 0x80:
+                c = f.read(1)[0]
+                size |= (c & 0x7F) << shift
+                shift += 7
+            if typ not in PACK_TYPES:
+                raise GitException(
+                    "Can't read delta {0} from an unfinished pack".format(sha)
+                )
+
+            d = zlib.decompressobj()
+            chunks = list()
+            while not d.eof:
+                chunk = f.read(STREAM_CHUNK)
+                if not chunk:
+                    raise GitException("Truncated pack entry {0}".format(sha))
+                chunks.append(d.decompress(chunk))
+
+        data = b"".join(chunks)
+        if len(data) != size:
+            raise GitException("Malformed pack entry {0}: bad length".format(sha))
+        return PACK_TYPES[typ], data
+
+    def close(self):
+        """Finish the pack, write its index and return the pack path."""
+        if self.count != len(self.entries):
+            # Patch the header, and hash the whole pack again.
+            self.f.seek(8)
+            self.f.write(struct.pack(">I", len(self.entries)))
+            self.f.flush()
+            self.hash = hashlib.sha1()
+            with open(self.tmp, "rb") as f:
+                for chunk in iter(lambda: f.read(STREAM_CHUNK), b""):
+                    self.hash.update(chunk)
+            self.f.seek(0, os.SEEK_END)
+
+        checksum = self.hash.digest()
+        self.f.write(checksum)
+        self.f.close()
+
+        base = os.path.join(self.dir, "pack-" + checksum.hex())
+        os.chmod(self.tmp, 0o444)
+        os.replace(self.tmp, base + ".pack")
+        pack_index_write(base + ".idx", self.entries, checksum)
+
+        # Let the next lookup pick up the new pack.
+        self.repo.packs = None
+
+        return base + ".pack"
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp)
+
+
+def pack_index_write(path, entries, checksum):
+    """
+    Write a version 2 pack index. entries maps hex shas to their
+    offset and crc32 in the pack whose checksum is given.
+    """
+    shas = sorted(entries)
+    h = hashlib.sha1()
+    out = list()
+
+    out.append(IDX_MAGIC + struct.pack(">I", 2))
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    total = 0
+    for i in range(256):
+        total += fanout[i]
+        fanout[i] = total
+    out.append(struct.pack(">256I", *fanout))
+
+    out.append(b"".join(bytes.fromhex(sha) for sha in shas))
+    out.append(b"".join(struct.pack(">I", entries[sha][1]) for sha in shas))
+
+    # Offsets past 2GB go into a second table.
+    offsets = list()
+    large = list()
+    for sha in shas:
+        ofs = entries[sha][0]
+        if ofs < 0x80000000:
+            offsets.append(struct.pack(">I", ofs))
+        else:
+            offsets.append(struct.pack(">I", 0x80000000 | len(large)))
+            large.append(struct.pack(">Q", ofs))
+    out.append(b"".join(offsets))
+    out.append(b"".join(large))
+    out.append(checksum)
+
+    data = b"".join(out)
+    h.update(data)
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.write(h.digest())
+    os.chmod(tmp, 0o444)
+    os.replace(tmp, path)
+
+
+def pack_list(repo):
+    """
+    Return the packs of repo. They are opened once and kept on the
+    repository, only once all of them are: another thread must never
+    see a partial list.
+    """
+    if repo.packs is None:
+        packs = list()
+        path = repo_dir(repo, "objects", "pack")
+        if path:
+            for f in sorted(os.listdir(path)):
+                if f.endswith(".pack") and os.path.isfile(
+                    os.path.join(path, f[: -len(".pack")] + ".idx")
+                ):
+                    packs.append(GitPack(os.path.join(path, f)))
+        repo.packs = packs
+
+    return repo.packs
+
+
+def pack_find(repo, sha):
+    """Return the pack holding sha and the object's offset in it."""
+    for pack in pack_list(repo):
+        offset = pack.index.find(sha)
+        if offset is not None:
+            return pack, offset
+
+    return None, None
+
+
+def pack_read(repo, sha):
+    """Read sha from the packs of repo. Return its type and data, or None."""
+    pack, offset = pack_find(repo, sha)
+    if not pack:
+        return None
+
+    return pack.read(repo, offset)
+
+
+def pack_info(repo, sha):
+    """Like pack_read, but return only the object's type and size."""
+    pack, offset = pack_find(repo, sha)
+    if not pack:
+        return None
+
+    return pack.info(repo, offset)
+
+
+def pack_stream(repo, sha):
+    """Like pack_read, but return a stream over the object's data."""
+    pack, offset = pack_find(repo, sha)
+    if not pack:
+        return None
+
+    return pack.stream(repo, offset)
@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import atexit
+import builtins
+import functools
+import threading
+import collections
+
+# Set by enable(). Everything else here does nothing until then, and
+# call sites check this before doing any work.
+enabled = False
+
+counters = collections.Counter()  # Name -> how many times.
+timers = collections.Counter()  # Name -> seconds spent.
+events = list()  # Chrome trace spans, if that's the output.
+
+lock = threading.Lock()
+output = None
+origin = None
+
+# The filesystem calls counted while tracing, patched in by enable().
+SYSCALLS = [
+    (builtins, "open"),
+    (os, "open"),
+    (os, "stat"),
+    (os, "lstat"),
+    (os, "scandir"),
+    (os, "listdir"),
+    (os, "replace"),
+]
+syscalls_orig = dict()
+
+
+def count(name, n=1):
+    with lock:
+        counters[name] += n
+
+
+def record(name, start, end=None):
+    """Record a call to name that started at start, in perf_counter time."""
+    end = end if end is not None else time.perf_counter()
+    with lock:
+        counters[name] += 1
+        timers[name] += end - start
+        if output and output.endswith(".json"):
+            events.append(
+                dict(
+                    name=name,
+                    ph="X",
+                    ts=(start - origin) * 1e6,
+                    dur=(end - start) * 1e6,
+                    pid=os.getpid(),
+                    tid=threading.get_ident(),
+                )
+            )
+
+
+def timed(name):
+    """
+    Decorate a function to count and time its calls under name. When
+    tracing is off, the wrapper only checks the flag.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, start)
+
+        return wrapper
+
+    return decorator
+
+
+def syscall_wrap(name, fn):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record("syscall." + name, start)
+
+    return wrapper
+
+
+def enable(dest):
+    """
+    Start tracing. dest says where the report goes at exit: "1",
+    "true" or "-" for a summary on stderr, a path ending in .json for
+    a Chrome trace, any other path for a summary appended to it.
+    """
+    global enabled, output, origin
+
+    if enabled:
+        return
+    enabled = True
+    output = None if dest.lower() in ("1", "true", "-") else dest
+    origin = time.perf_counter()
+
+    for module, name in SYSCALLS:
+        fn = getattr(module, name)
+        syscalls_orig[(module, name)] = fn
+        setattr(module, name, syscall_wrap(name, fn))
+
+    atexit.register(report)
+
+
+def enable_from_env():
+    """Start tracing if PIT_TRACE_PERF asks for it."""
+    dest = os.environ.get("PIT_TRACE_PERF", "")
+    if dest and dest.lower() not in ("0", "false"):
+        enable(dest)
+
+
+def disable():
+    global enabled
+
+    enabled = False
+    for (module, name), fn in syscalls_orig.items():
+        setattr(module, name, fn)
+    syscalls_orig.clear()
+
+
+def summary():
+    """The report as text: counts and times, slowest first."""
+    total = time.perf_counter() - origin
+    lines = ["pit perf: {0:.3f} ms total".format(total * 1000)]
+    width = max((len(name) for name in counters), default=0)
+    for name in sorted(counters, key=lambda n: (-timers[n], n)):
+        if name in timers:
+            lines.append(
+                "  {0:<{1}} {2:>9} calls {3:>11.3f} ms".format(
+                    name, width, counters[name], timers[name] * 1000
+                )
+            )
+        else:
+            lines.append("  {0:<{1}} {2:>9}".format(name, width, counters[name]))
+    return "\n".join(lines) + "\n"
+
+
+def report():
+    """Write the report where enable() was told to."""
+    # Our own writes are not part of the command.
+    disable()
+
+    if not output:
+        sys.stderr.write(summary())
+    elif output.endswith(".json"):
+        # Counters that aren't spans, like bytes, as one counter event.
+        values = {n: c for n, c in counters.items() if n not in timers}
+        trace = events + [
+            dict(name="counters", ph="C", ts=0, pid=os.getpid(), args=values)
+        ]
+        with open(output, "w") as f:
+            json.dump(dict(traceEvents=trace, displayTimeUnit="ms"), f)
+    else:
+        with open(output, "a") as f:
+            f.write(summary())
@@ -1,22 +1,124 @@
 import os
 import collections
-from repo import repo_dir, repo_file
+from repo import repo_dir, repo_file, repo_path
+import perf
 
+PACKED_REFS_HEADER = "# pack-refs with: peeled fully-peeled sorted \n"
 
-def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
 
-    # Sometimes, an indirect reference may be broken. This is normal
-    # in one specific case: we're looking for HEAD on a new repository
-    # with no commits. In that case, .git/HEAD points to "ref:
-    # refs/heads/main", but ./git/refs/heads/main doesn't exist yet
-    # (since there's no commit for it to refer to).
+class GitRefSnapshot(object):
+    """
+    Every ref under refs/, loose or packed, read once.
+
+    refs maps full ref names to their raw value, sorted by name: a sha,
+    or "ref: <name>" for a symbolic ref. peeled maps the annotated tags
+    of packed-refs to the object they point to, when git recorded it.
+    """
+
+    def __init__(self, refs, peeled, packed):
+        # Only sorted when someone iterates over refs: creating many
+        # refs in a row sorts them once, not once per ref.
+        self._refs = refs
+        self._sorted = False
+        self.peeled = peeled
+        self.packed = packed  # The names that came from packed-refs.
+
+    @property
+    def refs(self):
+        if not self._sorted:
+            self._refs = collections.OrderedDict(sorted(self._refs.items()))
+            self._sorted = True
+        return self._refs
+
+    def get(self, name):
+        """The raw value of ref name, or None. This doesn't sort refs."""
+        return self._refs.get(name)
+
+    def set(self, name, value):
+        if name not in self._refs:
+            self._sorted = False
+        self._refs[name] = value
+
+
+def packed_refs_read(repo):
+    """Parse .git/packed-refs. Return refs and peeled values."""
+    refs = dict()
+    peeled = dict()
+
+    path = repo_path(repo, "packed-refs")
     if not os.path.isfile(path):
-        return None
+        return refs, peeled
 
+    last = None
     with open(path, "r") as fp:
-        data = fp.read()[:-1]
-        # Drop final \n
+        for line in fp:
+            line = line.rstrip("\n")
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("^"):
+                # The peeled value of the tag on the previous line.
+                peeled[last] = line[1:]
+                continue
+            sha, last = line.split(" ", 1)
+            refs[last] = sha
+
+    return refs, peeled
+
+
+def loose_refs_read(repo, path, prefix, refs):
+    """Walk the loose refs under path, adding them to refs."""
+    with os.scandir(path) as it:
+        for entry in it:
+            name = prefix + "/" + entry.name
+            if entry.is_dir():
+                loose_refs_read(repo, entry.path, name, refs)
+            else:
+                with open(entry.path, "r") as fp:
+                    refs[name] = fp.read().strip()
+
+
+def ref_snapshot(repo):
+    """
+    Return the ref snapshot of repo, reading packed-refs and the
+    loose refs on first use. Loose refs override packed ones.
+    """
+    if repo.refs is None:
+        packed, peeled = packed_refs_read(repo)
+        refs = dict(packed)
+
+        path = repo_dir(repo, "refs")
+        if path:
+            loose_refs_read(repo, path, "refs", refs)
+
+        # A loose ref that moved makes its packed peeled value stale.
+        peeled = {k: v for k, v in peeled.items() if refs[k] == packed[k]}
+
+        repo.refs = GitRefSnapshot(refs, peeled, packed)
+
+    return repo.refs
+
+
+@perf.timed("ref_resolve")
+def ref_resolve(repo, ref):
+    # Refs under refs/ come from the snapshot. Others, like HEAD,
+    # are always read from their file.
+    if ref.startswith("refs/"):
+        data = ref_snapshot(repo).get(ref)
+    else:
+        # Sometimes, an indirect reference may be broken. This is normal
+        # in one specific case: we're looking for HEAD on a new repository
+        # with no commits. In that case, .git/HEAD points to "ref:
+        # refs/heads/main", but ./git/refs/heads/main doesn't exist yet
+        # (since there's no commit for it to refer to).
+        path = repo_path(repo, ref)
+        if not os.path.isfile(path):
+            return None
+
+        with open(path, "r") as fp:
+            data = fp.read().strip()
+
+    if data is None:
+        return None
 
     if data.startswith("ref: "):
         return ref_resolve(repo, data[5:])
@@ -24,19 +126,37 @@ def ref_resolve(repo, ref):
         return data
 
 
+def ref_peeled(repo, ref):
+    """Return the peeled value of ref recorded in packed-refs, or None."""
+    return ref_snapshot(repo).peeled.get(ref)
+
+
 def ref_list(repo, path=None):
+    """
+    Return the refs under path (refs/ by default) as nested
+    OrderedDicts, sorted the way git shows them, mapping names to
+    resolved shas.
+    """
     if not path:
-        path = repo_dir(repo, "refs")
+        path = "refs"
+    prefix = path.rstrip("/") + "/"
 
     ret = collections.OrderedDict()
-    # Git shows refs sorted. To do the same, we use
-    # an OrderedDict and sort the output of listdir
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path, f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
-        else:
-            ret[f] = ref_resolve(repo, can)
+    for name in ref_snapshot(repo).refs:
+        if not name.startswith(prefix):
+            continue
+
+        sha = ref_resolve(repo, name)
+        if not sha:
+            # A broken symbolic ref.
+            continue
+
+        # Walk down to the dict of the ref's directory.
+        *dirs, leaf = name[len(prefix) :].split("/")
+        dct = ret
+        for d in dirs:
+            dct = dct.setdefault(d, collections.OrderedDict())
+        dct[leaf] = sha
 
     return ret
 
@@ -44,3 +164,23 @@ def ref_list(repo, path=None):
 def ref_create(repo, ref_name, sha):
     with open(repo_file(repo, "refs/" + ref_name), "w") as fp:
         fp.write(sha + "\n")
+
+    if repo.refs is not None:
+        repo.refs.set("refs/" + ref_name, sha)
+        repo.refs.peeled.pop("refs/" + ref_name, None)
+
+
+def packed_refs_write(repo, refs, peeled):
+    """Write refs and their peeled values to .git/packed-refs."""
+    path = repo_path(repo, "packed-refs")
+    lines = [PACKED_REFS_HEADER]
+    for name in sorted(refs):
+        lines.append("{0} {1}\n".format(refs[name], name))
+        if name in peeled:
+            lines.append("^{0}\n".format(peeled[name]))
+
+    # Write the whole file aside, then swap it in, so readers never
+    # see it half-written.
+    with open(path + ".lock", "w") as fp:
+        fp.write("".join(lines))
+    os.replace(path + ".lock", path)
@@ -1,5 +1,11 @@
 import os
-import configparser
+from cache import (
+    ObjectCache,
+    OBJECT_CACHE_LIMIT,
+    BLOB_CACHE_LIMIT,
+    parse_size,
+)
+from config import GitConfig, config_read
 from error import FileSystemException, GitException
 
 
@@ -8,7 +14,14 @@ class GitRepository(object):
 
     worktree: str | None = None
     gitdir: str | None = None
-    conf: configparser.ConfigParser | None = None
+    conf: GitConfig | None = None
+    odb: object | None = None
+    packs: list | None = None
+    bitmap: tuple | None = None
+    cache: ObjectCache | None = None
+    refs: object | None = None
+    oid_index: object | None = None
+    commit_graph: object | None = None
 
     def __init__(self, path, force=False):
         self.worktree = path
@@ -17,20 +30,40 @@ class GitRepository(object):
         if not (force or os.path.isdir(self.gitdir)):
             raise GitException("Not a Git repository %s" % path)
 
-        # Read configuration file in .git/config
-        self.conf = configparser.ConfigParser()
+        # Read configuration file in .git/config, on top of the user's.
         cf = repo_file(self, "config")
 
         if cf and os.path.exists(cf):
-            self.conf.read([cf])
+            self.conf = config_read(cf)
         elif not force:
             raise GitException("Configuration file missing")
+        else:
+            self.conf = config_read()
 
         if not force:
-            vers = int(self.conf.get("core", "repositoryformatversion"))
+            vers = int(self.conf.get("core", "repositoryformatversion", fallback="0"))
             if vers != 0:
                 raise GitException("Unsupported repositoryformatversion %s" % vers)
 
+        # Objects read during this process, shared by every command.
+        self.cache = ObjectCache(*repo_cache_limits(self.conf))
+
+
+def repo_cache_limits(conf):
+    """
+    The limits of the object cache in conf: pit.objectCacheLimit and
+    pit.blobCacheLimit, in bytes.
+    """
+    return (
+        parse_size(
+            conf.get("pit", "objectcachelimit", fallback=None)
+            or str(OBJECT_CACHE_LIMIT)
+        ),
+        parse_size(
+            conf.get("pit", "blobcachelimit", fallback=None) or str(BLOB_CACHE_LIMIT)
+        ),
+    )
+
 
 def repo_path(repo, *path):
     """Compute path under repo's gitdir."""
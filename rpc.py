@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import socket
+import struct
+
+# The commands pit serve answers. They only read the repository, so
+# the server's warm caches can't make them write stale data.
+SERVE_COMMANDS = ("cat-file", "ls-tree", "log", "show-refs", "rev-parse", "rev-list")
+
+# Where pit serve listens by default, under the gitdir.
+SERVE_SOCKET = "pit.sock"
+
+# Frames are a one byte kind and a payload length, then the payload.
+FRAME_HEADER = struct.Struct(">cI")
+FRAME_ARGS = b"A"  # Client to server: JSON, {"argv": [...]}.
+FRAME_STDOUT = b"O"
+FRAME_STDERR = b"E"
+FRAME_EXIT = b"X"  # Last frame: the exit status, as a 4 bytes integer.
+
+
+def frame(kind, payload):
+    return FRAME_HEADER.pack(kind, len(payload)) + payload
+
+
+def rpc_forwardable(args):
+    """Whether the parsed command line args can go to a server."""
+    if args.command not in SERVE_COMMANDS or args.profile:
+        return False
+    # Batch mode talks over stdin, which we don't forward.
+    if args.command == "cat-file" and (args.batch or args.batch_check):
+        return False
+    return True
+
+
+def rpc_socket_find(path="."):
+    """
+    Return the socket of the server for the repository at path, from
+    $PIT_SOCKET or .git/pit.sock, or None. This only costs a few stats:
+    it runs before every forwardable command.
+    """
+    env = os.environ.get("PIT_SOCKET")
+    if env:
+        return env if os.path.exists(env) else None
+
+    path = os.path.realpath(path)
+    while True:
+        gitdir = os.path.join(path, ".git")
+        if os.path.isdir(gitdir):
+            sock = os.path.join(gitdir, SERVE_SOCKET)
+            return sock if os.path.exists(sock) else None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def recv_exactly(sock, n):
+    chunks = list()
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError("pit serve closed the connection")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def rpc_forward(path, argv):
+    """
+    Run the command line argv on the server listening on path, copying
+    its output to ours. Return its exit status, or None if there is no
+    server there, in which case the caller runs the command itself.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # A socket left behind by a server that is gone.
+        sock.close()
+        return None
+
+    with sock:
+        sock.sendall(frame(FRAME_ARGS, json.dumps(dict(argv=argv)).encode("utf8")))
+        while True:
+            kind, size = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+            payload = recv_exactly(sock, size)
+            match kind:
+                case b"O":
+                    # Output comes while the command runs: pass it on.
+                    sys.stdout.buffer.write(payload)
+                    sys.stdout.buffer.flush()
+                case b"E":
+                    sys.stderr.buffer.write(payload)
+                    sys.stderr.buffer.flush()
+                case b"X":
+                    sys.stdout.flush()
+                    return struct.unpack(">i", payload)[0]
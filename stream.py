@@ -0,0 +1,61 @@
+import io
+import zlib
+from error import GitException
+
+# How much data we read, inflate or copy at a time.
+STREAM_CHUNK = 64 * 1024
+
+
+class InflateStream(io.RawIOBase):
+    """
+    A readable stream over zlib-compressed data, inflated on demand.
+
+    source is a callable returning the next chunk of compressed data,
+    or b"" at the end. Only as much as the caller asks for is inflated,
+    so memory use doesn't depend on the size of the object. If size
+    is known, the inflated length is checked against it at the end.
+    """
+
+    def __init__(self, source, size=None, on_close=None):
+        self.source = source
+        self.size = size
+        self.on_close = on_close
+        self.inflater = zlib.decompressobj()
+        self.pending = b""  # Compressed data not consumed yet.
+        self.buf = b""  # Inflated data not returned yet.
+        self.total = 0
+
+    def readable(self):
+        return True
+
+    def unread(self, data):
+        """Push data back, to be returned by the next read."""
+        self.buf = data + self.buf
+
+    def readinto(self, b):
+        n = len(b)
+
+        while not self.buf:
+            if self.inflater.eof:
+                if self.size is not None and self.total != self.size:
+                    raise GitException("Malformed object: bad length")
+                return 0
+
+            if not self.pending:
+                self.pending = self.source()
+                if not self.pending:
+                    raise GitException("Truncated zlib stream")
+
+            self.buf = self.inflater.decompress(self.pending, max(n, STREAM_CHUNK))
+            self.pending = self.inflater.unconsumed_tail
+            self.total += len(self.buf)
+
+        k = min(n, len(self.buf))
+        b[:k] = self.buf[:k]
+        self.buf = self.buf[k:]
+        return k
+
+    def close(self):
+        if not self.closed and self.on_close:
+            self.on_close()
+        super().close()
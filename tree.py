@@ -1,55 +1,126 @@
+import array
+from error import GitException
+import perf
+
+
 class GitTreeLeaf(object):
+    __slots__ = ("mode", "path", "sha")
+
     def __init__(self, mode, path, sha):
         self.mode = mode
         self.sha = sha
         self.path = path
 
 
-def tree_parse_one(raw, start=0):
+class GitTreeEntries(object):
     """
-    Parse a single tree entry
+    The entries of a tree, backed by the raw tree data.
+
+    Parsing only records where each entry starts and where its path
+    ends. Modes, paths and shas are sliced and decoded when asked for,
+    and no object is created per entry.
     """
-    # Find the space terminator of the mode.
-    x = raw.find(b" ", start)
-    assert x - start == 5 or x - start == 6
 
-    # Read the mode.
-    mode = raw[start:x]
-    if len(mode) == 5:
-        # Normalize the six bytes.
-        mode = b"0" + mode
+    __slots__ = ("raw", "starts", "nuls")
+
+    def __init__(self, raw):
+        if not isinstance(raw, bytes):
+            raw = bytes(raw)
+
+        self.raw = raw
+        self.starts = array.array("I")
+        self.nuls = array.array("I")
+
+        # Each entry is "<mode> <path>\0<20 bytes sha>".
+        pos = 0
+        size = len(raw)
+        while pos < size:
+            y = raw.find(b"\x00", pos)
+            if y < 0 or y + 21 > size:
+                raise GitException("Malformed tree entry at {0}".format(pos))
+            self.starts.append(pos)
+            self.nuls.append(y)
+            pos = y + 21
+
+    def __len__(self):
+        return len(self.starts)
+
+    def mode(self, i):
+        """The mode of entry i, normalized to six bytes."""
+        start = self.starts[i]
+        x = self.raw.find(b" ", start, self.nuls[i])
+        assert x - start == 5 or x - start == 6
+        mode = self.raw[start:x]
+        if len(mode) == 5:
+            # Normalize the six bytes.
+            mode = b"0" + mode
+        return mode
+
+    def is_tree(self, i):
+        return self.raw.startswith(b"40000 ", self.starts[i])
+
+    def name(self, i):
+        """The path of entry i, as raw bytes."""
+        x = self.raw.find(b" ", self.starts[i], self.nuls[i])
+        return self.raw[x + 1 : self.nuls[i]]
 
-    # Find the null terminator of the path
-    y = raw.find(b"\x00", x)
-    # and read the path
-    path = raw[x + 1 : y]
+    def path(self, i):
+        return self.name(i).decode("utf8")
 
-    # Read the SHA and convert to a hex string.
-    sha = format(int.from_bytes(raw[y + 1 : y + 21], "big"), "040x")
-    return y + 21, GitTreeLeaf(mode, path.decode("utf8"), sha)
+    def binsha(self, i):
+        y = self.nuls[i]
+        return self.raw[y + 1 : y + 21]
 
+    def sha(self, i):
+        return self.binsha(i).hex()
 
+    def __getitem__(self, i):
+        return GitTreeLeaf(self.mode(i), self.path(i), self.sha(i))
+
+    def __iter__(self):
+        for i in range(len(self.starts)):
+            yield self[i]
+
+    def sort_key(self, i):
+        """The key git sorts entries by: trees sort as if with a "/"."""
+        return self.name(i) + b"/" if self.is_tree(i) else self.name(i)
+
+    def find(self, name):
+        """
+        Return the index of the entry named name, or None. Entries are
+        sorted, so this is a binary search.
+        """
+        if type(name) == str:
+            name = name.encode("utf8")
+
+        # We don't know whether name is a tree, so look for both keys.
+        for key in (name, name + b"/"):
+            lo, hi = 0, len(self.starts)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.sort_key(mid) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(self.starts) and self.sort_key(lo) == key:
+                return lo
+
+        return None
+
+
+@perf.timed("tree_parse")
 def tree_parse(raw):
     """
-    Parse a tree object, calling tree_parse_one for
-    each of its entries
+    Parse a tree object into its compact GitTreeEntries.
     """
-    pos = 0
-    max = len(raw)
-    ret = list()
-
-    while pos < max:
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
-
-    return ret
+    return GitTreeEntries(raw)
 
 
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startwith(b"10"):
-        return leaf.path
+    if leaf.mode.startswith(b"04"):
+        return leaf.path.encode("utf8") + b"/"
     else:
-        return leaf.path + "/"
+        return leaf.path.encode("utf8")
 
 
 def tree_serialize(obj):
@@ -57,14 +128,13 @@ def tree_serialize(obj):
     Serialize a tree object in bytes
     """
     obj.items.sort(key=tree_leaf_sort_key)
-    ret = b""
-
-    for i in obj.items:
-        ret += i.mode
-        ret += b" "
-        ret += i.path.encode("utf8")
-        ret += b"\x00"
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
 
-    return ret
+    return b"".join(
+        # Git writes tree modes without their leading zero.
+        i.mode.lstrip(b"0")
+        + b" "
+        + i.path.encode("utf8")
+        + b"\x00"
+        + bytes.fromhex(i.sha)
+        for i in obj.items
+    )